@@ -0,0 +1,138 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import backends, plot
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+
+def fake_colorize(seconds, ok=True):
+    def colorize(folder, input_file, output_file, color, transparency):
+        time.sleep(seconds)
+        return ok
+    return colorize
+
+
+class TestSelect(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        # Fake engines in an empty registry, the calibration is cached in a temp dir
+        patchers = [mock.patch.dict(backends._registry, {operation: {} for operation in backends.OPERATIONS}),
+                    mock.patch.object(backends, '_calibration', None),
+                    mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self._temp_dir.name})]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.slow = backends.Engine('slow', 'colorize', fake_colorize(0.02), transparency=True, popups=True)
+        self.fast = backends.Engine('fast', 'colorize', fake_colorize(0.0))
+        self.missing = backends.Engine('missing', 'colorize', fake_colorize(0.0), transparency=True, popups=True,
+                                       transparent_popups=True, available=lambda: False)
+        for engine in (self.slow, self.fast, self.missing):
+            backends.register(engine)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_register(self):
+        self.assertEqual(['auto', 'slow', 'fast', 'missing'], backends.names('colorize'))
+        with self.assertRaises(ValueError):
+            backends.register(self.fast._replace(operation='print'))
+
+    def test_by_name(self):
+        self.assertIs(self.fast, backends.select('colorize', 'fast', transparency=True))
+        self.assertIsNone(backends.select('colorize', 'missing'))
+        self.assertIsNone(backends.select('colorize', 'unknown'))
+
+    def test_capabilities(self):
+        # The first available engine doing the job
+        self.assertIs(self.slow, backends.select('colorize'))
+        self.assertIs(self.slow, backends.select('colorize', transparency=True))
+        self.assertIs(self.slow, backends.select('colorize', popups=True))
+        # Nothing keeps the popups of a transparent layer, the first available engine is used anyway
+        with self.assertLogs(backends._logger, 'WARNING'):
+            self.assertIs(self.slow, backends.select('colorize', transparency=True, popups=True))
+        self.assertIsNone(backends.select('merge'))
+
+    def test_supports(self):
+        self.assertTrue(self.slow.supports(transparency=True))
+        self.assertTrue(self.slow.supports(popups=True))
+        self.assertFalse(self.slow.supports(transparency=True, popups=True))
+        self.assertTrue(self.missing.supports(transparency=True, popups=True))
+        self.assertFalse(self.fast.supports(transparency=True))
+        self.assertFalse(self.fast.supports(popups=True))
+        self.assertFalse(self.fast.supports(scaling=True))
+
+    def test_auto_picks_the_fastest_capable_engine(self):
+        self.assertIs(self.fast, backends.select('colorize', backends.AUTO))
+        # The capabilities come first
+        self.assertIs(self.slow, backends.select('colorize', backends.AUTO, transparency=True))
+        self.assertIs(self.slow, backends.select('colorize', backends.AUTO, popups=True))
+        timings = backends.calibration()['colorize']
+        self.assertEqual({'slow', 'fast'}, set(timings))
+        self.assertLess(timings['fast'], timings['slow'])
+
+    def test_failing_engine_is_never_fastest(self):
+        backends.register(backends.Engine('broken', 'colorize', fake_colorize(0.0, ok=False)))
+        with self.assertLogs(backends._logger, 'WARNING'):
+            timings = backends.calibration()['colorize']
+        self.assertNotIn('broken', timings)
+        self.assertIs(self.fast, backends.select('colorize', backends.AUTO))
+
+    def test_calibration_cache(self):
+        with mock.patch.object(backends, '_calibrate', return_value={'colorize': {'slow': 1.0}}) as calibrate:
+            self.assertEqual({'colorize': {'slow': 1.0}}, backends.calibration())
+            self.assertEqual({'colorize': {'slow': 1.0}}, backends.calibration())
+            self.assertEqual(1, calibrate.call_count)
+            with open(backends.calibration_path()) as f:
+                cached = json.load(f)
+            self.assertEqual(backends._fingerprint(), cached['fingerprint'])
+            self.assertNotIn('node', cached['fingerprint'])
+
+            # Read from the file by another process
+            backends._calibration = None
+            self.assertEqual({'colorize': {'slow': 1.0}}, backends.calibration())
+            self.assertEqual(1, calibrate.call_count)
+
+            # Measured again for other engines and on request
+            backends.register(backends.Engine('new', 'colorize', fake_colorize(0.0)))
+            backends.calibration()
+            self.assertEqual(2, calibrate.call_count)
+            backends.calibration(refresh=True)
+            self.assertEqual(3, calibrate.call_count)
+
+    def test_unreadable_calibration(self):
+        os.makedirs(os.path.dirname(backends.calibration_path()))
+        with open(backends.calibration_path(), 'w') as f:
+            f.write('{')
+        with mock.patch.object(backends, '_calibrate', return_value={}) as calibrate:
+            self.assertEqual({}, backends.calibration())
+        calibrate.assert_called_once()
+
+
+class TestRegisteredEngines(unittest.TestCase):
+    def test_pymupdf_colorize_popups(self):
+        engine = backends._registry['colorize']['pymupdf']
+        self.assertTrue(engine.supports(popups=True))
+        self.assertTrue(engine.supports(transparency=True))
+        self.assertFalse(engine.supports(transparency=True, popups=True))
+
+    @unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+    def test_transparent_pymupdf_colorize_drops_the_popups(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with plot.pymupdf.open() as doc:
+                page = doc.new_page(width=200, height=100)
+                page.draw_rect((10, 10, 50, 50), color=(0, 0, 0), fill=(0, 0, 0))
+                page.add_text_annot((20, 20), 'R1')
+                doc.save(os.path.join(folder, 'layer.pdf'))
+            for transparency, annotations in ((0, 1), (50, 0)):
+                self.assertTrue(plot.colorize_pdf_pymupdf(folder, 'layer.pdf', 'colored.pdf', (1, 0, 0), transparency))
+                with plot.pymupdf.open(os.path.join(folder, 'colored.pdf')) as doc:
+                    self.assertEqual(annotations, len(list(doc[0].annots())), transparency)
+
+
+if __name__ == "__main__":
+    unittest.main()
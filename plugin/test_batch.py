@@ -0,0 +1,143 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import batch, plot
+import contextlib
+import io
+import json
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+DEFAULT_INI = os.path.join(os.path.dirname(batch.__file__), 'default_config.ini')
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('')
+
+
+def summary(board, success=True, errors=(), outputs=()):
+    return {'board': board, 'success': success, 'status': 'done' if success else 'failed', 'outputs': list(outputs),
+            'timings': {}, 'warnings': [], 'errors': list(errors), 'seconds': 1.5}
+
+
+class TestBoards(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.a = os.path.join(self.folder, 'a', 'a.kicad_pcb')
+        self.b = os.path.join(self.folder, 'b', 'b.kicad_pcb')
+        touch(self.a)
+        touch(self.b)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_expand_boards(self):
+        pattern = os.path.join(self.folder, '**', '*.kicad_pcb')
+        self.assertEqual([self.a, self.b], batch.expand_boards([self.b, pattern]))
+        with self.assertLogs(batch._logger, 'WARNING'):
+            self.assertEqual([], batch.expand_boards([os.path.join(self.folder, '*.kicad_sch')]))
+        # A plain path is taken as it is, run_batch reports it if it doesn't exist
+        missing = os.path.join(self.folder, 'c.kicad_pcb')
+        self.assertEqual([missing], batch.expand_boards([missing]))
+
+    def test_load_manifest(self):
+        manifest = os.path.join(self.folder, 'boards.json')
+        with open(manifest, 'w') as f:
+            json.dump({'boards': ['a/a.kicad_pcb', {'board': '*/b.kicad_pcb', 'ini': 'b/customer.ini',
+                                                    'overrides': {'output_path': 'docs'}}]}, f)
+        a, b = batch.load_manifest(manifest)
+        self.assertEqual((self.a, None, {}), (a.board, a.ini, a.overrides))
+        self.assertEqual((self.b, os.path.join(self.folder, 'b', 'customer.ini'), {'output_path': 'docs'}),
+                         (b.board, b.ini, b.overrides))
+
+        with open(manifest, 'w') as f:
+            json.dump(['b/b.kicad_pcb'], f)
+        self.assertEqual([self.b], [entry.board for entry in batch.load_manifest(manifest)])
+
+
+class TestPrintSummary(unittest.TestCase):
+    def print_summary(self, summaries):
+        output = io.StringIO()
+        batch.print_summary(summaries, output)
+        return output.getvalue().splitlines()
+
+    def test_rows(self):
+        lines = self.print_summary([
+            summary('/boards/a.kicad_pcb', outputs=['/boards/a__Assembly.pdf']),
+            summary('/boards/long_name.kicad_pcb', False, ['Traceback:\n  File "plot.py"\nValueError: no layers\n'])])
+        self.assertEqual(['Board', 'Result', 'Time', 'Memory', 'Details'], lines[1].split())
+        self.assertEqual(['a.kicad_pcb', 'ok', '1.5s', '-', '/boards/a__Assembly.pdf'], lines[3].split())
+        self.assertTrue(lines[4].endswith('failed - ValueError: no layers'))
+        self.assertEqual('1 of 2 boards succeeded.', lines[-1])
+
+    def test_empty_errors(self):
+        for errors in ([''], [' \n  '], []):
+            with self.subTest(errors=errors):
+                lines = self.print_summary([summary('/boards/a.kicad_pcb', False, errors)])
+                self.assertEqual(['a.kicad_pcb', 'FAILED', '1.5s', '-', 'failed'], lines[3].split())
+
+
+class TestRunBatch(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.boards = [os.path.join(self.folder, f'{name}.kicad_pcb') for name in ('a', 'b', 'broken')]
+        for board in self.boards:
+            touch(board)
+
+        # run_batch plots in this process with jobs=1, KiCad and the plot are stubbed
+        pcbnew = types.ModuleType('pcbnew')
+        pcbnew.LoadBoard = lambda path: path
+        self.plotted = []
+        patchers = [mock.patch.dict(sys.modules, {'pcbnew': pcbnew}),
+                    mock.patch.object(plot, 'plot_board', self.plot_board),
+                    mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(self.folder, 'cache')})]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def plot_board(self, board, **config_vars):
+        self.plotted.append((board, config_vars))
+        if board.endswith('broken.kicad_pcb'):
+            raise ValueError('no layers')
+        result = plot.PlotResult()
+        result.success = True
+        result.assembly_file = board.replace('.kicad_pcb', '__Assembly.pdf')
+        return result
+
+    def test_in_this_process(self):
+        missing = os.path.join(self.folder, 'missing.kicad_pcb')
+        entries = [batch.BatchEntry(self.boards[0], overrides={'output_path': 'docs'}),
+                   batch.BatchEntry(missing), batch.BatchEntry(self.boards[1]), batch.BatchEntry(self.boards[2])]
+        with contextlib.redirect_stdout(io.StringIO()), self.assertLogs(batch._logger, 'ERROR'):
+            summaries = batch.run_batch(entries, jobs=1, ini=DEFAULT_INI, overrides={'output_path': 'plots'})
+
+        self.assertEqual([entry.board for entry in entries], [s['board'] for s in summaries])
+        self.assertEqual([True, False, True, False], [s['success'] for s in summaries])
+        self.assertEqual([self.boards[0].replace('.kicad_pcb', '__Assembly.pdf')], summaries[0]['outputs'])
+        self.assertEqual('board not found', summaries[1]['status'])
+        self.assertEqual(['no layers'], summaries[3]['errors'])
+        # The missing board isn't plotted, the entry overrides replace the batch overrides
+        self.assertEqual(self.boards, [board for board, _ in self.plotted])
+        self.assertEqual(['docs', 'plots', 'plots'], [config_vars['output_path'] for _, config_vars in self.plotted])
+        self.assertIn('templates', self.plotted[0][1])
+
+    def test_ini_not_found(self):
+        entries = [batch.BatchEntry(self.boards[0], ini=os.path.join(self.folder, 'missing.ini'))]
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            summaries = batch.run_batch(entries, jobs=1)
+        self.assertEqual('ini file not found', summaries[0]['status'])
+        self.assertEqual([], self.plotted)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import cli
+import argparse
+import unittest
+
+
+class TestMemorySize(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(2 << 30, cli.memory_size("2G"))
+        self.assertEqual(1500 << 20, cli.memory_size("1500M"))
+        self.assertEqual(512 << 20, cli.memory_size("512MiB"))
+        self.assertEqual(64 << 10, cli.memory_size("64KB"))
+        self.assertEqual(1 << 40, cli.memory_size("1T"))
+        self.assertEqual(3 << 29, cli.memory_size("1.5G"))
+
+    def test_plain_number_is_megabytes(self):
+        self.assertEqual(300 << 20, cli.memory_size("300"))
+
+    def test_case_and_spaces(self):
+        self.assertEqual(2 << 30, cli.memory_size(" 2g "))
+        self.assertEqual(20 << 20, cli.memory_size("20mb"))
+
+    def test_invalid(self):
+        for arg in ("", "G", "lots", "2X", "0", "-1G"):
+            with self.assertRaises(argparse.ArgumentTypeError, msg=arg):
+                cli.memory_size(arg)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import costs, tracing
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+
+def span(name, wall, template='', layer='', peak_rss=None):
+    result = tracing.Span(name, template, layer)
+    result.wall = wall
+    result.peak_rss = peak_rss
+    return result
+
+
+class TestCostModel(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        environ = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self._temp_dir.name})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.path = costs.default_path()
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_cache_dir(self):
+        if sys.platform in ('win32', 'darwin'):
+            self.skipTest("XDG_CACHE_HOME is only used on Linux")
+        self.assertEqual(os.path.join(self._temp_dir.name, 'board2pdf', 'costs.json'), self.path)
+
+    def test_update_blends_the_runs(self):
+        model = costs.CostModel.load()
+        self.assertEqual({}, model.boards)
+        model.update('a.kicad_pcb', [span('plot', 2.0, 'Top', 'F.Cu'), span('plot', 1.0, 'Top', 'F.Cu'),
+                                     span('crop', 5.0, 'Top'), span('merge', 1.0, 'Top', peak_rss=300)])
+        entry = model.boards['a.kicad_pcb']
+        # Spans of one stage add up, stages that aren't stored per board are left out
+        self.assertEqual({'plot|Top|F.Cu': 3.0, 'merge|Top|': 1.0}, entry['stages'])
+        self.assertEqual(4.0, entry['total'])
+        self.assertEqual(300, model.predict_peak_rss('a.kicad_pcb'))
+
+        model.update('a.kicad_pcb', [span('plot', 1.0, 'Top', 'F.Cu'), span('merge', 3.0, 'Top')], peak_rss=200)
+        self.assertEqual({'plot|Top|F.Cu': 2.0, 'merge|Top|': 2.0}, entry['stages'])
+        self.assertEqual(4.0, entry['total'])
+        self.assertEqual(200, model.predict_peak_rss('a.kicad_pcb'))
+
+        model = costs.CostModel(alpha=0.25)
+        model.update('a.kicad_pcb', [span('plot', 4.0)])
+        model.update('a.kicad_pcb', [span('plot', 8.0)])
+        self.assertEqual(5.0, model.predict('a.kicad_pcb', 'plot'))
+
+    def test_update_without_stages(self):
+        model = costs.CostModel.load()
+        model.update('a.kicad_pcb', [span('crop', 1.0)])
+        self.assertFalse(model.has_history('a.kicad_pcb'))
+        self.assertTrue(model.save())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_save_merges_with_other_processes(self):
+        first, second = costs.CostModel.load(), costs.CostModel.load()
+        first.update('a.kicad_pcb', [span('plot', 1.0)])
+        second.update('b.kicad_pcb', [span('plot', 2.0)])
+        self.assertTrue(first.save())
+        self.assertTrue(second.save())
+        self.assertEqual({'a.kicad_pcb', 'b.kicad_pcb'}, set(costs.CostModel.load().boards))
+
+        # Only the boards updated by this process are written
+        second.update('b.kicad_pcb', [span('plot', 4.0)])
+        first.update('a.kicad_pcb', [span('plot', 3.0)])
+        self.assertTrue(second.save())
+        self.assertTrue(first.save())
+        loaded = costs.CostModel.load()
+        self.assertEqual(2.0, loaded.predict('a.kicad_pcb', 'plot'))
+        self.assertEqual(3.0, loaded.predict('b.kicad_pcb', 'plot'))
+        self.assertEqual(['costs.json'], os.listdir(os.path.dirname(self.path)))
+
+    def test_unreadable_history(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{')
+        with self.assertLogs(costs._logger, 'WARNING'):
+            model = costs.CostModel.load()
+        self.assertEqual({}, model.boards)
+        model.update('a.kicad_pcb', [span('plot', 1.0)])
+        with self.assertLogs(costs._logger, 'WARNING'):
+            self.assertTrue(model.save())
+        with open(self.path) as f:
+            self.assertEqual(['a.kicad_pcb'], list(json.load(f)['boards']))
+
+    def test_predict_fallbacks(self):
+        model = costs.CostModel()
+        model.update('a.kicad_pcb', [span('colorize', 1.0, 'Top', 'F.Cu'), span('colorize', 3.0, 'Bottom', 'F.Cu'),
+                                     span('colorize', 8.0, 'Bottom', 'B.Cu')])
+        self.assertEqual(3.0, model.predict('a.kicad_pcb', 'colorize', 'Bottom', 'F.Cu'))
+        # The same layer in the other templates, then the operation on the board
+        self.assertEqual(2.0, model.predict('a.kicad_pcb', 'colorize', 'Fab', 'F.Cu'))
+        self.assertEqual(4.0, model.predict('a.kicad_pcb', 'colorize', 'Top', 'F.Mask'))
+        self.assertEqual(4.0, model.predict('a.kicad_pcb', 'colorize'))
+        # Then the defaults
+        self.assertEqual(costs.DEFAULT_COSTS['merge'], model.predict('a.kicad_pcb', 'merge', 'Top'))
+        self.assertEqual(costs.DEFAULT_COSTS['plot'], model.predict('b.kicad_pcb', 'plot', 'Top', 'F.Cu'))
+        self.assertEqual(0.25, model.predict('b.kicad_pcb', 'plot', default=0.25))
+        self.assertEqual(1.0, model.predict('b.kicad_pcb', 'unknown'))
+
+    def test_predict_board(self):
+        model = costs.CostModel()
+        self.assertEqual(0.0, model.predict_board('a.kicad_pcb'))
+        self.assertIsNone(model.predict_peak_rss('a.kicad_pcb'))
+        model.update('a.kicad_pcb', [span('plot', 2.0), span('merge', 4.0)])
+        model.update('b.kicad_pcb', [span('plot', 10.0)])
+        self.assertEqual(6.0, model.predict_board('a.kicad_pcb'))
+        # A board without history gets the average of the others
+        self.assertEqual(8.0, model.predict_board('c.kicad_pcb'))
+
+
+class TestProgressEstimate(unittest.TestCase):
+    def test_progress_by_cost(self):
+        estimate = costs.ProgressEstimate(start=0.0, end=100.0)
+        estimate.add(1.0, 'plot', 'Top', 'F.Cu')
+        estimate.add(3.0, 'colorize', 'Top', 'F.Cu')
+        estimate.add(4.0, 'merge', 'Top')
+        self.assertEqual(8.0, estimate.total)
+        self.assertEqual(0.0, estimate.step('plot', 'Top', 'F.Cu'))
+        self.assertEqual(12.5, estimate.step('colorize', 'Top', 'F.Cu'))
+        self.assertEqual(50.0, estimate.step('merge', 'Top'))
+
+    def test_without_costs(self):
+        estimate = costs.ProgressEstimate()
+        self.assertEqual(5.0, estimate.step('plot'))
+        self.assertEqual(5.0, estimate.step('merge'))
+
+    def test_eta(self):
+        estimate = costs.ProgressEstimate()
+        estimate.add(2.0, 'plot')
+        estimate.add(6.0, 'merge')
+        with mock.patch.object(costs.time, 'perf_counter', side_effect=[100.0, 101.0, 101.0]):
+            estimate.step('plot')
+            self.assertIsNone(estimate.remaining())
+            self.assertEqual('Plotting', estimate.with_eta('Plotting'))
+            # The plot took half of its predicted 2 seconds, so the merge is expected to take 3
+            estimate.step('merge')
+            self.assertEqual(3.0, estimate.remaining())
+            self.assertEqual('Merging (about 3s left)', estimate.with_eta('Merging'))
+
+    def test_format_duration(self):
+        self.assertEqual('0s', costs.format_duration(0.2))
+        self.assertEqual('59s', costs.format_duration(59.4))
+        self.assertEqual('2m 05s', costs.format_duration(125))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import geometry
+import unittest
+
+if geometry.has_numpy:
+    import numpy as np
+
+
+@unittest.skipUnless(geometry.has_numpy, "needs numpy")
+class TestParsePaths(unittest.TestCase):
+    def test_segments_and_styles(self):
+        stream = (b"q 2 0 0 2 10 0 cm 0.5 w 1 0 0 RG 0 0 m 10 0 l S Q "
+                  b"0 0 1 rg 5 5 10 20 re f BT /F1 12 Tf (S f) Tj ET 0 0 m 1 2 2 2 3 0 c n")
+        paths = geometry.parse_paths(stream)
+        self.assertEqual(3, len(paths))
+        self.assertEqual([geometry.MOVE, geometry.LINE, geometry.RECT, geometry.MOVE, geometry.CURVE],
+                         paths.ops.tolist())
+        self.assertEqual([[10, 0], [30, 0]], paths.points[:2].tolist())
+        self.assertEqual([geometry.STROKE, geometry.FILL, geometry.NO_PAINT], paths.paint.tolist())
+        self.assertEqual([True, False, False], paths.stroked.tolist())
+        self.assertEqual([False, True, False], paths.filled.tolist())
+        # The line width is in user space, scaled by the cm
+        self.assertEqual(1.0, paths.width[0])
+        self.assertEqual([1, 0, 0], paths.styles.stroke[paths.path_style[0]].tolist())
+        self.assertEqual([0, 0, 1], paths.styles.fill[paths.path_style[1]].tolist())
+
+    def test_bboxes(self):
+        paths = geometry.parse_paths(b"2 w 0 0 m 10 0 l S 5 5 10 20 re f 0 0 m 1 2 2 2 3 0 c n")
+        self.assertEqual([[-1, -1, 11, 1], [5, 5, 15, 25], [0, 0, 3, 1.5]], paths.path_bboxes().tolist())
+        # The curve is bounded by its highest point, not its control points, and isn't painted
+        self.assertEqual((-1, -1, 15, 25), paths.bbox())
+        self.assertEqual((0, 0, 15, 25), paths.bbox(stroke=False))
+
+    def test_transform_and_filter(self):
+        paths = geometry.parse_paths(b"0 0 m 10 0 l S 5 5 10 20 re f")
+        moved = paths.transform((2, 0, 0, 2, 1, 1))
+        self.assertEqual([[1, 1], [21, 1]], moved.points[:2].tolist())
+        self.assertEqual(2.0, moved.width[0])
+        rects = paths.filter([False, True])
+        self.assertEqual(1, len(rects))
+        self.assertEqual([geometry.RECT], rects.ops.tolist())
+        self.assertEqual([0, 4], rects.segment_points.tolist())
+
+    def test_forms(self):
+        names = []
+
+        def resolve(name):
+            names.append(name)
+            return b"0 0 m 1 1 l S", (1, 0, 0, 1, 100, 100), None
+
+        paths = geometry.parse_paths(b"0 0 m 1 0 l S /Fm0 Do 5 5 m 6 6 l S", resolve=resolve)
+        self.assertEqual([b"Fm0"], names)
+        # The form is painted between the paths around its Do
+        self.assertEqual([[0, 0], [1, 0], [100, 100], [101, 101], [5, 5], [6, 6]], paths.points.tolist())
+        self.assertEqual(2, len(geometry.parse_paths(b"0 0 m 1 0 l S /Fm0 Do 5 5 m 6 6 l S")))
+
+    def test_forms_inherit_the_graphics_state(self):
+        def resolve(name):
+            return b"0 0 m 1 1 l S", (2, 0, 0, 2, 0, 0), None
+
+        paths = geometry.parse_paths(b"0.5 w 1 0 0 RG /Fm0 Do", resolve=resolve)
+        self.assertEqual([1.0], paths.width.tolist())
+        self.assertEqual([1, 0, 0], paths.styles.stroke[paths.path_style[0]].tolist())
+
+    def test_paint_count(self):
+        self.assertEqual(2, geometry.paint_count(b"0 0 m 1 0 l S (S f) Tj 1 1 2 2 re f"))
+        self.assertEqual(0, len(geometry.parse_paths(b"")))
+
+
+# A nearly straight line with a corner at the end, 9 vertices
+ZIGZAG = b"0 0 m 1 0.001 l 2 0 l 3 0.001 l 4 0 l 5 0 l 6 0.001 l 7 0 l 7 7 l S"
+
+
+@unittest.skipUnless(geometry.has_numpy, "needs numpy")
+class TestSimplify(unittest.TestCase):
+    def test_simplify_polylines(self):
+        points = [[0, 0], [1, 0.01], [2, 0], [3, 0], [3, 3], [0, 0], [1, 1], [1, 1], [2, 2]]
+        # The ends and the corner are kept, the collinear and duplicate points are dropped
+        self.assertEqual([True, False, False, True, True, True, False, False, True],
+                         geometry.simplify_polylines(points, [0, 5, 9], 0.1).tolist())
+
+    def test_simplify_polylines_tolerance_per_polyline(self):
+        points = [[0, 0], [1, 0.5], [2, 0], [0, 0], [1, 0.5], [2, 0]]
+        self.assertEqual([True, True, True, True, False, True],
+                         geometry.simplify_polylines(points, [0, 3, 6], [0.1, 1.0]).tolist())
+
+    def test_simplify_polylines_short(self):
+        # Empty and single point polylines
+        self.assertEqual([True, True, True, True],
+                         geometry.simplify_polylines([[0, 0], [1, 0.5], [2, 0], [5, 5]], [0, 0, 3, 4], 0.1).tolist())
+
+    def test_simplify_stream(self):
+        stream = b"0.5 w " + ZIGZAG + b" (1 1 m 2 2 l) Tj 0 0 m 1 0 l 2 0 l S"
+        simplified, before, after = geometry.simplify_stream(stream, 0.01)
+        # Short polylines and strings are left alone, the kept vertices are copied as they are
+        self.assertEqual(b"0.5 w 0 0 m 7 0 l 7 7 l S (1 1 m 2 2 l) Tj 0 0 m 1 0 l 2 0 l S", simplified)
+        self.assertEqual((9, 3), (before, after))
+
+    def test_simplify_stream_tolerance_in_pdf_points(self):
+        scaled_up = b"q 1000 0 0 1000 0 0 cm " + ZIGZAG + b" Q"
+        self.assertEqual((scaled_up, 9, 9), geometry.simplify_stream(scaled_up, 0.01))
+        scaled_down = b"q 0.001 0 0 0.001 0 0 cm " + ZIGZAG + b" Q"
+        self.assertEqual(b"q 0.001 0 0 0.001 0 0 cm 0 0 m 7 7 l S Q", geometry.simplify_stream(scaled_down, 0.01)[0])
+        self.assertEqual((b"0 0 m 1 0 l S", 0, 0), geometry.simplify_stream(b"0 0 m 1 0 l S", 0.01))
+
+
+@unittest.skipUnless(geometry.has_numpy, "needs numpy")
+class TestMinifyStream(unittest.TestCase):
+    def test_rounding(self):
+        self.assertEqual(b"0 0 m 1.2 1 l S", geometry.minify_stream(b"0 0 m 1.23456 1 l S", 0.1))
+        self.assertEqual(b"0 0 m 1.2346 1 l S", geometry.minify_stream(b"0 0 m 1.23456 1 l S", 0.0001))
+        # Colors get 3 decimals, strings are left alone
+        self.assertEqual(b"0.333 0.667 1 rg 0 0 m 1 1 l S (12.3456 x) Tj",
+                         geometry.minify_stream(b"0.33333333 0.66666666 1 rg 0 0 m 1 1 l S (12.3456 x) Tj", 0.01))
+
+    def test_same_paths_within_precision(self):
+        stream = b"0.123456 w 10.123456 20.987654 m 30.5 20 l 1.001 2.002 3.003 4.004 5.005 6.006 c S"
+        minified = geometry.minify_stream(stream, 0.01)
+        before, after = geometry.parse_paths(stream), geometry.parse_paths(minified)
+        self.assertLess(len(minified), len(stream))
+        self.assertEqual(before.ops.tolist(), after.ops.tolist())
+        self.assertLessEqual(abs(before.points - after.points).max(), 0.01)
+        self.assertLessEqual(abs(before.width - after.width).max(), 0.01)
+
+    def test_redundant_state_dropped(self):
+        self.assertEqual(b"1 0 0 RG 3 w 0 0 m 1 1 l S",
+                         geometry.minify_stream(b"1 0 0 RG 1 0 0 RG 2 w 3 w 0 0 m 1 1 l S", 0.01))
+
+    def test_paths_merged(self):
+        # Strokes with the same state are always merged
+        self.assertEqual(b"1 0 0 RG 0 0 m 5 5 l 5 0 m 0 5 l S",
+                         geometry.minify_stream(b"1 0 0 RG 0 0 m 5 5 l S 1 0 0 RG 5 0 m 0 5 l S", 0.01))
+        # Fills only if they don't touch
+        self.assertEqual(b"0 g 0 0 5 5 re 10 10 5 5 re f",
+                         geometry.minify_stream(b"0 g 0 0 5 5 re f 10 10 5 5 re f", 0.01))
+        self.assertEqual(b"0 g 0 0 5 5 re f 2 2 5 5 re f",
+                         geometry.minify_stream(b"0 g 0 0 5 5 re f 2 2 5 5 re f", 0.01))
+        # Nothing is merged with transparency
+        self.assertEqual(b"/GS0 gs 0 0 m 1 1 l S 2 2 m 3 3 l S",
+                         geometry.minify_stream(b"/GS0 gs 0 0 m 1 1 l S 2 2 m 3 3 l S", 0.01))
+        self.assertEqual(b"", geometry.minify_stream(b"", 0.01))
+
+
+@unittest.skipUnless(geometry.has_numpy, "needs numpy")
+class TestCullStream(unittest.TestCase):
+    def setUp(self):
+        # 20 x 20 pixels, the lower left quarter is covered
+        self.covered = np.zeros((20, 20), dtype=bool)
+        self.covered[0:10, 0:10] = True
+
+    def test_hidden_paths_dropped(self):
+        stream = (b"0 0 1 rg 2 2 3 3 re f 12 12 3 3 re f 3 3 m 6 3 l S "
+                  b"q 3 3 2 2 re W n 4 4 m 5 5 l S Q 2 2 m 1 w 3 3 l S")
+        culled, paths, dropped = geometry.cull_stream(stream, geometry.IDENTITY, self.covered)
+        # The clipping path and the path with a w operator inside it are kept
+        self.assertEqual(b"0 0 1 rg 12 12 3 3 re f q 3 3 2 2 re W n Q 2 2 m 1 w 3 3 l S", culled)
+        self.assertEqual((6, 3), (paths, dropped))
+
+    def test_ctm_maps_to_pixels(self):
+        stream = b"2 2 3 3 re f"
+        self.assertEqual((b"", 1, 1), geometry.cull_stream(stream, geometry.IDENTITY, self.covered))
+        # Scaled by 3 the box and the pixel around it reach past the covered quarter
+        self.assertEqual((stream, 1, 0), geometry.cull_stream(stream, (3, 0, 0, 3, 0, 0), self.covered))
+        # Rows are y
+        self.assertEqual((stream, 1, 0), geometry.cull_stream(stream, geometry.IDENTITY, self.covered.T[::-1]))
+
+    def test_outside_the_pixels_kept(self):
+        self.assertEqual((b"0 0 m 5 0 l S", 1, 0),
+                         geometry.cull_stream(b"0 0 m 5 0 l S", geometry.IDENTITY, self.covered))
+        self.assertEqual((b"", 0, 0), geometry.cull_stream(b"", geometry.IDENTITY, self.covered))
+
+    def test_opaque_pixels(self):
+        self.assertEqual([[True, False]], geometry.opaque_pixels(bytes([0, 0, 0, 255, 9, 9, 9, 254]), 2, 1, 4).tolist())
+
+
+def glyph(x, y):
+    """An A of the stroke font, two touching polylines."""
+    return b"%d %d m %d %d l %d %d l S %d %d m %d %d l S " % (x, y, x + 1, y + 2, x + 2, y, x, y + 1, x + 2, y + 1)
+
+
+@unittest.skipUnless(geometry.has_numpy, "needs numpy")
+class TestDedupStrokes(unittest.TestCase):
+    def setUp(self):
+        self.stream = b"0.2 w " + glyph(0, 0) + glyph(10, 0) + b"5 5 m 6 6 l S " + glyph(20, 30)
+
+    def test_repeated_shapes_drawn_once(self):
+        deduped, forms, replaced = geometry.dedup_strokes(self.stream, 0.01, b"B2PGlyph", min_saving=0)
+        self.assertEqual(b"0.2 w\nq 1 0 0 1 0 0 cm /B2PGlyph0 Do Q\nq 1 0 0 1 10 0 cm /B2PGlyph0 Do Q 5 5 m 6 6 l S\n"
+                         b"q 1 0 0 1 20 30 cm /B2PGlyph0 Do Q ", deduped)
+        self.assertEqual(3, replaced)
+        self.assertEqual([b"0 0 m\n1 2 l\n2 0 l\nS\n0 1 m\n2 1 l\nS\n"], [content for content, _ in forms])
+
+        # Painted with its forms the stream draws the same paths in the same order
+        def resolve(name):
+            return forms[int(name[len(b"B2PGlyph"):])][0], geometry.IDENTITY, None
+
+        before, after = geometry.parse_paths(self.stream), geometry.parse_paths(deduped, resolve=resolve)
+        self.assertEqual(before.points.tolist(), after.points.tolist())
+        self.assertEqual(before.width.tolist(), after.width.tolist())
+
+    def test_small_savings_left_alone(self):
+        self.assertEqual((self.stream, [], 0), geometry.dedup_strokes(self.stream, 0.01, b"B2PGlyph"))
+        self.assertEqual((b"0 0 m 1 1 l S", [], 0), geometry.dedup_strokes(b"0 0 m 1 1 l S", 0.01, b"G", 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
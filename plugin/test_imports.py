@@ -0,0 +1,39 @@
+import sys
+sys.path.append("src")
+
+import os
+import subprocess
+import unittest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+PDF_MODULES = ("fitz", "pymupdf", "pypdf", "wx")
+
+
+def imported_after(code):
+    """The PDF_MODULES imported by a fresh interpreter running `code`."""
+    script = (f"import sys; sys.path.insert(0, {SRC!r}); {code}; "
+              f"print(','.join(m for m in {PDF_MODULES!r} if m in sys.modules))")
+    completed = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    return [m for m in completed.stdout.strip().split(",") if m]
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_plot_imports_no_pdf_library(self):
+        self.assertEqual([], imported_after("import board2pdf.plot"))
+
+    def test_cli_imports_no_pdf_library(self):
+        self.assertEqual([], imported_after("import board2pdf.cli"))
+
+    def test_imported_on_first_use(self):
+        try:
+            import pypdf  # noqa: F401
+        except ImportError:
+            self.skipTest("needs pypdf")
+        self.assertEqual(["pypdf"], imported_after("from board2pdf import plot; plot.pypdf.PdfWriter"))
+
+    def test_no_wx_headless(self):
+        self.assertEqual([], imported_after("from board2pdf import plot; assert plot._wx() is None"))
+
+
+if __name__ == "__main__":
+    unittest.main()
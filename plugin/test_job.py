@@ -0,0 +1,129 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import job, plot
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+
+class StubPlot:
+    """Stands in for plot.plot_board: reports two layers and waits for `release` between them."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, board, progress_callback=None, cancel_token=None, **kwargs):
+        result = plot.PlotResult()
+        progress_callback(10, 'Plotting F.Cu')
+        self.started.set()
+        self.release.wait(5)
+        if cancel_token.cancelled:
+            result.cancelled = True
+            result.errors.append('Cancelled')
+            return result
+        progress_callback(50, 'Plotting B.Cu')
+        progress_callback(100, 'Done')
+        result.success = True
+        result.assembly_file = kwargs['output_path']
+        return result
+
+
+class TestPlotJob(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubPlot()
+        patcher = mock.patch.object(plot, 'plot_board', self.stub)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+        self.job = job.PlotJob('board', {'output_path': 'board__Assembly.pdf'},
+                               on_progress=lambda *args: self.calls.append(('progress',) + args),
+                               on_message=lambda *args: self.calls.append(('message',) + args[:2]),
+                               on_done=lambda result: self.calls.append(('done', result)))
+
+    def test_events_in_order(self):
+        self.stub.release.set()
+        self.job.start()
+        events = list(self.job.iter_events())
+        self.assertTrue(self.job.wait(5))
+        self.assertEqual([job.ProgressEvent(10, 'Plotting F.Cu'), job.ProgressEvent(50, 'Plotting B.Cu'),
+                          job.ProgressEvent(100, 'Done')], events[:3])
+        self.assertEqual(4, len(events))
+        self.assertEqual('All done!', events[3].caption)
+        self.assertEqual([('progress', 10, 'Plotting F.Cu'), ('progress', 50, 'Plotting B.Cu'),
+                          ('progress', 100, 'Done'), ('message', events[3].text, 'All done!'),
+                          ('done', self.job.result)], self.calls)
+        self.assertTrue(self.job.result.success)
+        self.assertFalse(self.job.running)
+
+    def test_cancel_mid_run(self):
+        self.job.start()
+        self.assertTrue(self.stub.started.wait(5))
+        self.job.cancel()
+        self.stub.release.set()
+        self.assertTrue(self.job.wait(5))
+        self.assertTrue(self.job.cancelled)
+        self.assertTrue(self.job.result.cancelled)
+        self.assertFalse(self.job.result.success)
+        self.assertEqual([job.ProgressEvent(10, 'Plotting F.Cu'), job.MessageEvent('Cancelled', 'Error', 0)],
+                         list(self.job.iter_events()))
+        self.assertEqual(('done', self.job.result), self.calls[-1])
+
+    def test_failing_plot(self):
+        with mock.patch.object(plot, 'plot_board', side_effect=ValueError('broken board')):
+            with self.assertLogs(job._logger, 'ERROR'):
+                self.job.start()
+                self.assertTrue(self.job.wait(5))
+        self.assertIn('ValueError: broken board', self.job.result.errors[0])
+        self.assertEqual('Error', self.calls[0][2])
+        self.assertEqual(('done', self.job.result), self.calls[-1])
+
+    def test_start_once(self):
+        with self.assertRaises(RuntimeError):
+            self.job.wait()
+        self.stub.release.set()
+        self.job.start()
+        with self.assertRaises(RuntimeError):
+            self.job.start()
+        self.assertTrue(self.job.wait(5))
+
+    def test_run_async(self):
+        self.stub.release.set()
+        threads = set()
+
+        def on_progress(progress, status):
+            threads.add(threading.current_thread())
+
+        self.job.on_progress = on_progress
+        result = asyncio.run(asyncio.wait_for(self.job.run_async(), 5))
+        self.assertIs(self.job.result, result)
+        self.assertTrue(result.success)
+        # The callbacks ran on the event loop, not on the worker thread
+        self.assertEqual({threading.main_thread()}, threads)
+        self.assertEqual(('done', result), self.calls[-1])
+
+    def test_run_async_cancelled(self):
+        async def plot_and_cancel():
+            task = asyncio.ensure_future(self.job.run_async())
+            while not self.stub.started.is_set():
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.sleep(0.01)
+            self.assertTrue(self.job.cancelled)
+            # The task ends with the job
+            self.assertFalse(task.done())
+            self.stub.release.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(task, 5)
+
+        asyncio.run(plot_and_cancel())
+        # on_done is the last thing the worker thread does
+        self.assertTrue(self.job.wait(5))
+        self.assertTrue(self.job.result.cancelled)
+        self.assertEqual(('done', self.job.result), self.calls[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
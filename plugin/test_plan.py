@@ -0,0 +1,107 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import plan, plot
+from board2pdf.plot import Template
+import unittest
+
+LAYER_NAMES = {"F.Cu": 0, "B.Cu": 2, "F.Paste": 35, "F.SilkS": 37, "F.Mask": 39, "Edge.Cuts": 44, "F.Fab": 49}
+
+
+def template(name, enabled_layers, frame="F.Fab", **settings):
+    config = {"enabled_layers": enabled_layers, "frame": frame, "popups": "Front Layer", "layers": {},
+              "layers_transparency": {}}
+    config.update(settings)
+    return Template(name, config, LAYER_NAMES)
+
+
+class TestCompilePlan(unittest.TestCase):
+    def setUp(self):
+        """The first enabled layer is painted on top."""
+        self.top = template("Top", "F.Fab,F.SilkS,F.Paste,F.Cu", layers={"F.Cu": "#B3FFB3", "F.Paste": "#FF8A8A"})
+        self.paste = template("Paste", "F.Fab,F.Paste,F.Cu", layers={"F.Cu": "#B3FFB3", "F.Paste": "#808080"},
+                              layers_transparency={"F.Paste": "50"})
+
+    def test_merge_inputs_bottom_layer_first(self):
+        board_plan = plan.compile_plan([self.top])
+        merge = board_plan.templates[0].merge
+        self.assertEqual(["F.Cu", "F.Paste", "F.SilkS", "F.Fab"], [node.layer for node in merge.inputs])
+        self.assertEqual(3, merge.frame)
+
+    def test_nodes_after_their_inputs(self):
+        board_plan = plan.compile_plan([self.top, self.paste], create_svg=True, minify_precision=0.005,
+                                       cull_hidden=True)
+        nodes = board_plan.nodes()
+        self.assertEqual(len(nodes), len(set(nodes)))
+        position = {node: i for i, node in enumerate(nodes)}
+        for node in nodes:
+            for child in plan._children(node):
+                self.assertLess(position[child], position[node], plan.stage(node))
+        self.assertIs(board_plan.concat, nodes[-len(board_plan.templates) - 1])
+
+    def test_cull_occluders_are_the_opaque_layers_above(self):
+        board_plan = plan.compile_plan([self.paste], cull_hidden=True)
+        cu, paste, fab = board_plan.templates[0].layers
+        # F.Paste is transparent and F.Fab is the frame, they are neither culled nor hide anything
+        self.assertIsInstance(cu, plan.ColorizeNode)
+        self.assertIsInstance(paste, plan.ColorizeNode)
+        self.assertIsInstance(fab, plan.PlotNode)
+
+        board_plan = plan.compile_plan([self.top], cull_hidden=True)
+        cu, paste, silk, fab = board_plan.templates[0].layers
+        self.assertIsInstance(cu, plan.CullNode)
+        self.assertEqual(("F.Paste", "F.SilkS"), tuple(node.layer for node in cu.occluders))
+        self.assertEqual((paste.source, silk), cu.occluders)
+        self.assertEqual(("F.SilkS",), tuple(node.layer for node in paste.occluders))
+        self.assertNotIsInstance(silk, plan.CullNode)
+        self.assertIsInstance(fab, plan.PlotNode)
+
+    def test_shared_node_keys(self):
+        board_plan = plan.compile_plan([self.top, self.paste])
+        top, paste = board_plan.templates
+        # The same layer plotted for two templates is one node, colored differently it is not
+        self.assertEqual(top.plots[0], paste.plots[0])
+        self.assertEqual(plan.node_key(top.layers[0]), plan.node_key(paste.layers[0]))
+        self.assertNotEqual(plan.node_key(top.layers[1]), plan.node_key(paste.layers[1]))
+        self.assertEqual(top.plots[1], paste.plots[1])
+        # The frame layer carries the page number in its title block
+        self.assertNotEqual(plan.node_key(top.plots[-1]), plan.node_key(paste.plots[-1]))
+        self.assertLess(len(board_plan.nodes()), board_plan.node_count())
+
+    def test_node_keys_are_stable(self):
+        first = plan.compile_plan([self.top], minify_precision=0.005)
+        second = plan.compile_plan([template("Top", "F.Fab,F.SilkS,F.Paste,F.Cu",
+                                             layers={"F.Cu": "#B3FFB3", "F.Paste": "#FF8A8A"})],
+                                   minify_precision=0.005)
+        self.assertEqual([plan.node_key(node) for node in first.nodes()],
+                         [plan.node_key(node) for node in second.nodes()])
+        changed = plan.compile_plan([self.top], minify_precision=0.01)
+        self.assertNotEqual(plan.node_key(first.concat), plan.node_key(changed.concat))
+        self.assertEqual(first.templates[0].plots, changed.templates[0].plots)
+
+    def test_colorize_engine_in_the_key(self):
+        pymupdf = plan.compile_plan([self.top], colorize_lib="pymupdf").templates[0]
+        pypdf = plan.compile_plan([self.top], colorize_lib="pypdf").templates[0]
+        self.assertEqual(("pymupdf", "pypdf"), (pymupdf.layers[0].engine, pypdf.layers[0].engine))
+        self.assertNotEqual(plan.node_key(pymupdf.layers[0]), plan.node_key(pypdf.layers[0]))
+        self.assertEqual(pymupdf.plots, pypdf.plots)
+
+    @unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+    def test_colorize_engine_for_transparency(self):
+        # Without a library the first engine doing the job, only PyMuPDF does transparent layers
+        cu, paste, fab = plan.compile_plan([self.paste], colorize_lib="").templates[0].layers
+        self.assertEqual(("pymupdf", 50), (paste.engine, paste.transparency))
+
+    def test_rasterize_settings_per_layer(self):
+        top = template("Top", "F.Fab,F.SilkS,F.Paste,F.Cu", layers_rasterize_over={"F.Paste": "0"},
+                       layers_rasterize_paths={"F.Cu": "500"})
+        cu, paste, silk, fab = plan.compile_plan([top], rasterize_over=1000, rasterize_paths=0).templates[0].layers
+        self.assertEqual((1000, 500), (cu.max_bytes, cu.max_paths))
+        self.assertIsInstance(paste, plan.PlotNode)
+        self.assertEqual((1000, 0), (silk.max_bytes, silk.max_paths))
+        # The frame layer is never rasterized
+        self.assertIsInstance(fab, plan.PlotNode)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,654 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import cli, persistence, plot
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import types
+import unittest
+import zlib
+from unittest import mock
+
+
+def write_page(path, text):
+    with plot.pymupdf.open() as doc:
+        page = doc.new_page(width=200, height=100)
+        page.insert_text((20, 50), text)
+        doc.save(path)
+
+
+def page_texts(path):
+    with plot.pymupdf.open(path) as doc:
+        return [page.get_text().strip() for page in doc]
+
+
+def write_image_page(path, samples, width, height, rect, flate=False):
+    """A page with an RGB image of `samples` drawn at `rect`, with `flate` stored as they are compressed by zlib."""
+    pixmap = plot.pymupdf.Pixmap(plot.pymupdf.csRGB, width, height, samples, 0)
+    with plot.pymupdf.open() as doc:
+        page = doc.new_page(width=200, height=100)
+        xref = page.insert_image(rect, pixmap=pixmap)
+        if flate:
+            plot._set_image(doc, xref, zlib.compress(samples, 9), 'FlateDecode', 'DeviceRGB', width, height)
+        doc.save(path)
+
+
+def page_images(path):
+    """(width, height, raw stream) of the images of every page."""
+    with plot.pymupdf.open(path) as doc:
+        return [[(image[2], image[3], doc.xref_stream_raw(image[0])) for image in page.get_images()] for page in doc]
+
+
+LAYERS = ['F.Cu', 'B.Cu', 'Edge.Cuts']
+
+
+class FakeBoard:
+    """The parts of a pcbnew.BOARD used by plot_board."""
+
+    def __init__(self, path):
+        self.path = path
+        self.title_block = mock.Mock(**{'GetComment.return_value': 'Rev A'})
+
+    def GetFileName(self):
+        return self.path
+
+    def GetStandardLayerName(self, layer_id):
+        return LAYERS[layer_id]
+
+    def GetTitleBlock(self):
+        return self.title_block
+
+    def SetTitleBlock(self, title_block):
+        self.title_block = title_block
+
+
+class FakePlotController:
+    """Plots a square per layer, or a broken pdf for a board named broken. Every plotted layer name is added to
+    `plotted`."""
+
+    plotted = []
+
+    def __init__(self, board):
+        self.board = board
+        self.options = mock.Mock()
+        self.layer = None
+        self.path = None
+
+    def GetPlotOptions(self):
+        return self.options
+
+    def SetLayer(self, layer_id):
+        self.layer = layer_id
+
+    def OpenPlotfile(self, suffix, plot_format, *description):
+        output_dir = self.options.SetOutputDirectory.call_args[0][0]
+        self.path = os.path.join(output_dir, f'board-{suffix}.pdf')
+
+    def PlotLayer(self):
+        self.plotted.append(LAYERS[self.layer])
+        if 'broken' in self.board.GetFileName():
+            with open(self.path, 'wb') as f:
+                f.write(b'%PDF-1.7 broken')
+            return
+        with plot.pymupdf.open() as doc:
+            page = doc.new_page(width=200, height=100)
+            x = 10 + 30 * self.layer
+            page.draw_rect((x, 10, x + 20, 30), color=(0, 0, 0), fill=(0, 0, 0))
+            doc.save(self.path)
+
+    def GetPlotFileName(self):
+        return self.path
+
+    def ClosePlot(self):
+        pass
+
+
+def fake_pcbnew():
+    pcbnew = types.ModuleType('pcbnew')
+    pcbnew.PCBNEW_LAYER_ID_START = 0
+    pcbnew.PCB_LAYER_ID_COUNT = len(LAYERS)
+    pcbnew.PLOT_FORMAT_PDF = 1
+    pcbnew.DRILL_MARKS_FULL_DRILL_SHAPE = 2
+    pcbnew.DRILL_MARKS_NO_DRILL_SHAPE = 0
+    pcbnew.Version = lambda: '8.0.0'
+    pcbnew.IsCopperLayer = lambda layer_id: LAYERS[layer_id].endswith('.Cu')
+    pcbnew.PLOT_CONTROLLER = FakePlotController
+    pcbnew.LoadBoard = FakeBoard
+    return pcbnew
+
+
+def plot_config(output_path, color='#C87533'):
+    """Config vars of a template with F.Cu in `color` over the board edges."""
+    return dict(output_path=output_path, enabled_templates=['Top'], del_temp_files=True, create_svg=False,
+                del_single_page_files=True, templates={'Top': {'enabled_layers': 'F.Cu,Edge.Cuts', 'frame': 'Edge.Cuts',
+                                                               'layers': {'F.Cu': color}}})
+
+
+@unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+class TestUpdatePdfPages(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.templates = ['Top', 'Bottom', 'Fab']
+        self.files = [f'{template}.pdf' for template in self.templates]
+        for template, filename in zip(self.templates, self.files):
+            write_page(os.path.join(self.folder, filename), template)
+        self.assembly = os.path.join(self.folder, 'board__Assembly.pdf')
+        self.assertTrue(plot.create_pdf_from_pages(self.folder, self.files, self.folder, 'board__Assembly.pdf', False))
+        self.assertTrue(plot.write_page_manifest(self.folder, self.files, self.assembly, self.templates, False))
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_page_manifest_path(self):
+        self.assertEqual(os.path.join('plots', '.board__Assembly.pdf.pages.json'),
+                         plot.page_manifest_path(os.path.join('plots', 'board__Assembly.pdf')))
+        self.assertTrue(os.path.exists(plot.page_manifest_path(self.assembly)))
+
+    def test_unchanged_pages_leave_the_pdf_alone(self):
+        with open(self.assembly, 'rb') as f:
+            before = f.read()
+        # Saved again, the pages get a new file ID but their content is the same
+        write_page(os.path.join(self.folder, 'Top.pdf'), 'Top')
+        self.assertIs(True, plot.update_pdf_pages(self.folder, self.files, self.assembly, self.templates, False))
+        with open(self.assembly, 'rb') as f:
+            self.assertEqual(before, f.read())
+
+    def test_changed_page_is_replaced_incrementally(self):
+        size = os.path.getsize(self.assembly)
+        write_page(os.path.join(self.folder, 'Bottom.pdf'), 'Bottom v2')
+        self.assertIs(True, plot.update_pdf_pages(self.folder, self.files, self.assembly, self.templates, False))
+        self.assertEqual(['Top', 'Bottom v2', 'Fab'], page_texts(self.assembly))
+        with open(self.assembly, 'rb') as f:
+            data = f.read()
+        # The old file is kept in front of the update
+        self.assertGreater(len(data), size)
+        self.assertEqual(2, data.count(b'%%EOF'))
+
+        # The manifest matches the patched pdf, so it can be patched again
+        write_page(os.path.join(self.folder, 'Fab.pdf'), 'Fab v2')
+        self.assertIs(True, plot.update_pdf_pages(self.folder, self.files, self.assembly, self.templates, False))
+        self.assertEqual(['Top', 'Bottom v2', 'Fab v2'], page_texts(self.assembly))
+
+    def test_whole_file_needed(self):
+        write_page(os.path.join(self.folder, 'Top.pdf'), 'Top v2')
+        # Other templates, other popup setting
+        self.assertIsNone(plot.update_pdf_pages(self.folder, self.files, self.assembly, ['Top', 'Fab', 'Bottom'],
+                                                False))
+        self.assertIsNone(plot.update_pdf_pages(self.folder, self.files, self.assembly, self.templates, True))
+        # All pages changed
+        write_page(os.path.join(self.folder, 'Bottom.pdf'), 'Bottom v2')
+        write_page(os.path.join(self.folder, 'Fab.pdf'), 'Fab v2')
+        self.assertIsNone(plot.update_pdf_pages(self.folder, self.files, self.assembly, self.templates, False))
+        # The pdf was changed by someone else
+        write_page(os.path.join(self.folder, 'Fab.pdf'), 'Fab')
+        with open(self.assembly, 'ab') as f:
+            f.write(b'\n')
+        self.assertIsNone(plot.update_pdf_pages(self.folder, self.files, self.assembly, self.templates, False))
+        # No manifest
+        os.remove(plot.page_manifest_path(self.assembly))
+        self.assertIsNone(plot.update_pdf_pages(self.folder, self.files, self.assembly, self.templates, False))
+
+
+class TestPdfDigest(unittest.TestCase):
+    def test_without_file_id_and_dates(self):
+        with tempfile.TemporaryDirectory() as folder:
+            digests = set()
+            for trailer in (rb'/ID[<C3BF7DC2><547E81DA>]', rb'/ID [(zq\021P\)k) <0465F1E7>]',
+                            rb'/ID[(a(b\)c)(\\)]/CreationDate(D:20240101)'):
+                path = os.path.join(folder, 'page.pdf')
+                with open(path, 'wb') as f:
+                    f.write(b'%PDF-1.7\ntrailer\n<</Size 7/Root 1 0 R' + trailer + b'>>\n%%EOF\n')
+                digests.add(plot.pdf_digest(path))
+            self.assertEqual(1, len(digests))
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.settings = {'engines': {'colorize': 'pymupdf'}}
+        self.input = os.path.join(self.folder, 'F_Cu.pdf')
+        self.output = os.path.join(self.folder, 'F_Cu-colored.pdf')
+        for path in (self.input, self.output):
+            with open(path, 'wb') as f:
+                f.write(os.path.basename(path).encode())
+        checkpoint = plot.Checkpoint.load(self.folder, 'board1', self.settings)
+        checkpoint.add('colorize', self.output, [self.input])
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_done_after_load(self):
+        checkpoint = plot.Checkpoint.load(self.folder, 'board1', dict(self.settings))
+        self.assertEqual(self.output, checkpoint.done('colorize'))
+        self.assertIsNone(checkpoint.done('merge'))
+
+    def test_board_changed(self):
+        checkpoint = plot.Checkpoint.load(self.folder, 'board2', self.settings)
+        self.assertIsNone(checkpoint.done('colorize'))
+
+    def test_settings_changed(self):
+        checkpoint = plot.Checkpoint.load(self.folder, 'board1', {'engines': {'colorize': 'pypdf'}})
+        self.assertIsNone(checkpoint.done('colorize'))
+
+    def test_files_changed(self):
+        with open(self.input, 'ab') as f:
+            f.write(b' changed')
+        self.assertIsNone(plot.Checkpoint.load(self.folder, 'board1', self.settings).done('colorize'))
+        os.remove(self.output)
+        self.assertIsNone(plot.Checkpoint.load(self.folder, 'board1', self.settings).done('colorize'))
+
+    def test_unreadable_checkpoint(self):
+        with open(os.path.join(self.folder, plot.Checkpoint.file_name), 'w') as f:
+            f.write('{')
+        with self.assertLogs(plot._logger, 'WARNING'):
+            checkpoint = plot.Checkpoint.load(self.folder, 'board1', self.settings)
+        self.assertIsNone(checkpoint.done('colorize'))
+
+
+@unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+class TestLinearize(unittest.TestCase):
+    engines = [(plot.linearize_pdf_pikepdf, plot.pikepdf_loaded), (plot.linearize_pdf_qpdf, plot.qpdf_path),
+               (plot.linearize_pdf_pymupdf, plot.pymupdf_linearizes)]
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        files = [f'page{i}.pdf' for i in range(20)]
+        for i, filename in enumerate(files):
+            write_page(os.path.join(self.folder, filename), f'Page {i}')
+        self.assertTrue(plot.create_pdf_from_pages(self.folder, files, self.folder, 'assembly.pdf', True))
+        self.assembly = os.path.join(self.folder, 'assembly.pdf')
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_first_page_at_the_start(self):
+        tested = 0
+        for function, available in self.engines:
+            if not available():
+                continue
+            with self.subTest(function.__name__):
+                output = os.path.join(self.folder, f'{function.__name__}.pdf')
+                self.assertTrue(function(self.assembly, output))
+                first_page = plot.linearized_first_page(output)
+                self.assertIsNotNone(first_page)
+                self.assertLess(first_page, os.path.getsize(output) / 2)
+                self.assertEqual([f'Page {i}' for i in range(20)], page_texts(output))
+                tested += 1
+        if not tested:
+            self.skipTest("needs pikepdf, qpdf or a PyMuPDF that linearizes")
+
+    def test_not_linearized(self):
+        self.assertIsNone(plot.linearized_first_page(self.assembly))
+        for function, available in self.engines:
+            if available():
+                output = os.path.join(self.folder, 'linearized.pdf')
+                self.assertTrue(function(self.assembly, output))
+                # An incremental update breaks the linearization
+                with open(output, 'ab') as f:
+                    f.write(b'\n% changed\n')
+                self.assertIsNone(plot.linearized_first_page(output))
+                break
+
+
+@unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+class TestMakeReproducible(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        for i in range(3):
+            write_page(os.path.join(self.folder, f'page{i}.pdf'), f'Page {i}')
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def assembly(self, name):
+        # With popups pypdf names the javascript by a random uuid, and the file ID and dates differ every time
+        files = [f'page{i}.pdf' for i in range(3)]
+        self.assertTrue(plot.create_pdf_from_pages(self.folder, files, self.folder, f'{name}.pdf', True))
+        return os.path.join(self.folder, f'{name}.pdf')
+
+    def reproducible(self, path):
+        output = f'{os.path.splitext(path)[0]}-reproducible.pdf'
+        self.assertTrue(plot.make_reproducible(path, output))
+        with open(output, 'rb') as f:
+            return f.read()
+
+    def test_same_input_same_bytes(self):
+        first, second = self.assembly('first'), self.assembly('second')
+        with open(first, 'rb') as f, open(second, 'rb') as g:
+            self.assertNotEqual(f.read(), g.read())
+        data = self.reproducible(first)
+        self.assertEqual(data, self.reproducible(second))
+        self.assertIn(b'B2PScript0000', data)
+        self.assertEqual(['Page 0', 'Page 1', 'Page 2'], page_texts(first.replace('.pdf', '-reproducible.pdf')))
+
+    def test_in_place_and_source_date(self):
+        path = self.assembly('board')
+        data = self.reproducible(path)
+        self.assertTrue(plot.make_reproducible(path, path))
+        with open(path, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+        environ = dict(os.environ)
+        try:
+            os.environ['SOURCE_DATE_EPOCH'] = '1700000000'
+            self.assertEqual('D:20231114221320Z', plot.source_date())
+            dated = self.reproducible(path)
+            self.assertEqual(dated, self.reproducible(path))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        self.assertIn(b'D:20231114221320Z', dated)
+
+
+@unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+class TestOptimizeImages(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.path = os.path.join(self.folder, 'assembly.pdf')
+        rng = random.Random(0)
+        self.noise = bytes(rng.getrandbits(8) for _ in range(64 * 64 * 3))
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_identical_images_stored_once(self):
+        pages = []
+        for i in range(3):
+            pages.append(f'page{i}.pdf')
+            write_image_page(os.path.join(self.folder, pages[-1]), bytes(range(256)) * 48, 64, 64, (10, 10, 40, 40))
+        # Every page pdf brings its own copy of the image
+        self.assertTrue(plot.create_pdf_from_pages(self.folder, pages, self.folder, 'assembly.pdf', False))
+        with plot.pymupdf.open(self.path) as doc:
+            self.assertEqual(3, len({page.get_images()[0][0] for page in doc}))
+
+        savings = plot.optimize_images(self.path, 300)
+        self.assertEqual((3, 2, 0), (savings.images, savings.duplicates, savings.downsampled))
+        self.assertLess(savings.bytes_after, savings.bytes_before)
+        with plot.pymupdf.open(self.path) as doc:
+            self.assertEqual(1, len({page.get_images()[0][0] for page in doc}))
+
+    def test_downsampled_to_the_dpi(self):
+        write_image_page(self.path, bytes(range(256)) * 48, 64, 64, (0, 0, 72, 72))
+        # Drawn one inch wide, the 64 pixels are kept down to 64 / DOWNSAMPLE_OVER dpi
+        savings = plot.optimize_images(self.path, 32)
+        self.assertEqual(1, savings.downsampled)
+        self.assertEqual([[(32, 32)]], [[image[:2] for image in page] for page in page_images(self.path)])
+
+        write_image_page(self.path, bytes(range(256)) * 48, 64, 64, (0, 0, 72, 72))
+        savings = plot.optimize_images(self.path, 48)
+        self.assertEqual(0, savings.downsampled)
+        self.assertEqual([[(64, 64)]], [[image[:2] for image in page] for page in page_images(self.path)])
+
+    def test_image_that_does_not_shrink_is_left_alone(self):
+        write_image_page(self.path, self.noise, 64, 64, (0, 0, 100, 100), flate=True)
+        before = page_images(self.path)
+        savings = plot.optimize_images(self.path, 300)
+        self.assertEqual((1, 0, 0), (savings.images, savings.duplicates, savings.downsampled))
+        self.assertEqual(before, page_images(self.path))
+
+
+@unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+class TestExportTiles(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.pdf = os.path.join(self.folder, 'Top.pdf')
+        self.dzi = os.path.join(self.folder, 'Top.dzi')
+        self.files = os.path.join(self.folder, 'Top_files')
+        write_page(self.pdf, 'Top')
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def tile_sizes(self):
+        sizes = {}
+        for level in os.listdir(self.files):
+            if level.isdigit():
+                for name in os.listdir(os.path.join(self.files, level)):
+                    pixmap = plot.pymupdf.Pixmap(os.path.join(self.files, level, name))
+                    sizes[f'{level}/{name}'] = (pixmap.width, pixmap.height)
+        return sizes
+
+    def test_pyramid(self):
+        # 200 x 100 pt at 144 dpi is 400 x 200 pixels, levels down to 1 x 1 pixel
+        self.assertEqual((11, 11), plot.export_tiles(self.pdf, self.dzi, 'png', 256, 144))
+        expected = {'9/0_0.png': (256, 200), '9/1_0.png': (144, 200), '8/0_0.png': (200, 100),
+                    '7/0_0.png': (100, 50), '1/0_0.png': (2, 1), '0/0_0.png': (1, 1)}
+        sizes = self.tile_sizes()
+        self.assertEqual(11, len(sizes))
+        self.assertEqual(expected, {name: sizes[name] for name in expected})
+        with open(self.dzi) as f:
+            self.assertEqual('<?xml version="1.0" encoding="UTF-8"?>\n'
+                             '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="png" Overlap="0" '
+                             'TileSize="256">\n  <Size Width="400" Height="200"/>\n</Image>\n', f.read())
+
+    def test_unchanged_tiles_are_kept(self):
+        plot.export_tiles(self.pdf, self.dzi, 'jpeg', 256, 144)
+        self.assertIn('9/1_0.jpg', self.tile_sizes())
+        self.assertEqual((11, 0), plot.export_tiles(self.pdf, self.dzi, 'jpeg', 256, 144))
+        # The text is on the left tile of the finest level, and on one tile of every coarser level
+        write_page(self.pdf, 'Bottom')
+        self.assertEqual((11, 10), plot.export_tiles(self.pdf, self.dzi, 'jpeg', 256, 144))
+        # Other settings render everything again
+        self.assertEqual((11, 11), plot.export_tiles(self.pdf, self.dzi, 'jpeg', 256, 144, salt='v2'))
+
+
+@unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+class TestPanel(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.board = types.SimpleNamespace(GetFileName=lambda: os.path.join(self.folder, 'board.kicad_pcb'))
+        environ = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(self.folder, 'cache')})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def write_layout(self, layout):
+        with open(os.path.join(self.folder, 'panel.json'), 'w') as f:
+            json.dump(layout, f)
+        return plot.panel_layout_path(self.board, 'panel.json')
+
+    def test_load_panel_layout(self):
+        path = self.write_layout({'frame_board': 'rails.kicad_pcb', 'center': [10, 5],
+                                  'instances': [{'x': 0, 'y': 0}, {'x': 20, 'rotation': 90}]})
+        self.assertEqual(os.path.join(self.folder, 'panel.json'), path)
+        layout = plot.load_panel_layout(path, self.board)
+        self.assertEqual(os.path.join(self.folder, 'rails.kicad_pcb'), layout.frame_board)
+        self.assertEqual(((0.0, 0.0, 0.0), (20.0, 0.0, 90.0)), layout.instances)
+        self.assertEqual((10.0, 5.0), layout.center)
+
+        for layout in ({'frame_board': 'rails.kicad_pcb', 'instances': []}, {'instances': [{'x': 0}]},
+                       {'frame_board': 'rails.kicad_pcb', 'center': [10], 'instances': [{'x': 0}]}):
+            with self.subTest(layout=layout), self.assertRaises(ValueError):
+                plot.load_panel_layout(self.write_layout(layout), self.board)
+
+    def test_two_copies_on_one_page(self):
+        for filename, width in (('layer.pdf', 200), ('frame.pdf', 400)):
+            with plot.pymupdf.open() as doc:
+                page = doc.new_page(width=width, height=200)
+                if filename == 'layer.pdf':
+                    page.draw_rect((10, 10, 30, 30), color=(0, 0, 0), fill=(0, 0, 0))
+                doc.save(os.path.join(self.folder, filename))
+        self.assertTrue(plot.panel_pdf(self.folder, 'layer.pdf', 'frame.pdf', 'panel.pdf', ((0, 0, 0), (20, 0, 0)),
+                                       (0, 0), False))
+
+        with plot.pymupdf.open(os.path.join(self.folder, 'panel.pdf')) as doc:
+            self.assertEqual(1, len(doc))
+            self.assertEqual(400, doc[0].rect.width)
+            # The layer is added once and drawn by both copies, the second one 20 mm to the right
+            self.assertEqual(2, doc[0].read_contents().count(b'/B2PPanel Do'))
+            rects = sorted((drawing['rect'] for drawing in doc[0].get_drawings()), key=lambda rect: rect.x0)
+        self.assertEqual(2, len(rects))
+        self.assertEqual((10, 10, 30, 30), tuple(round(v, 2) for v in rects[0]))
+        offset = 20 * plot.MM_TO_PT
+        self.assertEqual((round(10 + offset, 2), 10, round(30 + offset, 2), 30), tuple(round(v, 2) for v in rects[1]))
+
+    def test_malformed_layout_fails_the_plot(self):
+        self.write_layout({'instances': [{'x': 0}]})
+        result = plot.plot_board(self.board, 'plot', {}, [], True, False, False, panel_layout='panel.json')
+        self.assertFalse(result.success)
+        self.assertEqual('Failed to read the panel layout.', result.status)
+        self.assertEqual(1, len(result.errors))
+        self.assertIn("invalid panel layout", result.errors[0])
+        self.assertIn("KeyError('frame_board')", result.errors[0])
+
+        os.remove(os.path.join(self.folder, 'panel.json'))
+        result = plot.plot_board(self.board, 'plot', {}, [], True, False, False, panel_layout='panel.json')
+        self.assertFalse(result.success)
+        self.assertIn('FileNotFoundError', result.errors[0])
+
+
+@unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+class TestPlotVariants(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.board = FakeBoard(os.path.join(self.folder, 'board.kicad_pcb'))
+        with open(self.board.path, 'w'):
+            pass
+        self.pcbnew = fake_pcbnew()
+        patchers = [mock.patch.object(plot, 'pcbnew', self.pcbnew), mock.patch.object(FakePlotController, 'plotted', []),
+                    mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(self.folder, 'cache')})]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_layers_plotted_once(self):
+        results = plot.plot_variants(self.board, [plot_config('a'), plot_config('b', '#00FF00')])
+        self.assertEqual([True, True], [result.success for result in results])
+        self.assertEqual([[os.path.join(self.folder, 'a', 'board__Assembly.pdf')],
+                          [os.path.join(self.folder, 'b', 'board__Assembly.pdf')]],
+                         [result.outputs for result in results])
+        # Same layer settings, so the second variant only colors F.Cu in its own color
+        self.assertEqual(['Edge.Cuts', 'F.Cu'], FakePlotController.plotted)
+        self.assertNotIn('plot', results[1].timings)
+        self.assertIn('colorize', results[1].timings)
+
+        # Plotted on their own every run plots its layers
+        for output_path in ('a', 'b'):
+            self.assertTrue(plot.plot_board(self.board, **plot_config(output_path)).success)
+        self.assertEqual(['Edge.Cuts', 'F.Cu'] * 3, FakePlotController.plotted)
+
+    def test_cli_variants(self):
+        configfiles = []
+        for name, color in (('top', '#C87533'), ('green', '#00FF00')):
+            config = persistence.Persistence(os.path.join(self.folder, f'{name}.ini'))
+            for varname, value in plot_config('plot', color).items():
+                setattr(config, varname, value)
+            config.save(config._configfile)
+            configfiles.append(config._configfile)
+
+        # Not mock.patch.dict, that would also drop the pdf libraries first imported by the plot from sys.modules
+        previous = sys.modules.get('pcbnew')
+        sys.modules['pcbnew'] = self.pcbnew
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertTrue(cli.cli_variants(self.board.path, configfiles))
+        finally:
+            if previous is None:
+                del sys.modules['pcbnew']
+            else:
+                sys.modules['pcbnew'] = previous
+        self.assertEqual(['Edge.Cuts', 'F.Cu'], FakePlotController.plotted)
+        # The second variant writes to the same output path, its assembly pdf gets the name of its ini file
+        self.assertEqual(['board__Assembly.pdf', 'board__Assembly_green.pdf'],
+                         sorted(os.listdir(os.path.join(self.folder, 'plot'))))
+
+
+@unittest.skipUnless(plot.pymupdf_loaded(), "needs PyMuPDF")
+class TestPlotBoard(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self._temp_dir.name
+        self.board, self.broken = (FakeBoard(os.path.join(self.folder, f'{name}.kicad_pcb')) for name in ('a', 'broken'))
+        for board in (self.board, self.broken):
+            with open(board.path, 'w'):
+                pass
+        patchers = [mock.patch.object(plot, 'pcbnew', fake_pcbnew()), mock.patch.object(FakePlotController, 'plotted', []),
+                    mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(self.folder, 'cache')})]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_failing_stage(self):
+        with mock.patch.object(FakePlotController, 'PlotLayer', side_effect=RuntimeError('no plotter')):
+            result = plot.plot_board(self.board, **plot_config('plot'))
+        self.assertFalse(result.success)
+        self.assertEqual('Failed to set plot_options or plot_controller', result.status)
+        self.assertEqual(1, len(result.errors))
+        self.assertIn('RuntimeError: no plotter', result.errors[0])
+
+        # A pdf function reports its failure through the message sink
+        result = plot.plot_board(self.broken, **plot_config('plot'))
+        self.assertFalse(result.success)
+        self.assertEqual('Failed when coloring F.Cu for template Top', result.status)
+        self.assertEqual(1, len(result.errors))
+        self.assertTrue(result.errors[0].startswith('colorize_pdf_pymupdf failed'))
+
+    def test_calls_do_not_share_state(self):
+        # A failing run with a memory budget, then one without
+        failed = plot.plot_board(self.broken, max_memory=1 << 30, **plot_config('plot'))
+        self.assertFalse(failed.success)
+        self.assertEqual(1 << 30, failed.max_memory)
+        result = plot.plot_board(self.board, **plot_config('plot'))
+        self.assertTrue(result.success)
+        self.assertEqual([], result.errors)
+        self.assertIsNone(result.max_memory)
+        self.assertIsNone(plot._message_sink.get())
+        self.assertIsNone(plot._memory_budget.get())
+
+    def test_concurrent_calls(self):
+        budgets = {}
+        barrier = threading.Barrier(2, timeout=5)
+        plot_layer = FakePlotController.PlotLayer
+
+        def PlotLayer(controller):
+            name = os.path.basename(controller.board.GetFileName())
+            if name not in budgets:
+                budgets[name] = plot._memory_budget.get()
+                # Both runs are plotting before either goes on
+                barrier.wait()
+            plot_layer(controller)
+
+        results = {}
+
+        def run(board, **config_vars):
+            results[board] = plot.plot_board(board, **plot_config('plot'), **config_vars)
+
+        with mock.patch.object(FakePlotController, 'PlotLayer', PlotLayer):
+            threads = [threading.Thread(target=run, args=(self.board,), kwargs={'max_memory': 1 << 30}),
+                       threading.Thread(target=run, args=(self.broken,))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+
+        self.assertEqual({'a.kicad_pcb': 1 << 30, 'broken.kicad_pcb': None}, budgets)
+        self.assertTrue(results[self.board].success)
+        self.assertEqual([], results[self.board].errors)
+        self.assertFalse(results[self.broken].success)
+        self.assertEqual(1, len(results[self.broken].errors))
+        self.assertTrue(results[self.broken].errors[0].startswith('colorize_pdf_pymupdf failed'))
+
+
+if __name__ == "__main__":
+    unittest.main()
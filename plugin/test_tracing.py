@@ -0,0 +1,180 @@
+import sys
+sys.path.append("src")
+
+from board2pdf import tracing
+import json
+import os
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from unittest import mock
+
+
+class TestSpan(unittest.TestCase):
+    def test_measure_and_dict(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = []
+            for name, size in (('in1.pdf', 100), ('in2.pdf', 50), ('out.pdf', 30)):
+                paths.append(os.path.join(folder, name))
+                with open(paths[-1], 'wb') as f:
+                    f.write(b'x' * size)
+            span = tracing.Span('colorize', 'Top', 'F.Cu')
+            span.add_input(paths[0])
+            span.add_input(paths[1])
+            span.add_output(paths[2])
+            span.add_output(os.path.join(folder, 'missing.pdf'))
+            span.measure()
+        self.assertEqual((150, 30), (span.bytes_in, span.bytes_out))
+        self.assertNotIn('info', span.as_dict())
+        span.info['paths'] = 12
+        self.assertEqual({'paths': 12}, span.as_dict()['info'])
+        self.assertEqual(('colorize', 'Top', 'F.Cu'), tuple(span.as_dict()[k] for k in ('name', 'template', 'layer')))
+
+    def test_null_span_without_tracer(self):
+        with tracing.stage('plot', 'Top', 'F.Cu') as span:
+            span.add_input('missing.pdf')
+        self.assertIsInstance(span, tracing._NullSpan)
+        self.assertEqual([], span.inputs)
+
+
+class TestTracer(unittest.TestCase):
+    def test_stages(self):
+        tracer = tracing.Tracer()
+        with tracer.activate():
+            with tracing.stage('merge', 'Top'):
+                with tracing.stage('colorize', 'Top', 'F.Cu') as span:
+                    span.info['paths'] = 3
+                with tracing.stage('colorize', 'Top', 'B.Cu'):
+                    pass
+            with tracing.stage('concat'):
+                pass
+        # Not recorded after the tracer is deactivated
+        with tracing.stage('cleanup'):
+            pass
+
+        self.assertEqual(['colorize', 'colorize', 'merge', 'concat'], [span.name for span in tracer.spans])
+        colorize, _, merge, concat = tracer.spans
+        self.assertLessEqual(merge.start, colorize.start)
+        self.assertLessEqual(colorize.start + colorize.wall, merge.start + merge.wall)
+        self.assertLessEqual(merge.start + merge.wall, concat.start)
+        self.assertEqual({'colorize', 'merge', 'concat'}, set(tracer.totals()))
+        self.assertEqual(2, tracer.totals()['colorize']['count'])
+        self.assertEqual({'Top'}, set(tracer.totals('template')))
+        self.assertEqual({'F.Cu', 'B.Cu'}, set(tracer.totals('layer')))
+
+        report = tracer.report(board='demo.kicad_pcb')
+        self.assertEqual('demo.kicad_pcb', report['board'])
+        self.assertEqual(4, len(report['stages']))
+        self.assertEqual({'paths': 3}, report['stages'][0]['info'])
+
+    def test_stage_of_a_failing_step(self):
+        tracer = tracing.Tracer()
+        with self.assertRaises(ValueError):
+            with tracer.stage('plot', 'Top', 'F.Cu'):
+                raise ValueError('broken layer')
+        self.assertEqual(['plot'], [span.name for span in tracer.spans])
+        self.assertEqual([], tracer._open)
+
+    def test_chrome_trace(self):
+        tracer = tracing.Tracer()
+        with tracer.stage('plot', 'Top', 'F.Cu'):
+            pass
+        with tracer.stage('concat'):
+            pass
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'trace.json')
+            tracer.write_chrome_trace(path)
+            with open(path) as f:
+                trace = json.load(f)
+        self.assertEqual('ms', trace['displayTimeUnit'])
+        plot, concat = trace['traceEvents']
+        self.assertEqual(('plot Top F.Cu', 'plot', 'X'), (plot['name'], plot['cat'], plot['ph']))
+        self.assertEqual('concat', concat['name'])
+        self.assertEqual((os.getpid(), threading.get_ident()), (plot['pid'], plot['tid']))
+        self.assertIsInstance(plot['ts'], int)
+        self.assertGreaterEqual(concat['ts'], plot['ts'] + plot['dur'])
+        self.assertEqual('Top', plot['args']['template'])
+        self.assertNotIn('wall', plot['args'])
+
+    def test_peak_not_reset_by_default(self):
+        with mock.patch.object(tracing, 'reset_peak_rss', return_value=True) as reset, \
+                mock.patch.object(tracing, 'peak_rss', return_value=900), \
+                mock.patch.object(tracing, 'current_rss', side_effect=[100, 300, 200, 200, 150, 200]):
+            tracer = tracing.Tracer()
+            with tracer.stage('plot'):
+                pass
+            with tracer.stage('crop'):
+                pass
+        reset.assert_not_called()
+        # Without the reset the spans get the resident set sizes at their start and end
+        self.assertEqual([300, 200], [span.peak_rss for span in tracer.spans])
+        self.assertEqual(300, tracer.peak_rss())
+
+    def test_peak_reset_per_stage(self):
+        with mock.patch.object(tracing, 'reset_peak_rss', return_value=True) as reset, \
+                mock.patch.object(tracing, 'peak_rss', side_effect=[50, 50, 400, 400, 150, 120]), \
+                mock.patch.object(tracing, 'current_rss', return_value=10):
+            tracer = tracing.Tracer(reset_peak=True)
+            with tracer.stage('plot'):
+                with tracer.stage('colorize'):
+                    pass
+        self.assertEqual(3, reset.call_count)
+        # The peak of the inner stage counts for the outer stage too
+        self.assertEqual({'colorize': 400, 'plot': 400}, {span.name: span.peak_rss for span in tracer.spans})
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+def allocate_and_fib():
+    blocks = [bytearray(1024) for _ in range(2000)]
+    fib(16)
+    return len(blocks)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self._temp_dir.name, 'profile')
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def test_stage_profiles(self):
+        profiler = tracing.Profiler(self.folder)
+        tracer = tracing.Tracer(profiler)
+        with tracer.activate():
+            with tracing.stage('colorize', 'Top', 'F.Cu'):
+                # Nested stages are part of the outer profile
+                with tracing.stage('simplify', 'Top', 'F.Cu'):
+                    allocate_and_fib()
+            with tracing.stage('concat'):
+                pass
+        profiler.close()
+        self.assertFalse(tracemalloc.is_tracing())
+
+        self.assertEqual(['001-colorize-Top-F.Cu.collapsed', '001-colorize-Top-F.Cu.pstats', '002-concat.collapsed',
+                          '002-concat.pstats', 'allocations.txt'], sorted(os.listdir(self.folder)))
+        with open(os.path.join(self.folder, '001-colorize-Top-F.Cu.collapsed')) as f:
+            stacks = [line.rsplit(' ', 1) for line in f.read().splitlines()]
+        self.assertTrue(all(int(microseconds) >= 0 for _, microseconds in stacks))
+        fib_stack = next(stack for stack, _ in stacks if 'fib (test_tracing.py:' in stack)
+        # The caller comes before the callee, recursion is folded into the first call
+        self.assertLess(fib_stack.index('allocate_and_fib'), fib_stack.index('fib (test_tracing.py:'))
+        self.assertEqual(1, fib_stack.count('fib (test_tracing.py:'))
+
+        colorize = tracer.spans[1]
+        self.assertEqual('colorize', colorize.name)
+        self.assertGreater(colorize.info['traced_peak'], 2000 * 1024)
+        self.assertNotIn('traced_peak', tracer.spans[0].info)
+        with open(os.path.join(self.folder, 'allocations.txt')) as f:
+            allocations = f.read()
+        self.assertTrue(allocations.startswith('Top 25 allocation sites of 001-colorize-Top-F.Cu, traced peak'))
+        self.assertIn('test_tracing.py', allocations)
+
+
+if __name__ == "__main__":
+    unittest.main()
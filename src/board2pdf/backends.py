@@ -0,0 +1,188 @@
+from __future__ import annotations
+import importlib.metadata
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import tempfile
+import time
+from typing import Callable, NamedTuple
+
+try:
+    from . import costs
+except ImportError:
+    import costs
+
+_logger = logging.getLogger(__name__)
+
+OPERATIONS = ('colorize', 'merge', 'crop', 'concat', 'linearize')
+AUTO = 'auto'
+# Distributions whose version invalidates the calibration.
+_distributions = ('PyMuPDF', 'pypdf', 'pdfCropMargins', 'pikepdf')
+
+
+class Engine(NamedTuple):
+    """A pdf library doing one operation. The function is called like the plot.py function of the operation:
+
+    colorize: function(folder, input_file, output_file, color, transparency) -> bool
+    merge: function(input_folder, input_files, output_folder, output_file, frame_file, scale_or_crop, layer_scale,
+                    use_popups, template_name, crop_pdf) -> bool
+    crop: function(input_path, output_path, whitespace) -> bool
+    concat: function(input_folder, input_files, output_folder, output_file, use_popups) -> bool
+    linearize: function(input_path, output_path) -> bool
+    """
+    name: str
+    operation: str
+    function: Callable
+    transparency: bool = False  # colorize: layers can be transparent
+    popups: bool = False  # the footprint popup menus survive
+    scaling: bool = False  # merge: the crop and scale methods of the template are done
+    available: Callable[[], bool] = lambda: True
+    transparent_popups: bool = False  # colorize: the popup menus survive on transparent layers too
+
+    def supports(self, transparency: bool = False, popups: bool = False, scaling: bool = False) -> bool:
+        keeps_popups = self.popups and (self.transparent_popups or not transparency)
+        return ((self.transparency or not transparency) and (keeps_popups or not popups)
+                and (self.scaling or not scaling))
+
+
+_registry: dict[str, dict[str, Engine]] = {operation: {} for operation in OPERATIONS}
+_calibration: dict | None = None
+
+
+def register(engine: Engine):
+    """Add an engine, engines registered first are preferred when no engine is asked for."""
+    if engine.operation not in _registry:
+        raise ValueError(f"unknown operation {engine.operation!r}")
+    _registry[engine.operation][engine.name] = engine
+
+
+def engines(operation: str) -> list[Engine]:
+    return list(_registry[operation].values())
+
+
+def names(operation: str) -> list[str]:
+    return [AUTO] + list(_registry[operation])
+
+
+def select(operation: str, name: str = '', transparency: bool = False, popups: bool = False,
+           scaling: bool = False) -> Engine | None:
+    """Engine for `operation`, None if it isn't available.
+
+    An engine asked for by `name` is used even if it lacks a capability, like the --colorize and --merge options
+    always did. Without a name the first available engine doing the job is used, with 'auto' the fastest one
+    according to calibration(). If no engine can do the job, the first available one is used.
+    """
+    if name and name != AUTO:
+        engine = _registry[operation].get(name)
+        return engine if engine is not None and engine.available() else None
+
+    available = [engine for engine in engines(operation) if engine.available()]
+    capable = [engine for engine in available if engine.supports(transparency, popups, scaling)]
+    if not capable:
+        if available:
+            _logger.warning(f'no {operation} engine supports {transparency=} {popups=} {scaling=}, '
+                            f'using {available[0].name}')
+        return available[0] if available else None
+    if name == AUTO:
+        timings = calibration().get(operation, {})
+        return min(capable, key=lambda engine: timings.get(engine.name, math.inf))
+    return capable[0]
+
+
+def calibration_path() -> str:
+    return os.path.join(costs.cache_dir(), 'calibration.json')
+
+
+def _fingerprint() -> dict:
+    versions = {}
+    for distribution in _distributions:
+        try:
+            versions[distribution] = importlib.metadata.version(distribution)
+        except importlib.metadata.PackageNotFoundError:
+            versions[distribution] = None
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'versions': versions, 'engines': {operation: sorted(_registry[operation]) for operation in OPERATIONS}}
+
+
+def calibration(refresh: bool = False) -> dict[str, dict[str, float]]:
+    """Seconds every available engine needs for a small synthetic job, by operation and engine name.
+
+    The result is cached in the user cache directory and measured again when python, the machine, the pdf
+    libraries or the registered engines change.
+    """
+    global _calibration
+    fingerprint = _fingerprint()
+    if _calibration is not None and not refresh and _calibration['fingerprint'] == fingerprint:
+        return _calibration['timings']
+
+    path = calibration_path()
+    if not refresh:
+        try:
+            with open(path, 'r') as f:
+                cached = json.load(f)
+            if cached.get('fingerprint') == fingerprint:
+                _calibration = cached
+                return cached['timings']
+        except (OSError, ValueError):
+            pass
+
+    _calibration = {'fingerprint': fingerprint, 'timings': _calibrate()}
+    try:
+        # Written atomically, batch workers may read it at the same time
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_calibration, f, indent=2)
+        os.replace(temp_path, path)
+    except OSError:
+        _logger.warning(f'unable to save the calibration {path=}', exc_info=True)
+    return _calibration['timings']
+
+
+def _calibrate(repeat: int = 2) -> dict[str, dict[str, float]]:
+    try:
+        from . import bench
+    except ImportError:
+        import bench
+
+    folder = tempfile.mkdtemp(prefix='board2pdf-calibration-')
+    try:
+        for i in range(2):
+            with open(os.path.join(folder, f'layer{i}.pdf'), 'wb') as f:
+                f.write(bench.synthetic_layer_pdf(paths=1500, zone_vertices=300, seed=i))
+        with open(os.path.join(folder, 'frame.pdf'), 'wb') as f:
+            f.write(bench.synthetic_frame_pdf())
+        layers = ['layer0.pdf', 'layer1.pdf', 'frame.pdf']
+        color = (0.2, 0.4, 0.6)
+        jobs = {
+            'colorize': lambda f: f(folder, 'layer0.pdf', 'colored.pdf', color, 0),
+            'merge': lambda f: f(folder, list(layers), folder, 'merged.pdf', 'frame.pdf', {'scaling_method': '0'},
+                                 1.0, False, 'calibration', None),
+            'crop': lambda f: f(os.path.join(folder, 'layer0.pdf'), os.path.join(folder, 'cropped.pdf'), '10'),
+            'concat': lambda f: f(folder, layers, folder, 'concat.pdf', False),
+            'linearize': lambda f: f(os.path.join(folder, 'layer0.pdf'), os.path.join(folder, 'linearized.pdf')),
+        }
+
+        timings = {}
+        for operation, job in jobs.items():
+            timings[operation] = {}
+            for engine in engines(operation):
+                if not engine.available():
+                    continue
+                best = math.inf
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    ok = job(engine.function)
+                    best = min(best, time.perf_counter() - start)
+                    if not ok:
+                        _logger.warning(f'calibration of {operation} engine {engine.name} failed')
+                        best = math.inf
+                        break
+                if best < math.inf:
+                    timings[operation][engine.name] = best
+        _logger.info(f'{timings=}')
+        return timings
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
@@ -0,0 +1,312 @@
+from __future__ import annotations
+import argparse
+import concurrent.futures
+import copy
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    from . import cli, costs, persistence, tracing
+except ImportError:
+    import cli, costs, persistence, tracing
+
+_logger = logging.getLogger(__name__)
+
+# Peak memory assumed for a board without history, when the pool is sized for a memory budget.
+DEFAULT_PEAK_RSS = 1 << 30
+
+
+class BatchEntry:
+    def __init__(self, board: str, ini: str = None, overrides: dict = None):
+        self.board: str = board  # absolute path of the .kicad_pcb file
+        self.ini: str | None = ini  # ini file, None to look it up like the single board cli does
+        self.overrides: dict = overrides or {}  # config values replacing the ones from the ini file
+
+    def __repr__(self):
+        var_str = ', '.join(f"{key}: {value}" for key, value in vars(self).items())
+        return f'{self.__class__.__name__}:{{ {var_str} }}'
+
+
+def expand_boards(patterns: list[str]) -> list[str]:
+    """Expand board paths and glob patterns to a sorted list of unique absolute paths."""
+    boards = []
+    for pattern in patterns:
+        pattern = os.path.expanduser(os.path.expandvars(pattern))
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            _logger.warning(f'{pattern=} matched no boards')
+        boards += [os.path.abspath(m) for m in matches]
+    return sorted(set(boards))
+
+
+def load_manifest(manifest_path: str) -> list[BatchEntry]:
+    """Read a JSON manifest.
+
+    The manifest is a list (or a dict with a "boards" list) of entries like
+    {"board": "a/a.kicad_pcb", "ini": "a/customer.ini", "overrides": {"output_path": "docs"}}.
+    Entries can also be plain board paths, and the board path can be a glob. Relative paths are relative
+    to the manifest.
+    """
+    with open(manifest_path, 'r') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get('boards', [])
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+    for item in data:
+        if isinstance(item, str):
+            item = {'board': item}
+        ini = item.get('ini')
+        if ini:
+            ini = os.path.join(base_dir, os.path.expanduser(ini))
+        for board in expand_boards([os.path.join(base_dir, item['board'])]):
+            entries.append(BatchEntry(board, ini, item.get('overrides')))
+    return entries
+
+
+def _init_worker(log_level: int):
+    # Import the heavy libraries once per worker process instead of once per board.
+    if log_level:
+        logging.basicConfig(level=log_level)
+    import pcbnew  # noqa: F401
+    try:
+        from . import plot  # noqa: F401
+    except ImportError:
+        import plot  # noqa: F401
+
+
+def _failed_summary(board_path: str, status: str, errors: list = None) -> dict:
+    return {'board': board_path, 'success': False, 'status': status, 'outputs': [], 'timings': {}, 'warnings': [],
+            'errors': errors or [], 'seconds': 0.0}
+
+
+def plot_entry(board_path: str, config_vars: dict) -> dict:
+    """Plot one board, returns a picklable summary of the plot.PlotResult."""
+    import pcbnew
+    try:
+        from . import plot
+    except ImportError:
+        import plot
+
+    start = time.perf_counter()
+    try:
+        board = pcbnew.LoadBoard(board_path)
+        result = plot.plot_board(board, **config_vars)
+        summary = {'success': result.success, 'status': result.status, 'outputs': result.outputs,
+                   'timings': result.timings, 'warnings': result.warnings, 'errors': result.errors,
+                   'peak_rss': result.peak_rss, 'report': result.tracer.report()}
+    except Exception as e:
+        _logger.exception(f'{board_path=} failed')
+        summary = _failed_summary(board_path, f'{type(e).__name__}: {e}', [str(e)])
+    summary['board'] = board_path
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def print_summary(summaries: list[dict], file=sys.stdout):
+    name_width = max([len(os.path.basename(s['board'])) for s in summaries] + [5])
+    print(f"\n{'Board':<{name_width}}  {'Result':<6}  {'Time':>8}  {'Memory':>9}  Details", file=file)
+    print(f"{'-' * name_width}  {'-' * 6}  {'-' * 8}  {'-' * 9}  {'-' * 40}", file=file)
+    for s in summaries:
+        details = s['outputs'][0] if s['success'] and s['outputs'] else s['status']
+        # The last line of the first error, a traceback ends with the exception
+        error_lines = s['errors'][0].strip().splitlines() if not s['success'] and s['errors'] else []
+        if error_lines:
+            details += ' - ' + error_lines[-1]
+        memory = tracing.format_bytes(s['peak_rss']) if s.get('peak_rss') else '-'
+        print(f"{os.path.basename(s['board']):<{name_width}}  {'ok' if s['success'] else 'FAILED':<6}  "
+              f"{s['seconds']:7.1f}s  {memory:>9}  {details}", file=file)
+    failed = sum(not s['success'] for s in summaries)
+    print(f"\n{len(summaries) - failed} of {len(summaries)} boards succeeded.", file=file)
+
+
+def run_batch(entries: list[BatchEntry], jobs: int = 0, ini: str = None, overrides: dict = None,
+              log_level: int = logging.NOTSET, max_memory: int = None) -> list[dict]:
+    """Plot all `entries` with a pool of `jobs` worker processes (0 = one per cpu, 1 = in this process).
+
+    Each ini file is parsed once and shared by all boards using it. The pool starts the boards predicted to
+    take longest first (costs.CostModel). With `max_memory` (bytes) the pool is made smaller until the peak
+    memory of the largest board, from earlier runs, fits in each worker's share of the budget.
+    Returns one summary per board in the order of `entries`.
+    """
+    configs: dict[str, dict] = {}
+    tasks = []
+    summaries: list[dict | None] = [None] * len(entries)
+    for i, entry in enumerate(entries):
+        ini_path = cli.find_ini(entry.board, entry.ini or ini)
+        if not os.path.exists(entry.board) or ini_path is None:
+            status = 'ini file not found' if os.path.exists(entry.board) else 'board not found'
+            summaries[i] = _failed_summary(entry.board, status)
+            continue
+        if str(ini_path) not in configs:
+            configs[str(ini_path)] = persistence.Persistence(str(ini_path)).load()
+        config_vars = copy.deepcopy(configs[str(ini_path)])
+        config_vars.update(overrides or {})
+        config_vars.update(entry.overrides)
+        tasks.append((i, entry.board, config_vars))
+
+    done = sum(s is not None for s in summaries)
+
+    def report(summary: dict):
+        print(f"[{done}/{len(entries)}] {'ok    ' if summary['success'] else 'FAILED'} "
+              f"{summary['seconds']:6.1f}s  {summary['board']}")
+
+    jobs = jobs or os.cpu_count() or 1
+    cost_model = costs.CostModel.load()
+    if max_memory:
+        peak = max([cost_model.predict_peak_rss(board) or DEFAULT_PEAK_RSS for _, board, _ in tasks] + [1])
+        jobs = max(1, min(jobs, max_memory // peak))
+        _logger.info(f'{jobs=} for {max_memory=} and {peak=}')
+        for _, _, config_vars in tasks:
+            config_vars['max_memory'] = max_memory // jobs
+    if any(config_vars.get(lib) == 'auto' for _, _, config_vars in tasks for lib in ('colorize_lib', 'merge_lib', 'crop_lib')):
+        # Calibrate the pdf libraries once here instead of in every worker
+        try:
+            from . import plot
+        except ImportError:
+            import plot
+        plot.backends.calibration()
+    if jobs == 1 or len(tasks) <= 1:
+        _init_worker(logging.NOTSET)
+        for i, board, config_vars in tasks:
+            summaries[i] = plot_entry(board, config_vars)
+            done += 1
+            report(summaries[i])
+        return summaries
+
+    # Longest boards first, by the cost history of earlier runs, so one slow board doesn't run alone at the end.
+    tasks.sort(key=lambda task: cost_model.predict_board(task[1]), reverse=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), initializer=_init_worker,
+                                                initargs=(log_level,)) as pool:
+        futures = {pool.submit(plot_entry, board, config_vars): i for i, board, config_vars in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                summaries[i] = future.result()
+            except Exception as e:
+                # The worker process died, e.g. a crash inside KiCad.
+                summaries[i] = _failed_summary(entries[i].board, f'worker failed: {e}')
+            done += 1
+            report(summaries[i])
+    return summaries
+
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(prog='board2pdf batch', description='Board2Pdf CLI, plot several boards.')
+    parser.add_argument('boards', nargs='*', help='.kicad_pcb files or glob patterns like "boards/**/*.kicad_pcb"')
+    parser.add_argument('--manifest', default=None, type=cli.shell_path(), required=False,
+                        help='JSON file listing boards with optional ini file and overrides per board')
+    parser.add_argument('--ini', default=None, type=cli.shell_path(), required=False,
+                        help='Path to `board2pdf.config.ini` to use for boards without their own ini')
+    parser.add_argument('-j', '--jobs', default=0, type=cli.num_range(int, 0, 256), required=False,
+                        help='Number of worker processes, 0 for one per cpu')
+    parser.add_argument('--log', default='NOTSET', choices=cli._log_levels.keys(), required=False,
+                        help='Enables logging with given log-level')
+    parser.add_argument('--merge', default=None, choices=cli._pdf_libs_merge, required=False,
+                        help='PDF merge processor library')
+    parser.add_argument('--colorize', default=None, choices=cli._pdf_libs_color, required=False,
+                        help='PDF colorize processor library')
+    parser.add_argument('--crop', default=None, choices=cli._pdf_libs_crop, required=False,
+                        help='PDF crop processor library')
+    parser.add_argument('--ext', default=None, required=False,
+                        help='File extension to use for the merged PDF. Default is `__Assembly`.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only replace the pages of changed templates in the assembly pdfs of the last run')
+    parser.add_argument('--max-memory', default=None, type=cli.memory_size, required=False,
+                        help='Memory budget like 8G for the whole batch, fewer workers are used to stay under it')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the steps finished by an earlier run of each board that failed')
+    parser.add_argument('--minify', default=None, type=cli.num_range(float, 0.0, 1.0), required=False, metavar='MM',
+                        help='Round the coordinates of the layer pdfs to this precision in mm before merging')
+    parser.add_argument('--cull', action='store_true',
+                        help='Drop the drawings of opaque layers hidden by the opaque layers over them')
+    parser.add_argument('--rasterize-over', default=None, type=cli.memory_size, required=False, metavar='SIZE',
+                        help='Render layers with more drawing data than this, like 20M, to an image')
+    parser.add_argument('--rasterize-paths', default=None, type=cli.num_range(int, 1, 10 ** 9), required=False,
+                        metavar='COUNT', help='Render layers with more painted paths than this to an image')
+    parser.add_argument('--rasterize-dpi', default=None, type=cli.num_range(int, 50, 1200), required=False,
+                        help='Resolution of the rasterized layers, default 300')
+    parser.add_argument('--dedup-text', action='store_true',
+                        help='Draw the glyphs of text repeated in a layer only once')
+    parser.add_argument('--image-dpi', default=None, type=cli.num_range(int, 50, 1200), required=False,
+                        help='Store images only once, downsampled to this resolution')
+    parser.add_argument('--linearize', action='store_true',
+                        help='Write the assembly pdfs linearized (fast web view)')
+    parser.add_argument('--reproducible', action='store_true',
+                        help='Write the same assembly pdfs for the same boards, unchanged ones are left alone')
+    parser.add_argument('--panel', default=None, type=cli.shell_path(), required=False, metavar='LAYOUT',
+                        help='Plot every board as a panel with this JSON layout')
+    parser.add_argument('--tiles', default=None, choices=['png', 'jpeg', 'webp'], required=False,
+                        help='Also write every template page as a deep zoom image with tiles in this format')
+    parser.add_argument('--report', default=None, type=cli.shell_path(True, False), required=False,
+                        help='Write a JSON report with the result and the stage timings of every board')
+    args = parser.parse_args(argv)
+    if not args.boards and not args.manifest:
+        parser.error('give at least one board or a --manifest')
+    return args
+
+
+def main(argv: list[str] = None) -> int:
+    args = parse_args(argv)
+
+    log_level = cli._log_levels[args.log]
+    if log_level:
+        logging.basicConfig(filename='board2pdf.log', level=log_level)
+
+    entries = [BatchEntry(board) for board in expand_boards(args.boards)]
+    if args.manifest:
+        entries += load_manifest(args.manifest)
+    if not entries:
+        print("Error: no boards found.", file=sys.stderr)
+        return 1
+
+    overrides = {}
+    if args.colorize:
+        overrides['colorize_lib'] = args.colorize
+    if args.merge:
+        overrides['merge_lib'] = args.merge
+    if args.crop:
+        overrides['crop_lib'] = args.crop
+    if args.ext:
+        overrides['assembly_file_extension'] = args.ext
+    if args.incremental:
+        overrides['incremental'] = True
+    if args.resume:
+        overrides['resume'] = True
+    if args.minify is not None:
+        overrides['minify_precision'] = args.minify
+    if args.cull:
+        overrides['cull_hidden'] = True
+    if args.rasterize_over:
+        overrides['rasterize_over'] = args.rasterize_over
+    if args.rasterize_paths:
+        overrides['rasterize_paths'] = args.rasterize_paths
+    if args.rasterize_dpi:
+        overrides['rasterize_dpi'] = args.rasterize_dpi
+    if args.dedup_text:
+        overrides['dedup_text'] = True
+    if args.image_dpi:
+        overrides['image_dpi'] = args.image_dpi
+    if args.linearize:
+        overrides['linearize'] = True
+    if args.tiles:
+        overrides['tile_format'] = args.tiles
+    if args.reproducible:
+        overrides['reproducible'] = True
+    if args.panel:
+        overrides['panel_layout'] = args.panel
+    if args.report:
+        # The report has the memory peak of every stage
+        overrides['reset_peak_rss'] = True
+
+    summaries = run_batch(entries, args.jobs, args.ini, overrides, log_level, args.max_memory)
+    print_summary(summaries)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    return 0 if all(s['success'] for s in summaries) else 1
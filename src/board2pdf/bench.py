@@ -0,0 +1,439 @@
+"""Benchmarks of the pdf stages, no KiCad needed.
+
+Run with `python -m board2pdf.bench`. The stages run on synthetic KiCad-like layer pdfs and on the pages of
+the assembly pdfs in `resources/`. Use --save-baseline once and --baseline later to see regressions.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+try:
+    from . import plot, tracing, _version
+except ImportError:
+    import plot, tracing, _version
+
+pymupdf = plot.pymupdf
+pypdf = plot.pypdf
+geometry = plot.geometry
+
+_logger = logging.getLogger(__name__)
+
+_resources_dir = Path(__file__).resolve().parents[2] / 'resources'
+_bundled_pdfs = {'armory': 'armory-Assembly.pdf', 'hackrf': 'hackrf-one-Assembly.pdf'}
+_color = (0.2, 0.4, 0.6)
+
+
+def _pdf_file(objects: list[bytes]) -> bytes:
+    """Serialize `objects` (object 1 is the catalog) with a classic xref table."""
+    out = bytearray(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%b\nendobj\n' % (number, obj)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _stream(data: bytes) -> bytes:
+    data = zlib.compress(data)
+    return b'<< /Length %d /Filter /FlateDecode >>\nstream\n%b\nendstream' % (len(data), data)
+
+
+def synthetic_layer_pdf(paths: int = 5000, zone_vertices: int = 1000, streams: int = 1, seed: int = 0,
+                        width: float = 842.0, height: float = 595.0) -> bytes:
+    """A one page pdf drawn in black like a KiCad layer plot.
+
+    It has `paths` tracks, pads and vias spread over `streams` content streams, a filled zone outline with
+    `zone_vertices` vertices and an outline entry like the ones KiCad writes.
+    """
+    rnd = random.Random(seed)
+    streams = max(1, streams)
+    ops = [[] for _ in range(streams)]
+
+    def point() -> str:
+        return f'{rnd.uniform(20, width - 20):.4f} {rnd.uniform(20, height - 20):.4f}'
+
+    # Zones are plotted first, as a filled polygon.
+    if zone_vertices >= 3:
+        cx, cy, r = width / 2, height / 2, min(width, height) / 3
+        zone = ['0 0 0 rg\n']
+        for i in range(zone_vertices):
+            a = 2 * math.pi * i / zone_vertices
+            k = r * rnd.uniform(0.8, 1.0)
+            zone.append(f"{cx + k * math.cos(a):.4f} {cy + k * math.sin(a):.4f} {'m' if i == 0 else 'l'}\n")
+        zone.append('h\nf\n')
+        ops[0].append(''.join(zone))
+
+    for i in range(paths):
+        kind = i % 4
+        if kind < 2:  # track with one or two segments
+            segments = 1 + kind
+            track = f'0 0 0 RG\n{rnd.choice((0.1524, 0.2032, 0.254)):.4f} w\n1 J 1 j\n{point()} m\n'
+            track += ''.join(f'{point()} l\n' for _ in range(segments))
+            ops[i % streams].append(track + 'S\n')
+        elif kind == 2:  # rectangular pad
+            ops[i % streams].append(f'0 0 0 rg\n{point()} {rnd.uniform(0.5, 2):.4f} {rnd.uniform(0.5, 2):.4f} re f\n')
+        else:  # round pad or via, a circle from four bezier curves
+            x, y = rnd.uniform(20, width - 20), rnd.uniform(20, height - 20)
+            r = rnd.uniform(0.3, 1.0)
+            c = r * 0.5523
+            ops[i % streams].append(
+                f'0 0 0 rg\n{x + r:.4f} {y:.4f} m\n'
+                f'{x + r:.4f} {y + c:.4f} {x + c:.4f} {y + r:.4f} {x:.4f} {y + r:.4f} c\n'
+                f'{x - c:.4f} {y + r:.4f} {x - r:.4f} {y + c:.4f} {x - r:.4f} {y:.4f} c\n'
+                f'{x - r:.4f} {y - c:.4f} {x - c:.4f} {y - r:.4f} {x:.4f} {y - r:.4f} c\n'
+                f'{x + c:.4f} {y - r:.4f} {x + r:.4f} {y - c:.4f} {x + r:.4f} {y:.4f} c\nf\n')
+
+    first_stream = 6
+    contents = ' '.join(f'{first_stream + i} 0 R' for i in range(streams))
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R /Outlines 5 0 R /PageMode /UseOutlines >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width:g} {height:g}] /Resources << >> '
+        f'/Contents [{contents}] >>'.encode(),
+        b'<< /Title (Page 1) /Parent 5 0 R /Dest [3 0 R /Fit] >>',
+        b'<< /Type /Outlines /First 4 0 R /Last 4 0 R /Count 1 >>',
+    ]
+    objects += [_stream(('q\n' + ''.join(o) + 'Q\n').encode()) for o in ops]
+    return _pdf_file(objects)
+
+
+def synthetic_frame_pdf(width: float = 842.0, height: float = 595.0) -> bytes:
+    """A drawing sheet border with a title block, stroked in black like the KiCad frame layer."""
+    lines = ['q\n0 0 0 RG\n0.3 w\n', f'10 10 {width - 20:g} {height - 20:g} re S\n']
+    for i in range(1, 8):
+        x = 10 + i * (width - 20) / 8
+        lines.append(f'{x:.4f} 10 m {x:.4f} 15 l S\n{x:.4f} {height - 15:.4f} m {x:.4f} {height - 10:.4f} l S\n')
+    lines.append(f'{width - 300:g} 10 290 80 re S\nQ\n')
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width:g} {height:g}] /Resources << >> '
+        f'/Contents 4 0 R >>'.encode(),
+        _stream(''.join(lines).encode()),
+    ]
+    return _pdf_file(objects)
+
+
+def prepare_synthetic(folder: str, layers: int, paths: int, zone_vertices: int, streams: int):
+    for i in range(layers):
+        with open(os.path.join(folder, f'layer{i}.pdf'), 'wb') as f:
+            f.write(synthetic_layer_pdf(paths, zone_vertices, streams, seed=i))
+    with open(os.path.join(folder, 'frame.pdf'), 'wb') as f:
+        f.write(synthetic_frame_pdf())
+    _prepare_merge_inputs(folder, layers)
+
+
+def prepare_bundled(folder: str, pdf_path: str, layers: int) -> int:
+    """Use the pages of an assembly pdf as layers, returns the number of layers."""
+    with pymupdf.open(pdf_path) as src:
+        layers = min(layers, src.page_count)
+        for i in range(layers):
+            with pymupdf.open() as doc:
+                doc.insert_pdf(src, from_page=i, to_page=i)
+                doc.save(os.path.join(folder, f'layer{i}.pdf'))
+        rect = src[0].rect
+    with open(os.path.join(folder, 'frame.pdf'), 'wb') as f:
+        f.write(synthetic_frame_pdf(rect.width, rect.height))
+    _prepare_merge_inputs(folder, layers)
+    return layers
+
+
+def _prepare_merge_inputs(folder: str, layers: int):
+    # Colored layers are the input of the merge cases, the merged page the input of concat and svg.
+    for i in range(layers):
+        if not plot.colorize_pdf_pymupdf(folder, f'layer{i}.pdf', f'colored{i}.pdf', _color, 0):
+            raise RuntimeError(f'colorizing layer{i}.pdf in {folder} failed')
+    if not plot.merge_pdf_pymupdf(folder, _merge_inputs(layers), folder, 'merged.pdf', 'frame.pdf',
+                                  {'scaling_method': '0'}, 1.0, False, 'bench'):
+        raise RuntimeError(f'merging the layers in {folder} failed')
+
+
+def _merge_inputs(layers: int) -> list[str]:
+    # The merge engines paint the last input on top, like in plan.py: the frame over the colored layers.
+    return [f'colored{i}.pdf' for i in range(layers)] + ['frame.pdf']
+
+
+class Case(NamedTuple):
+    name: str
+    run: Callable  # run(input folder, output folder, number of layers, pages) -> list of output files
+    available: Callable = lambda: True
+    span: str = ''  # only time this tracing stage of the run
+
+
+def _check(ok: bool, what: str):
+    if not ok:
+        raise RuntimeError(f'{what} failed')
+
+
+def _colorize(function: Callable, transparency: int):
+    def run(folder: str, out: str, layers: int, pages: int) -> list[str]:
+        outputs = []
+        for i in range(layers):
+            shutil.copy(os.path.join(folder, f'layer{i}.pdf'), out)
+            _check(function(out, f'layer{i}.pdf', f'colored{i}.pdf', _color, transparency), function.__name__)
+            outputs.append(os.path.join(out, f'colored{i}.pdf'))
+        return outputs
+
+    return run
+
+
+def _merge(function: Callable, scale_or_crop: dict, layer_scale: float = 1.0, crop_pdf: Callable = None):
+    def run(folder: str, out: str, layers: int, pages: int) -> list[str]:
+        temp = os.path.join(out, 'temp')
+        os.mkdir(temp)
+        for filename in _merge_inputs(layers):
+            shutil.copy(os.path.join(folder, filename), temp)
+        _check(function(temp, _merge_inputs(layers), out, 'merged.pdf', 'frame.pdf', dict(scale_or_crop),
+                        layer_scale, False, 'bench', crop_pdf), function.__name__)
+        return [os.path.join(out, 'merged.pdf')]
+
+    return run
+
+
+def _concat(folder: str, out: str, layers: int, pages: int) -> list[str]:
+    _check(plot.create_pdf_from_pages(folder, ['merged.pdf'] * pages, out, 'assembly.pdf', False),
+           'create_pdf_from_pages')
+    return [os.path.join(out, 'assembly.pdf')]
+
+
+def _linearize(function: Callable):
+    def run(folder: str, out: str, layers: int, pages: int) -> list[str]:
+        _check(plot.create_pdf_from_pages(folder, ['merged.pdf'] * pages, out, 'assembly.pdf', False),
+               'create_pdf_from_pages')
+        output = os.path.join(out, 'linearized.pdf')
+        _check(function(os.path.join(out, 'assembly.pdf'), output), function.__name__)
+        return [output]
+    return run
+
+
+def _svg(folder: str, out: str, layers: int, pages: int) -> list[str]:
+    # Same as the svg stage of plot_board.
+    with pymupdf.open(os.path.join(folder, 'merged.pdf')) as template_pdf:
+        svg_image = template_pdf[0].get_svg_image()
+    with open(os.path.join(out, 'merged.svg'), 'w') as file:
+        file.write(svg_image)
+    return [os.path.join(out, 'merged.svg')]
+
+
+def _geometry(folder: str, out: str, layers: int, pages: int) -> list[str]:
+    # The paths of the merged page as arrays, what crop_pdf_pymupdf measures.
+    with pymupdf.open(os.path.join(folder, 'merged.pdf')) as doc:
+        geometry.page_paths(doc).bbox()
+    return []
+
+
+def _minify(folder: str, out: str, layers: int, pages: int) -> list[str]:
+    outputs = []
+    for i in range(layers):
+        shutil.copy(os.path.join(folder, f'colored{i}.pdf'), out)
+        _check(plot.minify_pdf(out, f'colored{i}.pdf', f'minified{i}.pdf', 0.005), 'minify_pdf')
+        outputs.append(os.path.join(out, f'minified{i}.pdf'))
+    return outputs
+
+
+# colorize_pdf_pypdf ignores the transparency, so there is no transparent pypdf case.
+CASES = [
+    Case('colorize-pymupdf', _colorize(plot.colorize_pdf_pymupdf, 0)),
+    Case('colorize-pymupdf-transparency', _colorize(plot.colorize_pdf_pymupdf, 50)),
+    Case('colorize-pypdf', _colorize(plot.colorize_pdf_pypdf, 0)),
+    Case('merge-pymupdf', _merge(plot.merge_pdf_pymupdf, {'scaling_method': '0'})),
+    Case('merge-pymupdf-scaled', _merge(plot.merge_pdf_pymupdf, {'scaling_method': '3', 'scaling_factor': '1.5'})),
+    Case('merge-pypdf', _merge(plot.merge_pdf_pypdf, {'scaling_method': '0'})),
+    Case('merge-pypdf-scaled', _merge(plot.merge_pdf_pypdf, {'scaling_method': '0'}, 1.5)),
+    Case('crop-pdfcropmargins', _merge(plot.merge_pdf_pymupdf, {'scaling_method': '1', 'crop_whitespace': '10'},
+                                       crop_pdf=plot.crop_pdf_pdfcropmargins), plot.pdfcropmargins_loaded, 'crop'),
+    Case('crop-pymupdf', _merge(plot.merge_pdf_pymupdf, {'scaling_method': '1', 'crop_whitespace': '10'},
+                                crop_pdf=plot.crop_pdf_pymupdf), span='crop'),
+    Case('concat-pypdf', _concat),
+    Case('linearize-pikepdf', _linearize(plot.linearize_pdf_pikepdf), plot.pikepdf_loaded),
+    Case('linearize-qpdf', _linearize(plot.linearize_pdf_qpdf), lambda: plot.qpdf_path() is not None),
+    Case('linearize-pymupdf', _linearize(plot.linearize_pdf_pymupdf), plot.pymupdf_linearizes),
+    Case('svg-pymupdf', _svg),
+    Case('geometry-numpy', _geometry, lambda: geometry.has_numpy),
+    Case('minify-pymupdf', _minify, lambda: geometry.has_numpy),
+]
+
+
+def time_case(case: Case, folder: str, layers: int, pages: int, repeat: int) -> dict:
+    times = []
+    bytes_out = 0
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix='board2pdf-bench-') as out:
+            tracer = tracing.Tracer()
+            start = time.perf_counter()
+            with tracer.activate():
+                outputs = case.run(folder, out, layers, pages)
+            seconds = time.perf_counter() - start
+            if case.span:
+                seconds = tracer.totals().get(case.span, {}).get('wall', seconds)
+            times.append(seconds)
+            bytes_out = sum(os.path.getsize(path) for path in outputs)
+    return {'median': statistics.median(times), 'min': min(times), 'repeat': repeat, 'bytes_out': bytes_out}
+
+
+# Startup of a new python process, our batch scripts start board2pdf many times.
+STARTUP_CASES = {
+    'startup/version': ['-m', 'board2pdf.cli', '--version'],
+    'startup/import-plot': ['-c', 'import board2pdf.plot'],
+    'startup/load-pdf-libs': ['-c', 'import board2pdf.plot as p; p.pymupdf_loaded(); p.pdfcropmargins_loaded(); '
+                                    'p.pypdf.PdfWriter'],
+}
+
+
+def time_startup(args: list[str], repeat: int) -> dict:
+    src_dir = str(Path(__file__).resolve().parents[1])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [src_dir, os.environ.get('PYTHONPATH')])))
+    times = []
+    for _ in range(max(repeat, 5)):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], env=env, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return {'median': statistics.median(times), 'min': min(times), 'repeat': len(times), 'bytes_out': 0}
+
+
+def run_benchmarks(layers: int = 4, paths: int = 5000, zone_vertices: int = 1000, streams: int = 1, pages: int = 8,
+                   repeat: int = 3, only: list[str] = None, resources_dir: str = None) -> dict:
+    """Time every case on every input set, returns the results as a JSON-serializable dict."""
+    report = {
+        'meta': {
+            'board2pdf': _version.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+            'system': platform.system(), 'pymupdf': pymupdf.VersionBind, 'pypdf': pypdf.__version__,
+            'pdfCropMargins': plot.pdfcropmargins_loaded(), 'repeat': repeat,
+            'params': {'layers': layers, 'paths': paths, 'zone_vertices': zone_vertices, 'streams': streams,
+                       'pages': pages},
+        },
+        'results': {},
+    }
+    resources_dir = Path(resources_dir) if resources_dir else _resources_dir
+
+    with tempfile.TemporaryDirectory(prefix='board2pdf-bench-inputs-') as inputs:
+        input_sets = []
+        folder = os.path.join(inputs, 'synthetic')
+        os.mkdir(folder)
+        prepare_synthetic(folder, layers, paths, zone_vertices, streams)
+        input_sets.append(('synthetic', folder, layers))
+        for set_name, filename in _bundled_pdfs.items():
+            if not (resources_dir / filename).exists():
+                print(f'Skipping {set_name}, {resources_dir / filename} not found', file=sys.stderr)
+                continue
+            folder = os.path.join(inputs, set_name)
+            os.mkdir(folder)
+            input_sets.append((set_name, folder, prepare_bundled(folder, str(resources_dir / filename), layers)))
+
+        for set_name, folder, set_layers in input_sets:
+            for case in CASES:
+                case_id = f'{case.name}/{set_name}'
+                if only and not any(pattern in case_id for pattern in only):
+                    continue
+                if not case.available():
+                    report['results'][case_id] = {'skipped': 'not available'}
+                    continue
+                try:
+                    report['results'][case_id] = time_case(case, folder, set_layers, pages, repeat)
+                except Exception as e:
+                    _logger.exception(f'{case_id=} failed')
+                    report['results'][case_id] = {'error': f'{type(e).__name__}: {e}'}
+                print(f"{case_id:<45} {_format_result(report['results'][case_id])}", file=sys.stderr)
+
+    for case_id, args in STARTUP_CASES.items():
+        if only and not any(pattern in case_id for pattern in only):
+            continue
+        try:
+            report['results'][case_id] = time_startup(args, repeat)
+        except subprocess.CalledProcessError as e:
+            report['results'][case_id] = {'error': e.stderr.decode(errors='replace').strip()}
+        print(f"{case_id:<45} {_format_result(report['results'][case_id])}", file=sys.stderr)
+    return report
+
+
+def _format_result(result: dict) -> str:
+    if 'median' not in result:
+        return result.get('error') or result.get('skipped', '')
+    return f"{result['median']:8.3f}s {result['min']:8.3f}s {result['bytes_out'] / 1024:9.0f} KiB"
+
+
+def compare(report: dict, baseline: dict, threshold: float = 0.1) -> list[str]:
+    """Print `report` next to `baseline`, returns the ids of the cases more than `threshold` slower."""
+    if report['meta']['params'] != baseline['meta']['params']:
+        print(f"Warning: the baseline was made with other parameters: {baseline['meta']['params']}")
+    regressions = []
+    print(f"{'Case':<45} {'Median':>9} {'Baseline':>9} {'Change':>8}")
+    for case_id, result in report['results'].items():
+        base = baseline['results'].get(case_id, {})
+        if 'median' not in result or 'median' not in base:
+            print(f"{case_id:<45} {_format_result(result) if 'median' not in result else 'no baseline'}")
+            continue
+        change = result['median'] / base['median'] - 1 if base['median'] else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(case_id)
+        print(f"{case_id:<45} {result['median']:8.3f}s {base['median']:8.3f}s {change:+8.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(prog='python -m board2pdf.bench',
+                                     description='Benchmark the pdf stages of Board2Pdf without KiCad.')
+    parser.add_argument('--layers', default=4, type=int, help='Number of layers per template')
+    parser.add_argument('--paths', default=5000, type=int, help='Number of paths per synthetic layer')
+    parser.add_argument('--zone-vertices', default=1000, type=int,
+                        help='Number of vertices of the zone of each synthetic layer, 0 for no zone')
+    parser.add_argument('--streams', default=1, type=int, help='Number of content streams per synthetic layer')
+    parser.add_argument('--pages', default=8, type=int, help='Number of pages of the concat case')
+    parser.add_argument('--repeat', default=3, type=int, help='Number of runs per case, the median is reported')
+    parser.add_argument('--only', default=None, action='append',
+                        help='Only run the cases with an id containing this text, e.g. `colorize` or `/synthetic`')
+    parser.add_argument('--resources', default=None, help='Folder with the bundled assembly pdfs')
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='Compare the results with this JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results to the --baseline file')
+    parser.add_argument('--threshold', default=0.1, type=float,
+                        help='Slowdown of the median, relative to the baseline, reported as regression')
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None) -> int:
+    args = parse_args(argv)
+    if not plot.pymupdf_loaded():
+        print("Error: the benchmarks need PyMuPDF.", file=sys.stderr)
+        return 1
+
+    report = run_benchmarks(args.layers, args.paths, args.zone_vertices, args.streams, args.pages, args.repeat,
+                            args.only, args.resources)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) regressed: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,27 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
 import argparse
+import json
 import logging
 import os
 import sys
 from pathlib import Path
 
+# plot is imported when a board is plotted, so `--version` and argument errors return quickly.
 try:
-    from . import plot, _version
+    from . import _version
 except ImportError as e:
     print(e)
-    import plot, _version
+    import _version
 
 _logger = logging.getLogger(__name__)
 _log_levels = {'NOTSET': logging.NOTSET, 'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARN': logging.WARN,
                'ERROR': logging.ERROR, 'FATAL': logging.FATAL}
-_pdf_libs_merge = ['pypdf', 'pymupdf']
-_pdf_libs_color = ['pypdf', 'pymupdf']
+# 'auto' picks the fastest library that can do the job on this machine, see backends.select.
+_pdf_libs_merge = ['auto', 'pypdf', 'pymupdf']
+_pdf_libs_color = ['auto', 'pypdf', 'pymupdf']
+_pdf_libs_crop = ['auto', 'pdfcropmargins', 'pymupdf']
 
 
 def shell_path(abspath: bool = True, exists: bool = True):
@@ -44,41 +49,236 @@ def num_range(arg_type, min_val, max_val):
     return range_check
 
 
-def cli(board_filepath: str, configfile: str, **kwargs) -> bool:
+def memory_size(arg: str) -> int:
+    """Bytes of a size like 2G, 1500M or 512MiB, a plain number is in megabytes."""
+    units = {'': 1 << 20, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    value = arg.strip().upper()
+    for suffix in ('B', 'I'):
+        if value.endswith(suffix):
+            value = value[:-1]
+    unit = value[-1:] if value[-1:] in units else ''
+    try:
+        size = int(float(value[:len(value) - len(unit)]) * units[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError('must be a size like 2G, 1500M or 512MiB')
+    if size <= 0:
+        raise argparse.ArgumentTypeError('must be larger than 0')
+    return size
+
+
+def find_ini(pcb_path: str, ini: str = None) -> Path | None:
+    """Find the ini file to use for `pcb_path`, returns None if there is none.
+
+    An ini file given with `ini` must exist. If no ini file is specified, look for an ini file in the pcb path,
+    then the globally saved ini file, and last for the default ini file.
+    """
+    if ini:
+        ini_path = Path(ini).absolute()
+        if not ini_path.exists():
+            _logger.error(f'{ini_path=} specified with --ini argument not found, terminate')
+            print(f"Error: ini file `{ini}` specified with --ini argument not found.", file=sys.stderr)
+            return None
+        return ini_path
+
+    ini_path = Path(os.path.join(os.path.dirname(pcb_path), 'board2pdf.config.ini'))
+    if not ini_path.exists():
+        _logger.info(f'{ini_path=} not found, use global path')
+        ini_path = Path(__file__).parent / 'board2pdf.config.ini'
+        if not ini_path.exists():
+            _logger.info(f'{ini_path=} not found, use default path')
+            ini_path = Path(__file__).parent / 'default_config.ini'
+            if not ini_path.exists():
+                _logger.error(f'{ini_path=} not found, terminate')
+                print(f"Error: ini file not found.", file=sys.stderr)
+                return None
+    return ini_path
+
+
+def print_progress(progress: int, status: str):
+    print(f'{int(progress):3d}%: {status}')
+
+
+def print_msg(text: str, caption: str, flags: int):
+    print(f"{caption}: {text}")
+
+
+def write_trace_files(results: list, report_path: str = None, trace_path: str = None, **meta):
+    """Write the JSON run report and/or the Chrome trace of the plot.PlotResults of one cli run."""
+    if report_path:
+        reports = [result.tracer.report(**meta, status=result.status, success=result.success)
+                   for result in results]
+        with open(report_path, 'w') as f:
+            json.dump(reports[0] if len(reports) == 1 else {**meta, 'variants': reports}, f, indent=2)
+    if trace_path:
+        events = [event for result in results for event in result.tracer.chrome_trace()['traceEvents']]
+        with open(trace_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def cli(board_filepath: str, configfile: str, report_path: str = None, trace_path: str = None, **kwargs) -> bool:
     import pcbnew
     try:
-        from . import persistence
+        from . import persistence, plot
     except ImportError:
-        import persistence
+        import persistence, plot
 
     board = pcbnew.LoadBoard(board_filepath)
     config = persistence.Persistence(configfile)
     config_vars = config.load()
     # note: cli parameters override config.ini values
     config_vars.update(kwargs)
-    return plot.plot_pdfs(board, **config_vars)
+    # Only measure the memory peak of every stage when it is reported, that resets the peak of the process
+    config_vars['reset_peak_rss'] = bool(report_path or trace_path or kwargs.get('profile_dir'))
+    result = plot.plot_board(board, progress_callback=print_progress, **config_vars)
+    plot.report_result(result, print_msg)
+    write_trace_files([result], report_path, trace_path, board=board_filepath, ini=str(configfile))
+    return result.success
+
+
+def cli_variants(board_filepath: str, configfiles: list, report_path: str = None, trace_path: str = None,
+                 **kwargs) -> bool:
+    """Plot one board with several ini files, layers shared by the variants are plotted once."""
+    import pcbnew
+    try:
+        from . import persistence, plot
+    except ImportError:
+        import persistence, plot
+
+    board = pcbnew.LoadBoard(board_filepath)
+    base_filename = os.path.splitext(os.path.basename(board_filepath))[0]
+    variants = []
+    assembly_files = []
+    for configfile in configfiles:
+        config_vars = persistence.Persistence(configfile).load()
+        config_vars.update(kwargs)
+        config_vars['reset_peak_rss'] = bool(report_path or trace_path or kwargs.get('profile_dir'))
+        # Variants writing the same assembly file get the name of their ini file appended
+        ext = config_vars.get('assembly_file_extension', '__Assembly')
+        assembly_file = (config_vars.get('output_path', 'plot'), base_filename + ext + ".pdf")
+        if assembly_file in assembly_files:
+            config_vars['assembly_file_output'] = f"{base_filename}{ext}_{Path(configfile).stem}.pdf"
+        assembly_files.append(assembly_file)
+        if config_vars.get('profile_dir'):
+            config_vars['profile_dir'] = os.path.join(config_vars['profile_dir'], f"{len(variants) + 1}-{Path(configfile).stem}")
+        variants.append(config_vars)
+
+    results = plot.plot_variants(board, variants, print_progress)
+    for configfile, result in zip(configfiles, results):
+        print(f"\n{Path(configfile).name}:")
+        plot.report_result(result, print_msg)
+    write_trace_files(results, report_path, trace_path, board=board_filepath, ini=[str(c) for c in configfiles])
+    return len(results) == len(variants) and all(result.success for result in results)
+
+
+def dry_run(board_filepath: str, configfiles: list, **kwargs) -> bool:
+    """Print the execution plan of every ini file with the predicted time, nothing is plotted."""
+    import pcbnew
+    try:
+        from . import costs, persistence, plan, plot
+    except ImportError:
+        import costs, persistence, plan, plot
+
+    board = pcbnew.LoadBoard(board_filepath)
+    cost_model = costs.CostModel.load()
+    for configfile in configfiles:
+        config_vars = persistence.Persistence(configfile).load()
+        config_vars.update(kwargs)
+        board_plan = plot.plan_board(board, **config_vars)
+        if len(configfiles) > 1:
+            print(f"\n{Path(configfile).name}:")
+        print(plan.format_plan(board_plan, plan.predicted_costs(board_plan, cost_model, board_filepath)))
+    return True
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description='Board2Pdf CLI.')
+    parser = argparse.ArgumentParser(description='Board2Pdf CLI.',
+                                     epilog='Use `board2pdf batch --help` to process several boards in one run.')
     parser.add_argument('kicad_pcb', type=shell_path(), help='.kicad_pcb file')
-    parser.add_argument('--ini', default=None, type=shell_path(False, False), required=False,
-                        help=f'Path to `board2pdf.config.ini` to use')
+    parser.add_argument('--ini', default=None, type=shell_path(False, False), required=False, action='append',
+                        help=f'Path to `board2pdf.config.ini` to use. Give it several times to create one assembly '
+                             f'pdf per ini file, layers used by several of them are only plotted once.')
     parser.add_argument('--log', default='NOTSET', choices=_log_levels.keys(), required=False,
                         help='Enables logging with given log-level')
     parser.add_argument('--merge', default=None, choices=_pdf_libs_merge, required=False,
                         help='PDF merge processor library')
     parser.add_argument('--colorize', default=None, choices=_pdf_libs_color, required=False,
                         help='PDF colorize processor library')
+    parser.add_argument('--crop', default=None, choices=_pdf_libs_crop, required=False,
+                        help='PDF crop processor library, used by the crop and scale methods of the templates')
     parser.add_argument('--ext', default=None, required=False,
                         help='File extension to use for the merged PDF. Default is `__Assembly`.')
     parser.add_argument('--output', default=None, required=False,
                         help='Output file name. Takes precedent over --ext argument if set.')
+    parser.add_argument('--report', default=None, type=shell_path(True, False), required=False,
+                        help='Write a JSON report with wall time, cpu time, bytes and peak RSS of every stage')
+    parser.add_argument('--trace', default=None, type=shell_path(True, False), required=False,
+                        help='Write the stages as a Chrome trace, to be opened in ui.perfetto.dev')
+    parser.add_argument('--profile', default=None, type=shell_path(True, False), required=False,
+                        help='Directory to write a cProfile .pstats file and collapsed stacks of every stage to, '
+                             'plus the top allocation sites of the stage using the most memory')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only replace the pages of changed templates in the assembly pdf of the last run, '
+                             'with an incremental save')
+    parser.add_argument('--max-memory', default=None, type=memory_size, required=False,
+                        help='Memory budget like 2G or 1500M. The pdf steps use less memory at the cost of speed, '
+                             'and the peak memory use is reported')
+    parser.add_argument('--resume', action='store_true',
+                        help='Keep the temp files in the output directory and skip the plot, colorize and merge '
+                             'steps finished by an earlier run that failed or was cancelled')
+    parser.add_argument('--minify', default=None, type=num_range(float, 0.0, 1.0), required=False, metavar='MM',
+                        help='Round the coordinates of the layer pdfs to this precision in mm, e.g. 0.005, and drop '
+                             'drawing operators without effect before merging')
+    parser.add_argument('--cull', action='store_true',
+                        help='Drop the drawings of opaque layers that are completely hidden by the opaque layers over '
+                             'them')
+    parser.add_argument('--rasterize-over', default=None, type=memory_size, required=False, metavar='SIZE',
+                        help='Render layers with more drawing data than this, like 20M, to an image in their color '
+                             'and transparency. The other layers stay vector drawings')
+    parser.add_argument('--rasterize-paths', default=None, type=num_range(int, 1, 10 ** 9), required=False,
+                        metavar='COUNT',
+                        help='Render layers with more painted paths than this, like 50000, to an image the same way')
+    parser.add_argument('--rasterize-dpi', default=None, type=num_range(int, 50, 1200), required=False,
+                        help='Resolution of the rasterized layers, default 300')
+    parser.add_argument('--dedup-text', action='store_true',
+                        help='Draw the glyphs of text and other shapes repeated in a layer only once and reuse them')
+    parser.add_argument('--image-dpi', default=None, type=num_range(int, 50, 1200), required=False,
+                        help='Store images like logos only once in the assembly pdf, downsample the ones drawn at a '
+                             'higher resolution to this one and recompress them')
+    parser.add_argument('--image-jobs', default=0, type=num_range(int, 0, 256), required=False,
+                        help='Processes optimizing the images, default one per cpu')
+    parser.add_argument('--linearize', action='store_true',
+                        help='Write the assembly pdf linearized (fast web view) with pikepdf, qpdf or PyMuPDF, so '
+                             'browsers show the first page while the rest is downloaded')
+    parser.add_argument('--reproducible', action='store_true',
+                        help='Write the same assembly pdf for the same board and settings, without the time in its '
+                             'dates and ID, and leave the last one untouched if it has the same content')
+    parser.add_argument('--panel', default=None, type=shell_path(), required=False, metavar='LAYOUT',
+                        help='Plot a panel: a JSON file with the offset and rotation of every copy of the board and '
+                             'an optional frame board with the rails. Every layer is plotted once and drawn at '
+                             'every copy')
+    parser.add_argument('--tiles', default=None, choices=['png', 'jpeg', 'webp'], required=False,
+                        help='Also write every template page as a deep zoom image (.dzi) with tiles in this format '
+                             'for web viewers. Only the tiles of changed parts of the pages are rendered again')
+    parser.add_argument('--tile-size', default=None, type=num_range(int, 64, 4096), required=False,
+                        help='Width and height of the tiles in pixels, default 256')
+    parser.add_argument('--tile-dpi', default=None, type=num_range(int, 50, 2400), required=False,
+                        help='Resolution of the most zoomed in tiles, default 600')
+    parser.add_argument('--tile-jobs', default=0, type=num_range(int, 0, 256), required=False,
+                        help='Processes rendering the tiles, default one per cpu')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the plot, colorize, merge, crop and concat steps with the predicted time and exit')
     parser.add_argument('--version', action='version', version=_version.__version__)
     return parser.parse_args()
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        try:
+            from . import batch
+        except ImportError:
+            import batch
+        sys.exit(batch.main(sys.argv[2:]))
+
     args = parse_args()
 
     pcb_path = args.kicad_pcb
@@ -90,43 +290,79 @@ def main():
         logging.basicConfig(filename=log_file, level=log_level)
         _logger.info(f'starting logging with level: {_log_levels[args.log]}')
 
-    # Check for the ini file specified with the --ini argument
-    # Terminate if the file is not found
-    # If no ini file is specified, look for an ini file in the pcb path, then the globally saved ini
-    # file, and last for the default ini file.
-    if args.ini:
-        ini_path = Path(args.ini).absolute()
-        if not ini_path.exists():
-            _logger.error(f'{ini_path=} specified with --ini argument not found, terminate')
-            print(f"Error: ini file `{args.ini}` specified with --ini argument not found.", sys.stderr)
+    if args.ini and len(args.ini) > 1:
+        if args.output:
+            print("Error: --output can't be used with several --ini files.", file=sys.stderr)
+            sys.exit(1)
+        ini_paths = [find_ini(pcb_path, ini) for ini in args.ini]
+        if None in ini_paths:
             sys.exit(1)
     else:
-        ini_path = Path(os.path.join(os.path.dirname(pcb_path), 'board2pdf.config.ini'))
-        if not ini_path.exists():
-            _logger.info(f'{ini_path=} not found, use global path')
-            ini_path = Path(__file__).parent / 'board2pdf.config.ini'
-            if not ini_path.exists():
-                _logger.info(f'{ini_path=} not found, use default path')
-                ini_path = Path(__file__).parent / 'default_config.ini'
-                if not ini_path.exists():
-                    _logger.error(f'{ini_path=} not found, terminate')
-                    print(f"Error: ini file `{args.ini}` not found.", sys.stderr)
-                    sys.exit(1)
+        ini_paths = [find_ini(pcb_path, args.ini[0] if args.ini else None)]
+        if ini_paths[0] is None:
+            sys.exit(1)
+    ini_path = ini_paths[0]
 
     _logger.info(f'{pcb_path=}')
-    _logger.info(f'{ini_path=}')
+    _logger.info(f'{ini_paths=}')
 
     optional = {}
     if args.colorize:
         optional['colorize_lib'] = args.colorize
     if args.merge:
         optional['merge_lib'] = args.merge
+    if args.crop:
+        optional['crop_lib'] = args.crop
     if args.ext:
         optional['assembly_file_extension'] = args.ext
     if args.output:
         optional['assembly_file_output'] = args.output
+    if args.incremental:
+        optional['incremental'] = True
+    if args.resume:
+        optional['resume'] = True
+    if args.max_memory:
+        optional['max_memory'] = args.max_memory
+    if args.minify is not None:
+        optional['minify_precision'] = args.minify
+    if args.cull:
+        optional['cull_hidden'] = True
+    if args.rasterize_over:
+        optional['rasterize_over'] = args.rasterize_over
+    if args.rasterize_paths:
+        optional['rasterize_paths'] = args.rasterize_paths
+    if args.rasterize_dpi:
+        optional['rasterize_dpi'] = args.rasterize_dpi
+    if args.dedup_text:
+        optional['dedup_text'] = True
+    if args.image_dpi:
+        optional['image_dpi'] = args.image_dpi
+    optional['image_jobs'] = args.image_jobs
+    if args.linearize:
+        optional['linearize'] = True
+    if args.reproducible:
+        optional['reproducible'] = True
+    if args.panel:
+        optional['panel_layout'] = args.panel
+    if args.tiles:
+        optional['tile_format'] = args.tiles
+    if args.tile_size:
+        optional['tile_size'] = args.tile_size
+    if args.tile_dpi:
+        optional['tile_dpi'] = args.tile_dpi
+    optional['tile_jobs'] = args.tile_jobs
+    if args.report:
+        optional['report_path'] = args.report
+    if args.trace:
+        optional['trace_path'] = args.trace
+    if args.profile:
+        optional['profile_dir'] = args.profile
     _logger.info(f'{optional=}')
 
+    if args.dry_run:
+        sys.exit(0 if dry_run(pcb_path, ini_paths, **optional) else 1)
+    if len(ini_paths) > 1:
+        sys.exit(0 if cli_variants(pcb_path, ini_paths, **optional) else 1)
     sys.exit(0 if cli(pcb_path, ini_path, **optional) else 1)
 
 
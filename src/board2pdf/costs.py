@@ -0,0 +1,210 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Seconds assumed for a step the board has no history for.
+DEFAULT_COSTS = {'plot': 1.0, 'simplify': 0.5, 'colorize': 0.5, 'colorize-transparency': 5.0, 'rasterize': 2.0, 'cull': 1.0, 'minify': 0.5,
+                 'dedup': 0.5, 'panel': 0.5, 'merge': 1.0, 'concat': 1.0, 'images': 1.0, 'reproducible': 0.5, 'linearize': 0.5,
+                 'svg': 0.5, 'tiles': 2.0, 'cleanup': 0.1}
+# The stages stored per board, the crop and scale stages are part of merge.
+STAGES = ('plot', 'simplify', 'rasterize', 'colorize', 'cull', 'minify', 'dedup', 'panel', 'merge', 'concat',
+          'images', 'reproducible', 'linearize', 'svg', 'tiles', 'cleanup')
+MAX_BOARDS = 500
+
+
+def cache_dir() -> str:
+    """The board2pdf directory in the user cache directory."""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'board2pdf')
+
+
+def default_path() -> str:
+    return os.path.join(cache_dir(), 'costs.json')
+
+
+def stage_key(stage: str, template: str = '', layer: str = '') -> str:
+    return f'{stage}|{template}|{layer}'
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f'{seconds}s'
+    return f'{seconds // 60}m {seconds % 60:02d}s'
+
+
+def _read(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return data.get('boards', {}) if isinstance(data, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        _logger.warning(f'unable to read the cost history {path=}', exc_info=True)
+        return {}
+
+
+class CostModel:
+    """Seconds measured for every stage of earlier runs, keyed by board, operation, template and layer.
+
+    A new measurement is blended into the stored value with weight `alpha` (exponentially weighted moving
+    average). Several processes can share the file, save() only writes the boards updated by this one.
+    """
+
+    def __init__(self, path: str = None, alpha: float = 0.5):
+        self.path: str | None = path  # None keeps the history in memory only
+        self.alpha: float = alpha
+        self.boards: dict[str, dict] = {}  # board path: {'stages': {stage_key: seconds}, 'total': seconds}
+        self._updated: set[str] = set()
+
+    @classmethod
+    def load(cls, path: str = None) -> 'CostModel':
+        model = cls(path or default_path())
+        model.boards = _read(model.path)
+        return model
+
+    def predict(self, board: str, stage: str, template: str = '', layer: str = '', default: float = None) -> float:
+        """Predicted seconds of a stage.
+
+        Without history for the exact stage, the same layer in another template of the board is used, then
+        the average of the operation on the board, and last `default` or DEFAULT_COSTS.
+        """
+        stages = self.boards.get(board, {}).get('stages', {})
+        cost = stages.get(stage_key(stage, template, layer))
+        if cost is not None:
+            return cost
+        for same_layer in (True, False):
+            if same_layer and not layer:
+                continue
+            costs = [c for key, c in stages.items()
+                     if key.split('|')[0] == stage and (not same_layer or key.split('|')[2] == layer)]
+            if costs:
+                return sum(costs) / len(costs)
+        return default if default is not None else DEFAULT_COSTS.get(stage, 1.0)
+
+    def predict_board(self, board: str) -> float:
+        """Predicted seconds of a whole run of `board`, boards without history get the average of the others."""
+        total = self.boards.get(board, {}).get('total')
+        if total is not None:
+            return total
+        totals = [entry['total'] for entry in self.boards.values() if 'total' in entry]
+        return sum(totals) / len(totals) if totals else 0.0
+
+    def predict_peak_rss(self, board: str) -> int | None:
+        """Peak resident set size in bytes of the last run of `board`, None without history."""
+        return self.boards.get(board, {}).get('peak_rss')
+
+    def has_history(self, board: str) -> bool:
+        return bool(self.boards.get(board, {}).get('stages'))
+
+    def update(self, board: str, spans: list, peak_rss: int = None):
+        """Blend the wall time of the tracing.Spans of a finished run of `board` into the history.
+
+        `peak_rss` is the peak resident set size of this run in bytes (PlotResult.peak_rss), not of the process,
+        a batch worker plots many boards. Without it the largest peak of the spans is used.
+        """
+        measured: dict[str, float] = {}
+        for span in spans:
+            if span.name in STAGES:
+                key = stage_key(span.name, span.template, span.layer)
+                measured[key] = measured.get(key, 0.0) + span.wall
+        if not measured:
+            return
+
+        entry = self.boards.setdefault(board, {})
+        stages = entry.setdefault('stages', {})
+        for key, seconds in measured.items():
+            stages[key] = self._blend(stages.get(key), seconds)
+        entry['total'] = self._blend(entry.get('total'), sum(measured.values()))
+        if peak_rss is None:
+            peak_rss = max((span.peak_rss for span in spans if span.peak_rss is not None), default=None)
+        if peak_rss is not None:
+            entry['peak_rss'] = peak_rss
+        entry['updated'] = time.time()
+        self._updated.add(board)
+
+    def _blend(self, old: float | None, new: float) -> float:
+        return new if old is None else self.alpha * new + (1 - self.alpha) * old
+
+    def save(self) -> bool:
+        if self.path is None or not self._updated:
+            return True
+        try:
+            boards = _read(self.path)
+            boards.update({board: self.boards[board] for board in self._updated})
+            if len(boards) > MAX_BOARDS:
+                recent = sorted(boards, key=lambda b: boards[b].get('updated', 0), reverse=True)[:MAX_BOARDS]
+                boards = {board: boards[board] for board in recent}
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': 1, 'boards': boards}, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            _logger.warning(f'unable to save the cost history {self.path=}', exc_info=True)
+            return False
+        self._updated.clear()
+        return True
+
+    def __repr__(self):
+        var_str = ', '.join(f"{key}: {value}" for key, value in vars(self).items())
+        return f'{self.__class__.__name__}:{{ {var_str} }}'
+
+
+class ProgressEstimate:
+    """Progress of a run weighted by the predicted cost of its steps, with the time left.
+
+    All steps are added first, step() is then called when a step starts and returns the progress.
+    """
+
+    def __init__(self, start: float = 5.0, end: float = 100.0):
+        self.start: float = start
+        self.end: float = end
+        self.costs: dict[str, float] = {}  # predicted seconds of every step, by stage_key
+        self._done: float = 0.0  # predicted seconds of the finished steps
+        self._current: str | None = None
+        self._started: float | None = None
+
+    def add(self, cost: float, stage: str, template: str = '', layer: str = ''):
+        self.costs[stage_key(stage, template, layer)] = cost
+
+    @property
+    def total(self) -> float:
+        return sum(self.costs.values())
+
+    def step(self, stage: str, template: str = '', layer: str = '') -> float:
+        if self._started is None:
+            self._started = time.perf_counter()
+        if self._current is not None:
+            self._done += self.costs.get(self._current, 0.0)
+        self._current = stage_key(stage, template, layer)
+        total = self.total
+        return self.start + (self.end - self.start) * (min(self._done / total, 1.0) if total else 0.0)
+
+    def remaining(self) -> float | None:
+        """Seconds left, the predictions scaled by how fast the finished steps were. None before that's known."""
+        if self._started is None or self._done <= 0.0:
+            return None
+        elapsed = time.perf_counter() - self._started
+        return max(self.total - self._done, 0.0) * elapsed / self._done
+
+    def with_eta(self, status: str) -> str:
+        remaining = self.remaining()
+        return status if remaining is None else f'{status} (about {format_duration(remaining)} left)'
+
+    def __repr__(self):
+        var_str = ', '.join(f"{key}: {value}" for key, value in vars(self).items())
+        return f'{self.__class__.__name__}:{{ {var_str} }}'
@@ -0,0 +1,932 @@
+"""Path geometry of pdf content streams as NumPy arrays.
+
+parse_paths() reads the path operators of a content stream (m, l, c, v, y, re, h and the painting operators)
+into a Paths object: the points of all segments in one float array, an op code per segment and per path the
+index of its style (colors, line width, paint operator) in a style table. The tokens are found and the numbers
+are converted by NumPy, and bbox, transform and filter work on the whole arrays, so there are no Python objects
+per segment. Text and images are not paths and are skipped.
+"""
+from __future__ import annotations
+import logging
+import re
+from typing import Callable, NamedTuple
+
+try:
+    import numpy as np
+    has_numpy = True
+except ImportError:
+    np = None
+    has_numpy = False
+
+_logger = logging.getLogger(__name__)
+
+# Segment op codes, with the number of points of each.
+MOVE, LINE, CURVE, RECT, CLOSE = range(5)
+SEGMENT_POINTS = (1, 1, 3, 4, 0)
+
+# Paint op codes, the operator ending a path.
+STROKE, CLOSE_STROKE, FILL, FILL_EVEN_ODD, FILL_STROKE, FILL_STROKE_EVEN_ODD, CLOSE_FILL_STROKE, \
+    CLOSE_FILL_STROKE_EVEN_ODD, NO_PAINT = range(9)
+PAINT_OPERATORS = (b'S', b's', b'f', b'f*', b'B', b'B*', b'b', b'b*', b'n')
+_filled = (False, False, True, True, True, True, True, True, False)
+_stroked = (True, True, False, False, True, True, True, True, False)
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+# Strings, hex strings, dictionaries, arrays, comments, names and inline images. Names are kept as an index in
+# a list, gs and Do need them. Strings with unescaped nested parentheses are not supported, KiCad escapes them.
+_skip = re.compile(rb'(?=[(<%\[\]{}/B])(?:\((?:\\.|[^\\()])*\)|<<|>>|<[0-9A-Fa-f\s]*>|%[^\r\n]*|[\[\]{}]|/[^\s/\[\]()<>{}%]*'
+                   rb'|\bBI\b.*?\bEI\b)', re.S)
+
+
+def _code(operator: bytes) -> int:
+    """Operators of up to three bytes as an int, the same as the vectorized encoding in _tokenize."""
+    code = 0
+    for i, byte in enumerate(operator):
+        code |= byte << (8 * i)
+    return code
+
+
+_m, _l, _c, _v, _y, _re, _h, _F = (_code(op) for op in (b'm', b'l', b'c', b'v', b'y', b're', b'h', b'F'))
+_paint_codes = {_code(op): paint for paint, op in enumerate(PAINT_OPERATORS)}
+_paint_codes[_F] = FILL
+_q, _Q, _cm, _w, _RG, _rg, _G, _g, _K, _k, _gs, _Do = (
+    _code(op) for op in (b'q', b'Q', b'cm', b'w', b'RG', b'rg', b'G', b'g', b'K', b'k', b'gs', b'Do'))
+_state_codes = (_q, _Q, _cm, _w, _RG, _rg, _G, _g, _K, _k, _gs, _Do)
+
+
+class Styles(NamedTuple):
+    stroke: 'np.ndarray'  # (styles, 3) rgb of the stroke color
+    fill: 'np.ndarray'  # (styles, 3) rgb of the fill color
+    width: 'np.ndarray'  # (styles,) line width in user space
+    paint: 'np.ndarray'  # (styles,) paint op code
+    gstate: list  # name of the graphics state set with gs, or None
+
+
+class Paths:
+    """Paths of a content stream in user space, in paint order.
+
+    Segment i has op code ops[i] and the points points[segment_points[i]:segment_points[i + 1]]. Path j has the
+    segments path_segments[j]:path_segments[j + 1] and the style path_style[j]. A RECT segment has the four
+    corners of the rectangle, v and y curves are stored as c curves.
+    """
+
+    def __init__(self, points, ops, segment_points, path_segments, path_style, styles: Styles):
+        self.points: np.ndarray = points  # (points, 2) float64
+        self.ops: np.ndarray = ops  # (segments,) uint8
+        self.segment_points: np.ndarray = segment_points  # (segments + 1,) offsets in points
+        self.path_segments: np.ndarray = path_segments  # (paths + 1,) offsets in ops
+        self.path_style: np.ndarray = path_style  # (paths,) index in styles
+        self.styles: Styles = styles
+
+    def __len__(self) -> int:
+        return len(self.path_style)
+
+    @property
+    def segment_count(self) -> int:
+        return len(self.ops)
+
+    @property
+    def path_points(self) -> 'np.ndarray':
+        """(paths + 1,) offsets of the points of each path."""
+        return self.segment_points[self.path_segments]
+
+    @property
+    def paint(self) -> 'np.ndarray':
+        return self.styles.paint[self.path_style]
+
+    @property
+    def filled(self) -> 'np.ndarray':
+        return np.asarray(_filled)[self.paint]
+
+    @property
+    def stroked(self) -> 'np.ndarray':
+        return np.asarray(_stroked)[self.paint]
+
+    @property
+    def width(self) -> 'np.ndarray':
+        return self.styles.width[self.path_style]
+
+    def path_bboxes(self, stroke: bool = True) -> 'np.ndarray':
+        """(paths, 4) x0, y0, x1, y1 of every path. Curves are bounded by their extremes, not their control
+        points. With `stroke` the half line width is added to stroked paths."""
+        if len(self) == 0:
+            return np.empty((0, 4))
+        offsets = self.path_points[:-1]
+        points = self.points
+        curves = np.flatnonzero(self.ops == CURVE)
+        if len(curves):
+            # The current point is the last point of the segment before the curve
+            start = self.segment_points[curves]
+            p0 = points[start - 1]
+            p1, p2, p3 = points[start], points[start + 1], points[start + 2]
+            # The control points are off the curve, its extremes are added below
+            points = points.copy()
+            points[start] = p3
+            points[start + 1] = p3
+
+        boxes = np.empty((len(self), 4))
+        boxes[:, 0:2] = np.minimum.reduceat(points, offsets, axis=0)
+        boxes[:, 2:4] = np.maximum.reduceat(points, offsets, axis=0)
+        if len(curves):
+            low, high = _curve_extremes(p0, p1, p2, p3)
+            path = np.searchsorted(self.path_segments, curves, side='right') - 1
+            np.minimum.at(boxes[:, 0:2], path, low)
+            np.maximum.at(boxes[:, 2:4], path, high)
+
+        if stroke:
+            half = np.where(self.stroked, self.width / 2, 0.0)
+            boxes += np.column_stack((-half, -half, half, half))
+        return boxes
+
+    def bbox(self, stroke: bool = True) -> tuple | None:
+        """x0, y0, x1, y1 of all paths, None without paths. Paths that aren't painted are left out."""
+        boxes = self.path_bboxes(stroke)[self.paint != NO_PAINT]
+        if len(boxes) == 0:
+            return None
+        return (float(boxes[:, 0].min()), float(boxes[:, 1].min()), float(boxes[:, 2].max()),
+                float(boxes[:, 3].max()))
+
+    def transform(self, matrix: tuple) -> 'Paths':
+        """The paths transformed by the pdf matrix (a, b, c, d, e, f), line widths are scaled along."""
+        a, b, c, d, e, f = matrix
+        points = self.points @ np.array([[a, b], [c, d]]) + np.array([e, f])
+        styles = self.styles._replace(width=self.styles.width * np.sqrt(abs(a * d - b * c)))
+        return Paths(points, self.ops, self.segment_points, self.path_segments, self.path_style, styles)
+
+    def filter(self, keep) -> 'Paths':
+        """The paths where the boolean array `keep` (one value per path) is true."""
+        keep = np.asarray(keep, dtype=bool)
+        segment_counts = np.diff(self.path_segments)[keep]
+        keep_segments = np.repeat(keep, np.diff(self.path_segments))
+        point_counts = np.diff(self.segment_points)
+        keep_points = np.repeat(keep_segments, point_counts)
+        return Paths(self.points[keep_points], self.ops[keep_segments],
+                     _offsets(point_counts[keep_segments]), _offsets(segment_counts), self.path_style[keep],
+                     self.styles)
+
+    @staticmethod
+    def concat(parts: list) -> 'Paths':
+        """One Paths with the paths of `parts` in order, the style tables are joined."""
+        parts = [part for part in parts if len(part)] or parts[:1]
+        if len(parts) == 1:
+            return parts[0]
+        style_offsets = np.cumsum([0] + [len(part.styles.paint) for part in parts])
+        styles = Styles(*(np.concatenate([getattr(part.styles, field) for part in parts])
+                          for field in ('stroke', 'fill', 'width', 'paint')),
+                        [name for part in parts for name in part.styles.gstate])
+        return Paths(np.concatenate([part.points for part in parts]),
+                     np.concatenate([part.ops for part in parts]),
+                     _offsets(np.concatenate([np.diff(part.segment_points) for part in parts])),
+                     _offsets(np.concatenate([np.diff(part.path_segments) for part in parts])),
+                     np.concatenate([part.path_style + offset for part, offset in zip(parts, style_offsets)]),
+                     styles)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self)} paths, {self.segment_count} segments, ' \
+               f'{len(self.styles.paint)} styles)'
+
+
+def _offsets(counts) -> 'np.ndarray':
+    return np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+
+
+def _curve_extremes(p0, p1, p2, p3) -> tuple:
+    """Lowest and highest point of cubic bezier curves, the arrays hold one point of each curve."""
+    # B'(t) / 3 = a t^2 + b t + c
+    a = -p0 + 3 * p1 - 3 * p2 + p3
+    b = 2 * (p0 - 2 * p1 + p2)
+    c = p1 - p0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = np.sqrt(b * b - 4 * a * c)
+        linear = np.abs(a) < 1e-12
+        t1 = np.where(linear, -c / b, (-b + root) / (2 * a))
+        t2 = np.where(linear, np.nan, (-b - root) / (2 * a))
+    low = np.minimum(p0, p3)
+    high = np.maximum(p0, p3)
+    for t in (t1, t2):
+        valid = (t > 0) & (t < 1)
+        t = np.where(valid, t, 0.0)
+        mt = 1 - t
+        point = mt ** 3 * p0 + 3 * mt * mt * t * p1 + 3 * mt * t * t * p2 + t ** 3 * p3
+        low = np.where(valid, np.minimum(low, point), low)
+        high = np.where(valid, np.maximum(high, point), high)
+    return low, high
+
+
+def _multiply(m1: tuple, m2: tuple) -> tuple:
+    """The pdf matrix m1 followed by m2."""
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1 * a2 + b1 * c2, a1 * b2 + b1 * d2, c1 * a2 + d1 * c2, c1 * b2 + d1 * d2,
+            e1 * a2 + f1 * c2 + e2, e1 * b2 + f1 * d2 + f2)
+
+
+_whitespace = None
+_number_start = None
+
+
+def _tables():
+    global _whitespace, _number_start
+    if _whitespace is None:
+        _whitespace = np.zeros(256, dtype=bool)
+        _whitespace[list(b' \t\r\n\f\x00')] = True
+        _number_start = np.zeros(256, dtype=bool)
+        _number_start[list(b'0123456789+-.')] = True
+    return _whitespace, _number_start
+
+
+def _tokenize(stream: bytes) -> tuple:
+    """Numbers, operator codes, the index in the numbers after the operands of each operator, and the names."""
+    names = []
+
+    def replace(match) -> bytes:
+        token = match.group()
+        if token[:1] == b'/':
+            names.append(token[1:])
+            return b' %d ' % (len(names) - 1)
+        return b' '
+
+    data = np.frombuffer(_skip.sub(replace, stream), dtype=np.uint8)
+    numbers, codes, operands_end = _scan(data)[:3]
+    return numbers, codes, operands_end, names
+
+
+def _scan(data) -> tuple:
+    """Numbers, operator codes, the index in the numbers after the operands of each operator, the offset after
+    each operator in `data` and the start and end offsets of the numbers."""
+    whitespace, number_start = _tables()
+    space = whitespace[data]
+    starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    ends = np.flatnonzero(~space & np.concatenate((space[1:], [True]))) + 1
+    is_number = number_start[data[starts]]
+
+    # Operators are blanked out and the numbers are converted in one go
+    marker = np.zeros(len(data), dtype=np.int64)
+    marker[starts] = 1
+    token = np.cumsum(marker) - 1
+    number_bytes = np.where(~space & is_number[np.maximum(token, 0)], data, ord(' ')).astype(np.uint8)
+    numbers = np.fromstring(number_bytes.tobytes(), dtype=np.float64, sep=' ') if is_number.any() else np.empty(0)
+    if len(numbers) != is_number.sum():
+        # A malformed number, e.g. 1.2.3, these are rare enough to take the slow way
+        numbers = np.array([float(t) if _is_float(t) else 0.0 for t in bytes(number_bytes).split()])
+
+    op_starts = starts[~is_number]
+    op_lengths = ends[~is_number] - op_starts
+    padded = np.concatenate((data, np.zeros(2, dtype=np.uint8))).astype(np.uint32)
+    codes = (padded[op_starts] | np.where(op_lengths > 1, padded[op_starts + 1], 0) << 8
+             | np.where(op_lengths > 2, padded[op_starts + 2], 0) << 16)
+    codes[op_lengths > 3] = 0
+    operands_end = np.cumsum(is_number)[~is_number]
+    return numbers, codes, operands_end, ends[~is_number], starts[is_number], ends[is_number]
+
+
+def _is_float(token: bytes) -> bool:
+    try:
+        float(token)
+    except ValueError:
+        return False
+    return True
+
+
+# A form xobject by name: its content stream, matrix and the resolver of its own resources.
+Resolver = Callable[[bytes], 'tuple[bytes, tuple, Resolver | None] | None']
+
+
+def parse_paths(stream: bytes, ctm: tuple = IDENTITY, resolve: Resolver = None) -> Paths:
+    """Paths of a content stream. `ctm` maps the stream to user space. Form xobjects painted with Do are
+    included when `resolve(name)` returns the stream, matrix and resolver of the form."""
+    if not has_numpy:
+        raise RuntimeError('geometry needs numpy')
+    # ctm, stroke, fill, line width, gs name
+    return _parse_paths(stream, (ctm, (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), 1.0, None), resolve)
+
+
+def _parse_paths(stream: bytes, state: tuple, resolve: Resolver | None) -> Paths:
+    numbers, codes, operands_end, names = _tokenize(stream)
+
+    # The graphics state is followed in order, but only at the operators that change it
+    is_state = np.isin(codes, _state_codes)
+    state_ops = np.flatnonzero(is_state)
+    stack = []
+    states = [state]
+    forms = []  # (operator index, Paths) of the Do operators
+    # The last six operands and the operand count of each state operator, as lists they are fast to index
+    end = operands_end[state_ops]
+    count = (end - np.concatenate(([0], operands_end))[state_ops]).tolist()
+    index = np.clip(end[:, None] - 6 + np.arange(6), 0, max(len(numbers) - 1, 0))
+    operands = (numbers[index] if len(numbers) else np.zeros(index.shape)).tolist()
+    for i, code, n, values in zip(state_ops.tolist(), codes[state_ops].tolist(), count, operands):
+        ctm_, stroke, fill, width, gstate = state
+        if code == _q:
+            stack.append(state)
+        elif code == _Q:
+            state = stack.pop() if stack else state
+        elif code == _cm and n >= 6:
+            state = (_multiply(tuple(values), ctm_), stroke, fill, width, gstate)
+        elif code == _w and n >= 1:
+            state = (ctm_, stroke, fill, values[-1], gstate)
+        elif code in (_RG, _rg) and n >= 3:
+            rgb = tuple(values[-3:])
+            state = (ctm_, rgb, fill, width, gstate) if code == _RG else (ctm_, stroke, rgb, width, gstate)
+        elif code in (_G, _g) and n >= 1:
+            rgb = (values[-1],) * 3
+            state = (ctm_, rgb, fill, width, gstate) if code == _G else (ctm_, stroke, rgb, width, gstate)
+        elif code in (_K, _k) and n >= 4:
+            c, m, y, k = values[-4:]
+            rgb = ((1 - c) * (1 - k), (1 - m) * (1 - k), (1 - y) * (1 - k))
+            state = (ctm_, rgb, fill, width, gstate) if code == _K else (ctm_, stroke, rgb, width, gstate)
+        elif code == _gs and n >= 1:
+            state = (ctm_, stroke, fill, width, names[int(values[-1])])
+        elif code == _Do and n >= 1 and resolve is not None:
+            form = resolve(names[int(values[-1])])
+            if form is not None:
+                # A form starts with the graphics state at its Do
+                form_stream, matrix, form_resolve = form
+                forms.append((i, _parse_paths(form_stream, (_multiply(matrix, ctm_), stroke, fill, width, gstate),
+                                              form_resolve)))
+        states.append(state)
+
+    # State of every operator: the state after the last state operator before it
+    state_of_op = np.cumsum(is_state)
+    unique_states = {}
+    state_ids = np.array([unique_states.setdefault(s, len(unique_states)) for s in states])
+    state_of_op = state_ids[state_of_op]
+    table = list(unique_states)
+
+    paths = _build_paths(numbers, codes, operands_end, state_of_op, table)
+    if not forms:
+        return paths
+
+    # The forms are painted between the paths painted before and after their Do
+    is_paint = np.isin(codes, list(_paint_codes))
+    parts = []
+    done = 0
+    painted_before = np.cumsum(is_paint)
+    for i, form_paths in forms:
+        count = int(painted_before[i])
+        parts += [paths.filter(_range_mask(len(paths), done, count)), form_paths]
+        done = count
+    parts.append(paths.filter(_range_mask(len(paths), done, len(paths))))
+    return Paths.concat(parts)
+
+
+def _range_mask(size: int, start: int, stop: int) -> 'np.ndarray':
+    mask = np.zeros(size, dtype=bool)
+    mask[min(start, size):min(stop, size)] = True
+    return mask
+
+
+def _build_paths(numbers, codes, operands_end, state_of_op, table: list) -> Paths:
+    is_paint = np.isin(codes, list(_paint_codes))
+    construction = np.isin(codes, (_m, _l, _c, _v, _y, _re, _h))
+    # Path number of every operator: the number of paint operators before it
+    path_of_op = np.cumsum(is_paint) - is_paint
+    paint_ops = np.flatnonzero(is_paint)
+    # Segments after the last paint operator are never painted
+    construction &= path_of_op < len(paint_ops)
+    seg = np.flatnonzero(construction)
+    seg_codes = codes[seg]
+
+    op = np.full(len(seg), LINE, dtype=np.uint8)
+    op[seg_codes == _m] = MOVE
+    op[np.isin(seg_codes, (_c, _v, _y))] = CURVE
+    op[seg_codes == _re] = RECT
+    op[seg_codes == _h] = CLOSE
+    counts = np.asarray(SEGMENT_POINTS)[op]
+    segment_points = _offsets(counts)
+    points = np.empty((int(segment_points[-1]), 2))
+    end = operands_end[seg]
+
+    def operands(mask, n) -> 'np.ndarray':
+        index = end[mask][:, None] - n + np.arange(n)
+        return numbers[np.clip(index, 0, max(len(numbers) - 1, 0))] if len(numbers) else np.zeros(index.shape)
+
+    for codes_, n in (((_m, _l), 2), ((_c,), 6)):
+        mask = np.isin(seg_codes, codes_)
+        values = operands(mask, n).reshape(-1, n // 2, 2)
+        index = segment_points[:-1][mask][:, None] + np.arange(n // 2)
+        points[index.ravel()] = values.reshape(-1, 2)
+    mask = seg_codes == _re
+    x, y, w, h = operands(mask, 4).T
+    start = segment_points[:-1][mask]
+    for k, corner in enumerate(((x, y), (x + w, y), (x + w, y + h), (x, y + h))):
+        points[start + k] = np.column_stack(corner)
+    for code_, first in ((_v, True), (_y, False)):
+        # v repeats the current point as first control point, y the end point as second one
+        mask = seg_codes == code_
+        values = operands(mask, 4).reshape(-1, 2, 2)
+        start = segment_points[:-1][mask]
+        if first:
+            points[start] = points[start - 1]
+            points[start + 1], points[start + 2] = values[:, 0], values[:, 1]
+        else:
+            points[start], points[start + 1], points[start + 2] = values[:, 0], values[:, 1], values[:, 1]
+
+    # Points to user space, per current transformation matrix
+    seg_state = state_of_op[seg]
+    point_state = np.repeat(seg_state, counts)
+    ctms = np.array([s[0] for s in table])
+    if len(points):
+        m = ctms[point_state]
+        x, y = points[:, 0].copy(), points[:, 1].copy()
+        points[:, 0] = x * m[:, 0] + y * m[:, 2] + m[:, 4]
+        points[:, 1] = x * m[:, 1] + y * m[:, 3] + m[:, 5]
+
+    # Paths with their style: colors, line width and gs of the state at the paint operator plus the paint op
+    path_of_seg = path_of_op[seg]
+    segment_counts = np.bincount(path_of_seg, minlength=len(paint_ops))
+    nonempty = segment_counts > 0
+    paint_state = state_of_op[paint_ops][nonempty]
+    paint = np.array([_paint_codes[c] for c in codes[paint_ops][nonempty].tolist()], dtype=np.uint8)
+    style_key = paint_state.astype(np.int64) * 16 + paint
+    keys, path_style = np.unique(style_key, return_inverse=True)
+    key_state = keys // 16
+    det = np.abs(ctms[key_state, 0] * ctms[key_state, 3] - ctms[key_state, 1] * ctms[key_state, 2])
+    styles = Styles(np.array([table[s][1] for s in key_state.tolist()]).reshape(-1, 3),
+                    np.array([table[s][2] for s in key_state.tolist()]).reshape(-1, 3),
+                    np.array([table[s][3] for s in key_state.tolist()], dtype=float) * np.sqrt(det),
+                    (keys % 16).astype(np.uint8),
+                    [table[s][4] for s in key_state.tolist()])
+    return Paths(points, op, segment_points, _offsets(segment_counts[nonempty]), path_style.astype(np.int64), styles)
+
+
+def _pdf_matrix(value: str) -> tuple:
+    numbers = value.strip('[] ').split()
+    return tuple(float(n) for n in numbers) if len(numbers) == 6 else IDENTITY
+
+
+def pymupdf_resolver(doc, xref: int) -> Resolver:
+    """Resolver of the form xobjects in the resources of the page or form `xref` of a pymupdf Document."""
+
+    def resolve(name: bytes):
+        kind, value = doc.xref_get_key(xref, f"Resources/XObject/{name.decode('latin-1')}")
+        if kind != 'xref':
+            return None
+        form = int(value.split()[0])
+        if doc.xref_get_key(form, 'Subtype')[1] != '/Form':
+            return None
+        return doc.xref_stream(form), _pdf_matrix(doc.xref_get_key(form, 'Matrix')[1]), pymupdf_resolver(doc, form)
+
+    return resolve
+
+
+def page_paths(doc, page_number: int = 0) -> Paths:
+    """Paths of a page of a pymupdf Document in pdf user space (y up), forms included."""
+    page = doc[page_number]
+    return parse_paths(page.read_contents(), IDENTITY, pymupdf_resolver(doc, page.xref))
+
+
+def paint_count(stream: bytes) -> int:
+    """Number of paint operators in a content stream, the paths it paints."""
+    if not has_numpy:
+        raise RuntimeError('geometry needs numpy')
+    codes = _scan(np.frombuffer(_skip.sub(_blank, stream), dtype=np.uint8))[1]
+    return int(np.isin(codes, list(_paint_codes)).sum())
+
+
+def simplify_polylines(points, offsets, tolerance) -> 'np.ndarray':
+    """Douglas-Peucker on many polylines at once, returns the mask of the points to keep.
+
+    Polyline i has the points points[offsets[i]:offsets[i + 1]], `tolerance` is one distance or one per polyline.
+    The first and last point of every polyline are kept, collinear and duplicate points are dropped. All
+    polylines are split in the same loop, so it runs once per level of the recursion, not once per split.
+    """
+    points = np.asarray(points, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    keep = np.zeros(len(points), dtype=bool)
+    first, last = offsets[:-1], offsets[1:] - 1
+    nonempty = last >= first
+    keep[first[nonempty]] = True
+    keep[last[nonempty]] = True
+
+    tolerance = np.broadcast_to(np.asarray(tolerance, dtype=float), first.shape)
+    split = last - first > 1
+    start, end, tol = first[split], last[split], tolerance[split]
+    while len(start):
+        counts = end - start - 1
+        bounds = _offsets(counts)[:-1]
+        part = np.repeat(np.arange(len(start)), counts)
+        index = np.arange(int(counts.sum())) - bounds[part] + start[part] + 1
+        distance = _segment_distance(points[index], points[start][part], points[end][part])
+
+        farthest = np.maximum.reduceat(distance, bounds)
+        # The first point at the largest distance of every part
+        candidates = np.flatnonzero(distance == farthest[part])
+        candidates = candidates[np.flatnonzero(np.diff(part[candidates], prepend=-1))]
+        far = index[candidates]
+
+        split = farthest > tol
+        keep[far[split]] = True
+        start = np.concatenate((start[split], far[split]))
+        end = np.concatenate((far[split], end[split]))
+        tol = np.concatenate((tol[split], tol[split]))
+        more = end - start > 1
+        start, end, tol = start[more], end[more], tol[more]
+    return keep
+
+
+def _segment_distance(p, a, b) -> 'np.ndarray':
+    """Distance of the points p to the segments a-b, a point when a and b are the same."""
+    ab = b - a
+    length = np.einsum('ij,ij->i', ab, ab)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(length > 0, np.einsum('ij,ij->i', p - a, ab) / length, 0.0)
+    closest = a + np.clip(t, 0.0, 1.0)[:, None] * ab
+    return np.hypot(*(p - closest).T)
+
+
+def _blank(match) -> bytes:
+    return b' ' * len(match.group())
+
+
+def simplify_stream(stream: bytes, tolerance: float, min_points: int = 8) -> tuple[bytes, int, int]:
+    """Drop the vertices of the polylines (m followed by l operators) of a content stream that are closer than
+    `tolerance` in pdf points to the simplified line, with simplify_polylines.
+
+    Only polylines of at least `min_points` are changed, the kept vertices are copied byte for byte. Returns the
+    new stream and the number of vertices of the changed polylines before and after.
+    """
+    if not has_numpy:
+        raise RuntimeError('geometry needs numpy')
+    # Strings, names, arrays etc. are blanked, so the offsets of the tokens are offsets in `stream`
+    data = np.frombuffer(_skip.sub(_blank, stream), dtype=np.uint8)
+    numbers, codes, operands_end, op_ends = _scan(data)[:4]
+    operand_count = np.diff(operands_end, prepend=0)
+
+    # A polyline is a moveto followed by linetos, each with two operands
+    vertex = np.isin(codes, (_m, _l)) & (operand_count == 2)
+    is_move = vertex & (codes == _m)
+    is_line = vertex & (codes == _l)
+    # Every operator that doesn't continue a polyline starts a group, polylines are the groups starting with m
+    group = np.cumsum(~is_line) - 1
+    group_is_run = is_move[np.flatnonzero(~is_line)]
+    in_run = vertex & group_is_run[group]
+    ops = np.flatnonzero(in_run)
+    counts = np.bincount(group[ops], minlength=len(group_is_run))[group_is_run]
+    large = counts >= min_points
+    if not large.any():
+        return stream, 0, 0
+
+    run_scale = _ctm_scale(numbers, codes, operands_end, ops[_offsets(counts)[:-1]])
+    # In a zero area transformation there is nothing to simplify
+    run_tolerance = np.where(run_scale > 0, tolerance / np.maximum(run_scale, 1e-12), 0.0)
+
+    index = operands_end[ops][:, None] - 2 + np.arange(2)
+    points = numbers[index]
+    keep = np.ones(len(points), dtype=bool)
+    in_large = np.repeat(large, counts)
+    keep[in_large] = simplify_polylines(points[in_large], _offsets(counts[large]), run_tolerance[large])
+
+    # A dropped vertex is the bytes after the operator before it up to its own operator. The first vertex of a
+    # polyline is always kept.
+    dropped = np.flatnonzero(~keep)
+    kept_bytes = ~_span_mask(len(data), op_ends[ops[dropped] - 1], op_ends[ops[dropped]])
+    return (np.frombuffer(stream, dtype=np.uint8)[kept_bytes].tobytes(), int(counts[large].sum()),
+            int(counts[large].sum() - len(dropped)))
+
+
+def _ctm_scale(numbers, codes, operands_end, at) -> 'np.ndarray':
+    """The scale (square root of the determinant) of the transformation in effect at the operators `at`. q, Q and
+    cm are rare enough for a loop."""
+    scale = 1.0
+    stack = []
+    state_ops = np.flatnonzero(np.isin(codes, (_q, _Q, _cm)))
+    operand_count = np.diff(operands_end, prepend=0)
+    scales = np.ones(len(state_ops) + 1)
+    for k, (i, code) in enumerate(zip(state_ops.tolist(), codes[state_ops].tolist())):
+        if code == _q:
+            stack.append(scale)
+        elif code == _Q:
+            scale = stack.pop() if stack else scale
+        elif operand_count[i] >= 6:
+            a, b, c, d = numbers[operands_end[i] - 6:operands_end[i] - 2].tolist()
+            scale *= abs(a * d - b * c) ** 0.5
+        scales[k + 1] = scale
+    return scales[np.searchsorted(state_ops, at)]
+
+
+def _span_mask(size: int, starts, ends) -> 'np.ndarray':
+    """Mask of the bytes in any of the spans starts[i]:ends[i]."""
+    depth = np.zeros(size + 1, dtype=np.int64)
+    np.add.at(depth, starts, 1)
+    np.add.at(depth, ends, -1)
+    return np.cumsum(depth[:-1]) > 0
+
+
+_S, _J, _j, _M, _cs, _CS, _sc, _SC, _scn, _SCN = (
+    _code(op) for op in (b'S', b'J', b'j', b'M', b'cs', b'CS', b'sc', b'SC', b'scn', b'SCN'))
+# Graphics state operators minify_stream keeps track of: (index in the state, number of operands)
+_tracked = {_w: (0, 1), _J: (1, 1), _j: (2, 1), _M: (3, 1), _RG: (4, 3), _G: (4, 1), _K: (4, 4), _rg: (5, 3),
+            _g: (5, 1), _k: (5, 4)}
+_mergeable = {_code(op) for op in (b'S', b'f', b'F', b'f*', b'B', b'B*')}
+_coordinate_codes = (_m, _l, _c, _v, _y, _re, _w)
+_color_codes = (_RG, _rg, _G, _g, _K, _k)
+
+
+def _format_number(value: float, decimals: int) -> bytes:
+    text = b'%.*f' % (decimals, value)
+    if decimals:
+        text = text.rstrip(b'0').rstrip(b'.')
+    return b'0' if text == b'-0' else text
+
+
+def minify_stream(stream: bytes, precision: float) -> bytes:
+    """A smaller content stream that paints the same.
+
+    Coordinates and line widths are rounded to the fewest decimals keeping them within `precision` pdf points,
+    colors to 3 decimals. Line width, cap, join, miter limit and color operators setting what is already set, or
+    set again before anything is painted, are dropped. Paths painted one after the other with the same state get one paint operator: always for strokes,
+    for fills only if their bounding boxes don't touch, as overlapping fills could change the winding. Streams
+    with an ExtGState (transparency) aren't merged.
+    """
+    if not has_numpy:
+        raise RuntimeError('geometry needs numpy')
+    data = np.frombuffer(_skip.sub(_blank, stream), dtype=np.uint8)
+    numbers, codes, operands_end, op_ends, number_starts, number_ends = _scan(data)
+    if not len(codes):
+        return stream
+    operand_count = np.diff(operands_end, prepend=0)
+    # The operator the number is an operand of, numbers after the last operator have none
+    op_of_number = np.searchsorted(operands_end, np.arange(len(numbers)), side='right')
+    has_op = op_of_number < len(codes)
+    op_of_number = np.minimum(op_of_number, len(codes) - 1)
+
+    # Decimals of the numbers, -1 for numbers that are kept
+    scale = _ctm_scale(numbers, codes, operands_end, np.arange(len(codes)))
+    with np.errstate(divide='ignore'):
+        coordinate_decimals = np.clip(np.ceil(np.log10(0.5 * scale / precision)), 0, 6)
+    op_decimals = np.full(len(codes), -1, dtype=np.int64)
+    is_coordinate = np.isin(codes, _coordinate_codes)
+    op_decimals[is_coordinate] = coordinate_decimals[is_coordinate]
+    op_decimals[np.isin(codes, _color_codes)] = 3
+    decimals = np.where(has_op, op_decimals[op_of_number], -1)
+    factor = 10.0 ** np.maximum(decimals, 0)
+    values = np.where(decimals >= 0, np.round(numbers * factor) / factor, numbers)
+
+    dots = np.flatnonzero(data == ord('.'))
+    dot = np.minimum(np.searchsorted(dots, number_starts), max(len(dots) - 1, 0))
+    has_dot = (dot < len(dots)) & (dots[dot] < number_ends) if len(dots) else np.zeros(len(numbers), dtype=bool)
+    text_decimals = np.where(has_dot, number_ends - dots[dot] - 1, 0) if len(dots) else np.zeros(len(numbers))
+    rounded = np.flatnonzero((decimals >= 0) & (text_decimals > decimals))
+
+    # Bounding box of the coordinates of every path, curves by their control points
+    is_paint = np.isin(codes, list(_paint_codes))
+    paint_ops = np.flatnonzero(is_paint)
+    path_of_op = np.cumsum(is_paint) - is_paint
+    merge = not (codes == _gs).any()
+    boxes = []
+    if merge:
+        low = np.full((len(paint_ops) + 1, 2), np.inf)
+        high = np.full((len(paint_ops) + 1, 2), -np.inf)
+        number_op = codes[op_of_number]
+        operand = np.arange(len(numbers)) - (operands_end[op_of_number] - operand_count[op_of_number])
+        pair = np.flatnonzero(has_op & np.isin(number_op, (_m, _l, _c, _v, _y, _re)) & (operand % 2 == 0)
+                              & (np.arange(len(numbers)) + 1 < operands_end[op_of_number]))
+        points = np.column_stack((numbers[pair], numbers[pair + 1]))
+        # The second pair of re is the size, the pair before it the corner
+        size = np.flatnonzero((number_op[pair] == _re) & (operand[pair] == 2))
+        points[size] += points[size - 1]
+        path = path_of_op[op_of_number[pair]]
+        np.minimum.at(low, path, points)
+        np.maximum.at(high, path, points)
+        widths = numbers[operands_end[codes == _w] - 1] if (codes == _w).any() else np.zeros(1)
+        half = float(np.max(np.abs(widths))) / 2 if len(widths) else 0.0
+        boxes = np.column_stack((low - half, high + half)).tolist()
+
+    # Redundant state and paint operators to drop, in paint order
+    interesting = np.flatnonzero(~np.isin(codes, (_m, _l, _c, _v, _y, _re, _h)))
+    index = np.clip(operands_end[interesting][:, None] - 4 + np.arange(4), 0, max(len(numbers) - 1, 0))
+    operands = (values[index] if len(numbers) else np.zeros(index.shape)).tolist()
+    dropped = []
+    state = [None] * 6
+    unused = [-1] * 6  # the operator setting each part of the state if nothing was painted with it yet
+    stack = []
+    clean = False
+    last_code = None
+    last_paint = -1
+    path = 0
+    group = None
+    for i, code, n, last in zip(interesting.tolist(), codes[interesting].tolist(),
+                                operand_count[interesting].tolist(), operands):
+        if code in _paint_codes:
+            box = boxes[path] if merge else None
+            if merge and clean and code == last_code and code in _mergeable and (
+                    code == _S or box[0] > group[2] or box[2] < group[0] or box[1] > group[3] or box[3] < group[1]):
+                dropped.append(last_paint)
+                group = [min(group[0], box[0]), min(group[1], box[1]), max(group[2], box[2]), max(group[3], box[3])]
+            else:
+                group = box
+            last_code, last_paint, clean = code, i, True
+            unused = [-1] * 6
+            path += 1
+            continue
+        tracked = _tracked.get(code)
+        if tracked is not None and n >= tracked[1]:
+            value = (code, tuple(last[4 - tracked[1]:]))
+            if state[tracked[0]] == value:
+                dropped.append(i)
+                continue
+            if unused[tracked[0]] >= 0:
+                dropped.append(unused[tracked[0]])
+            state[tracked[0]] = value
+            unused[tracked[0]] = i
+            clean = False
+            continue
+        # Anything else could use the state
+        unused = [-1] * 6
+        if code == _q:
+            stack.append(list(state))
+        elif code == _Q:
+            state = stack.pop() if stack else state
+        elif code == _gs:
+            state[0:4] = [None] * 4
+        elif code in (_CS, _SC, _SCN):
+            state[4] = None
+        elif code in (_cs, _sc, _scn):
+            state[5] = None
+        clean = False
+
+    # Rounded numbers are written over the old ones, the rest of them and the dropped operators are removed
+    dropped = np.array(dropped, dtype=np.int64)
+    op_starts = np.concatenate(([0], op_ends[:-1]))
+    integers = decimals[rounded] == 0
+    texts = np.empty(len(rounded), dtype=object)
+    if integers.any():
+        # Most coordinates end up as integers, which str() formats much faster
+        texts[integers] = ' '.join(map(str, np.rint(values[rounded[integers]]).astype(np.int64).tolist())
+                                   ).encode().split()
+    texts[~integers] = [_format_number(value, d) for value, d in zip(values[rounded[~integers]].tolist(),
+                                                                     decimals[rounded[~integers]].tolist())]
+    texts = texts.tolist()
+    out = bytearray(stream)
+    for start, text in zip(number_starts[rounded].tolist(), texts):
+        out[start:start + len(text)] = text
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    removed = (_span_mask(len(data), op_starts[dropped], op_ends[dropped])
+               | _span_mask(len(data), number_starts[rounded] + lengths, number_ends[rounded]))
+    return np.frombuffer(out, dtype=np.uint8)[~removed].tobytes()
+
+
+def opaque_pixels(samples: bytes, width: int, height: int, channels: int) -> 'np.ndarray':
+    """(height, width) mask of the fully opaque pixels of interleaved samples with the alpha last, like the samples
+    of a pymupdf Pixmap with alpha."""
+    return np.frombuffer(samples, dtype=np.uint8).reshape(height, width, channels)[..., -1] == 255
+
+
+def cull_stream(stream: bytes, ctm: tuple, covered) -> tuple[bytes, int, int]:
+    """Drop the paths of a content stream that are hidden by what is painted over it.
+
+    `ctm` maps the stream to the pixels of the boolean array `covered` (rows are y), which is true where the
+    pixel is fully covered by opaque content painted later. A path is dropped when every pixel of its bounding
+    box plus one pixel is covered. Stroked paths get their full line width around them, in case of miter joins.
+    Clipping paths and paths sharing operators with anything else are kept. Returns the new stream, the number
+    of painted paths and the number of dropped paths.
+    """
+    if not has_numpy:
+        raise RuntimeError('geometry needs numpy')
+    data = np.frombuffer(_skip.sub(_blank, stream), dtype=np.uint8)
+    codes, op_ends = _scan(data)[1:4:2]
+    paths = parse_paths(stream, ctm)
+    if not len(paths):
+        return stream, 0, 0
+
+    # The paint operators of the paths, and the last other operator before each of them
+    is_paint = np.isin(codes, list(_paint_codes))
+    construction = np.isin(codes, (_m, _l, _c, _v, _y, _re, _h))
+    ops = np.arange(len(codes))
+    paint_ops = np.flatnonzero(is_paint)
+    constructed = np.cumsum(construction)
+    previous_paint = np.concatenate(([-1], paint_ops[:-1]))
+    segments = constructed[paint_ops] - np.where(previous_paint >= 0, constructed[previous_paint], 0)
+    # Paint operators without segments have no path in `paths`
+    paint_ops, previous_paint = paint_ops[segments > 0], previous_paint[segments > 0]
+    last_other = np.maximum.accumulate(np.where(construction, -1, ops))[paint_ops - 1]
+    # Nothing but path construction may lie between the first segment of the path and its paint operator
+    separate = (last_other < 0) | (constructed[np.maximum(last_other, 0)] == np.where(
+        previous_paint >= 0, constructed[previous_paint], 0))
+
+    boxes = paths.path_bboxes()
+    half = np.where(paths.stroked, paths.width / 2, 0.0)
+    boxes += np.column_stack((-half, -half, half, half))
+    height, width = covered.shape
+    with np.errstate(invalid='ignore'):
+        x0, y0 = np.floor(boxes[:, 0]) - 1, np.floor(boxes[:, 1]) - 1
+        x1, y1 = np.ceil(boxes[:, 2]) + 1, np.ceil(boxes[:, 3]) + 1
+        inside = np.isfinite(boxes).all(axis=1) & (x0 >= 0) & (y0 >= 0) & (x1 <= width) & (y1 <= height)
+    x0, y0, x1, y1 = (np.where(inside, v, 0).astype(np.int64) for v in (x0, y0, x1, y1))
+    # Uncovered pixels in each box from the summed area table
+    table = np.zeros((height + 1, width + 1), dtype=np.int64)
+    table[1:, 1:] = np.cumsum(np.cumsum(~covered, axis=0), axis=1)
+    uncovered = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    hidden = np.flatnonzero(inside & (uncovered == 0) & separate & (paths.paint != NO_PAINT))
+    if not len(hidden):
+        return stream, len(paths), 0
+
+    starts = np.where(last_other[hidden] >= 0, op_ends[np.maximum(last_other[hidden], 0)], 0)
+    kept = ~_span_mask(len(data), starts, op_ends[paint_ops[hidden]])
+    return np.frombuffer(stream, dtype=np.uint8)[kept].tobytes(), len(paths), len(hidden)
+
+
+def dedup_strokes(stream: bytes, tolerance: float, name: bytes, min_saving: int = 256) -> tuple[bytes, list, int]:
+    """Draw repeated stroked shapes, like the stroke font glyphs KiCad plots text with, once as a form xobject.
+
+    A shape is a chain of stroked polylines (m and l operators followed by S) painted one after the other, that
+    touch each other. Shapes the same after moving them to their first point, within `tolerance` pdf points,
+    are one form named `name` + number, painted with `q 1 0 0 1 x y cm /name Do Q`. Only shapes saving
+    `min_saving` bytes in total are replaced. Returns the new stream, the content and bbox of every form, and the
+    number of shapes replaced.
+    """
+    if not has_numpy:
+        raise RuntimeError('geometry needs numpy')
+    data = np.frombuffer(_skip.sub(_blank, stream), dtype=np.uint8)
+    numbers, codes, operands_end, op_ends, number_starts, number_ends = _scan(data)
+    operand_count = np.diff(operands_end, prepend=0)
+    vertex = np.isin(codes, (_m, _l)) & (operand_count == 2)
+
+    # A polyline is the vertices between two other operators, starting with m and ending with S. The operator
+    # before it may not continue the path, like re or h.
+    others = np.flatnonzero(~vertex)
+    before = np.concatenate(([-1], others[:-1]))
+    first = before + 1
+    valid = ((codes[others] == _S) & (others - first >= 2) & (codes[np.minimum(first, len(codes) - 1)] == _m)
+             & ((before < 0) | ~np.isin(codes[np.maximum(before, 0)], (_m, _l, _c, _v, _y, _re, _h))))
+    paint, first = others[valid], first[valid]
+    if len(paint) < 2:
+        return stream, [], 0
+
+    counts = paint - first
+    ops = np.concatenate([np.arange(a, b) for a, b in zip(first.tolist(), paint.tolist())])
+    index = operands_end[ops][:, None] - 2 + np.arange(2)
+    points = numbers[index]
+    offsets = _offsets(counts)
+    low = np.minimum.reduceat(points, offsets[:-1], axis=0)
+    high = np.maximum.reduceat(points, offsets[:-1], axis=0)
+
+    # Polylines painted right after each other and touching are one shape
+    follows = np.concatenate(([False], first[1:] == paint[:-1] + 1))
+    shape_first = []
+    box = None
+    for k, (lo, hi, chained) in enumerate(zip(low.tolist(), high.tolist(), follows.tolist())):
+        if chained and lo[0] <= box[2] and hi[0] >= box[0] and lo[1] <= box[3] and hi[1] >= box[1]:
+            box = [min(box[0], lo[0]), min(box[1], lo[1]), max(box[2], hi[0]), max(box[3], hi[1])]
+        else:
+            shape_first.append(k)
+            box = [lo[0], lo[1], hi[0], hi[1]]
+    shape_first = np.array(shape_first)
+    shape_last = np.concatenate((shape_first[1:], [len(paint)])) - 1
+    shape_of_line = np.repeat(np.arange(len(shape_first)), np.diff(np.concatenate((shape_first, [len(paint)]))))
+
+    # The points relative to the first point of their shape, on a grid of `tolerance` in stream units
+    scale = _ctm_scale(numbers, codes, operands_end, first[shape_first])
+    grid = tolerance / np.where(scale > 0, scale, 1.0)
+    origin = points[offsets[:-1][shape_first]]
+    point_shape = np.repeat(shape_of_line, counts)
+    relative = np.rint((points - origin[point_shape]) / grid[point_shape][:, None]).astype(np.int64)
+
+    shapes = {}
+    point_offsets = offsets[np.concatenate((shape_first, [len(paint)]))]
+    for s, (a, b) in enumerate(zip(point_offsets[:-1].tolist(), point_offsets[1:].tolist())):
+        key = (float(grid[s]), counts[shape_first[s]:shape_last[s] + 1].tobytes(), relative[a:b].tobytes())
+        shapes.setdefault(key, []).append(s)
+
+    # The bytes of a shape start after the operator before its first m and end after its last S
+    start = np.where(first[shape_first] > 0, op_ends[np.maximum(first[shape_first] - 1, 0)], 0)
+    end = op_ends[paint[shape_last]]
+    widths = numbers[operands_end[codes == _w] - 1] if (codes == _w).any() else np.zeros(0)
+    margin = 10 * max(float(np.max(np.abs(widths))) if len(widths) else 0.0, 1.0)
+    forms = []
+    replaced = []  # (start, end, form number, shape)
+    for (grid_size, line_counts, _), members in shapes.items():
+        call_size = 30 + len(name)
+        if len(members) < 2 or sum(int(end[s] - start[s]) - call_size for s in members) < min_saving:
+            continue
+        s = members[0]
+        decimals = max(0, int(np.ceil(-np.log10(grid_size))))
+        shape_points = relative[point_offsets[s]:point_offsets[s + 1]] * grid_size
+        content = bytearray()
+        at = 0
+        for count in np.frombuffer(line_counts, dtype=counts.dtype).tolist():
+            for v, (x, y) in enumerate(shape_points[at:at + count].tolist()):
+                content += b'%b %b %b\n' % (_format_number(x, decimals), _format_number(y, decimals),
+                                            b'l' if v else b'm')
+            content += b'S\n'
+            at += count
+        low, high = shape_points.min(axis=0), shape_points.max(axis=0)
+        forms.append((bytes(content), (float(low[0]) - margin, float(low[1]) - margin, float(high[0]) + margin,
+                                       float(high[1]) + margin)))
+        replaced += [(int(start[m]), int(end[m]), len(forms) - 1, m) for m in members]
+    if not replaced:
+        return stream, [], 0
+
+    # The origin of every shape is written as it is in the stream
+    replaced.sort()
+    origin_number = operands_end[first[shape_first]] - 2
+    out = bytearray()
+    done = 0
+    for a, b, form, s in replaced:
+        x, y = (stream[number_starts[n]:number_ends[n]] for n in (origin_number[s], origin_number[s] + 1))
+        out += stream[done:a] + b'\nq 1 0 0 1 %b %b cm /%b%d Do Q' % (x, y, name, form)
+        done = b
+    out += stream[done:]
+    return bytes(out), forms, len(replaced)
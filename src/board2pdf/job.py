@@ -0,0 +1,180 @@
+from __future__ import annotations
+import asyncio
+import logging
+import queue
+import threading
+import traceback
+from typing import Callable, NamedTuple
+
+try:
+    from . import plot
+except ImportError:
+    import plot
+
+_logger = logging.getLogger(__name__)
+
+
+class ProgressEvent(NamedTuple):
+    progress: int
+    status: str
+
+
+class MessageEvent(NamedTuple):
+    text: str
+    caption: str
+    flags: int
+
+
+def _call_directly(fn: Callable, *args):
+    fn(*args)
+
+
+class PlotJob:
+    """Runs plot.plot_board on a worker thread.
+
+    Every progress update and message box is put on `events` as a ProgressEvent or MessageEvent, the queue
+    ends with None when the job is done. The `on_progress`, `on_message` and `on_done` callbacks are called
+    through `dispatch`, which is wx.CallAfter for the dialog so the widgets are only touched on the main thread.
+    `on_done` and `result` get the plot.PlotResult of the run.
+
+    The board must not be modified while the job is running.
+    """
+
+    def __init__(self, board, config_vars: dict, on_progress: Callable = None, on_message: Callable = None,
+                 on_done: Callable = None, dispatch: Callable = None):
+        self.board = board
+        self.config_vars: dict = dict(config_vars)
+        self.on_progress = on_progress
+        self.on_message = on_message
+        self.on_done = on_done
+        self.dispatch: Callable = dispatch or _call_directly
+
+        self.cancel_token = plot.CancelToken()
+        self.events: queue.Queue = queue.Queue()
+        self.result: plot.PlotResult | None = None
+        self._thread: threading.Thread | None = None
+
+    @classmethod
+    def for_dialog(cls, dlg, board, config_vars: dict, on_done: Callable = None):
+        """Create a job reporting to the plugin dialog. Must be called on the wx main thread."""
+        import wx
+
+        config_vars = dict(config_vars)
+        # Read the library selection here, the worker thread must not touch the widgets.
+        config_vars['colorize_lib'] = 'pymupdf' if dlg.m_radio_pymupdf.GetValue() else 'pypdf'
+        config_vars['merge_lib'] = 'pymupdf' if dlg.m_radio_merge_pymupdf.GetValue() else 'pypdf'
+
+        def on_progress(progress: int, status: str):
+            dlg.m_staticText_status.SetLabel(f'Status: {status}')
+            dlg.m_progress.SetValue(int(progress))
+
+        def on_message(text: str, caption: str, flags: int):
+            wx.MessageBox(text, caption, flags)
+
+        return cls(board, config_vars, on_progress, on_message, on_done, dispatch=wx.CallAfter)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.cancelled
+
+    def start(self):
+        if self._thread is not None:
+            raise RuntimeError("PlotJob can only be started once")
+        self._thread = threading.Thread(target=self._run, name='board2pdf-plot', daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        """Ask the job to stop, it stops at the next layer or stage and removes its temp files."""
+        self.cancel_token.cancel()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait for the job to finish, returns False if `timeout` expired first."""
+        if self._thread is None:
+            raise RuntimeError("PlotJob must be started before waiting for it")
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def iter_events(self):
+        """Yield events until the job is done, for headless callers polling from another thread."""
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            yield event
+
+    async def run_async(self) -> plot.PlotResult:
+        """Start the job and await its result, callbacks are dispatched on the running event loop.
+
+        Cancelling the awaiting task cancels the job and waits for it to stop.
+        """
+        loop = asyncio.get_running_loop()
+        self.dispatch = loop.call_soon_threadsafe
+        done = loop.create_future()
+        user_on_done = self.on_done
+
+        def on_done(result: plot.PlotResult):
+            if user_on_done is not None:
+                user_on_done(result)
+            if not done.done():
+                done.set_result(result)
+
+        self.on_done = on_done
+        self.start()
+        try:
+            return await asyncio.shield(done)
+        except asyncio.CancelledError:
+            # The job stops at the next layer or stage, its last callbacks still need the loop
+            self.cancel()
+            await done
+            raise
+
+    def _progress(self, progress: int, status: str):
+        self.events.put(ProgressEvent(int(progress), status))
+        if self.on_progress is not None:
+            self.dispatch(self.on_progress, progress, status)
+
+    def _message(self, text: str, caption: str, flags: int):
+        self.events.put(MessageEvent(text, caption, flags))
+        if self.on_message is not None:
+            self.dispatch(self.on_message, text, caption, flags)
+        else:
+            print(f"{caption}: {text}")
+
+    def _run(self):
+        try:
+            self.result = plot.plot_board(self.board, progress_callback=self._progress,
+                                          cancel_token=self.cancel_token, **self.config_vars)
+            plot.report_result(self.result, self._message)
+        except Exception:
+            _logger.exception("plot job failed")
+            self.result = plot.PlotResult()
+            self.result.errors.append(traceback.format_exc())
+            self._message(self.result.errors[-1], 'Error', 0)
+        finally:
+            self.events.put(None)
+            if self.on_done is not None:
+                self.dispatch(self.on_done, self.result)
+
+
+def plot_from_dialog(dlg, board, config_vars: dict) -> bool:
+    """Run the plot of the dialog's plot button in a PlotJob and keep the dialog responsive until it is done.
+
+    The job is `dlg.plot_job` while it runs, so the dialog's cancel button can call its cancel().
+    """
+    import wx
+
+    job = PlotJob.for_dialog(dlg, board, config_vars)
+    dlg.plot_job = job
+    job.start()
+    try:
+        while not job.wait(0.05):
+            wx.Yield()
+        # The progress and message boxes queued by wx.CallAfter
+        wx.Yield()
+    finally:
+        dlg.plot_job = None
+    return job.result.success
@@ -17,6 +17,19 @@ class Persistence:
         ('main', 'delete_single_page_files'): ('del_single_page_files', lambda x: x == "True"),
         ('main', 'assembly_file_extension'): ('assembly_file_extension', None),
         ('main', 'kicad_cli_path'): ('kicad_cli_path', None),
+        ('main', 'minify_precision'): ('minify_precision', float),
+        ('main', 'cull_hidden'): ('cull_hidden', lambda x: x == "True"),
+        ('main', 'rasterize_over'): ('rasterize_over', int),
+        ('main', 'rasterize_paths'): ('rasterize_paths', int),
+        ('main', 'rasterize_dpi'): ('rasterize_dpi', int),
+        ('main', 'dedup_text'): ('dedup_text', lambda x: x == "True"),
+        ('main', 'image_dpi'): ('image_dpi', int),
+        ('main', 'linearize'): ('linearize', lambda x: x == "True"),
+        ('main', 'reproducible'): ('reproducible', lambda x: x == "True"),
+        ('main', 'tile_format'): ('tile_format', None),
+        ('main', 'tile_size'): ('tile_size', int),
+        ('main', 'tile_dpi'): ('tile_dpi', int),
+        ('main', 'panel_layout'): ('panel_layout', None),
     }
     _typeconv: dict = {
         bool: lambda x: "True" if x else "False",
@@ -39,6 +52,19 @@ class Persistence:
         self.del_single_page_files: bool = True
         self.assembly_file_extension: str = "__Assembly"
         self.kicad_cli_path: str = ""
+        self.minify_precision: float = 0.0
+        self.cull_hidden: bool = False
+        self.rasterize_over: int = 0  # content stream bytes, 0 to never rasterize
+        self.rasterize_paths: int = 0  # painted paths, 0 to not count them
+        self.rasterize_dpi: int = 300
+        self.dedup_text: bool = False
+        self.image_dpi: int = 0  # 0 to leave the images as they are
+        self.linearize: bool = False
+        self.reproducible: bool = False
+        self.tile_format: str = ""  # png, jpeg or webp for deep zoom tiles of every template
+        self.tile_size: int = 256
+        self.tile_dpi: int = 600
+        self.panel_layout: str = ""  # json file with the copies of the board on a panel
         
         self.default_settings_file_path: str = ''
         self.global_settings_file_path: str = ''
@@ -102,7 +128,7 @@ class Persistence:
                                     if layer in layer_names:
                                         enabled_layers[i] = layer_names[layer]
                                 varname_values[name][var] = ','.join(enabled_layers)
-                            if var == 'layers' or var == 'layers_transparency' or var == 'layers_negative' or var == 'layers_footprint_values' or var == 'layers_reference_designators':
+                            if var == 'layers' or var == 'layers_transparency' or var == 'layers_negative' or var == 'layers_footprint_values' or var == 'layers_reference_designators' or var == 'layers_simplify' or var == 'layers_rasterize_over' or var == 'layers_rasterize_paths':
                                 layer_dict = {}
                                 for layer in varname_values[name][var]:
                                     if layer in layer_names:
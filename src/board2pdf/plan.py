@@ -0,0 +1,421 @@
+"""The work of a run as an immutable DAG.
+
+compile_plan turns the enabled templates into plot, simplify, rasterize, colorize, cull, minify, dedup, panel, merge,
+crop, concat and svg nodes. Nodes are NamedTuples, so equal work is one node: a layer plotted with the same settings for two templates is plotted
+once. node_key() is a stable hash of a node and is used as cache key for the files it produces.
+"""
+from __future__ import annotations
+import functools
+import hashlib
+import os
+from typing import NamedTuple, Union
+
+try:
+    from . import backends, costs
+except ImportError:
+    import backends, costs
+
+
+class PlotNode(NamedTuple):
+    layer: str
+    layer_id: int
+    with_frame: bool
+    negative: bool
+    footprint_value: bool
+    reference_designator: bool
+    mirrored: bool
+    tented: bool
+    front_popups: bool
+    back_popups: bool
+    comment: str  # title block comment, only set for the frame layer where it shows up
+    board: str = ''  # the board plotted, '' for the board of the run
+
+
+class SimplifyNode(NamedTuple):
+    source: PlotNode
+    tolerance: float  # mm
+
+    @property
+    def layer(self) -> str:
+        return self.source.layer
+
+
+class RasterizeNode(NamedTuple):
+    """Replace a layer with content streams over `max_bytes` or more than `max_paths` painted paths by an image in
+    its color, other layers are kept. 0 doesn't check that measure."""
+    source: Union[PlotNode, SimplifyNode]
+    color: tuple[float, float, float]
+    transparency: int
+    max_bytes: int
+    max_paths: int
+    dpi: int
+
+    @property
+    def layer(self) -> str:
+        return self.source.layer
+
+
+class ColorizeNode(NamedTuple):
+    source: Union[PlotNode, SimplifyNode, RasterizeNode]
+    color: tuple[float, float, float]
+    transparency: int
+    engine: str  # name of the colorize backends.Engine, the engines don't write the same file
+
+    @property
+    def layer(self) -> str:
+        return self.source.layer
+
+
+class CullNode(NamedTuple):
+    """Drop the paths of a layer hidden by the opaque layers merged over it."""
+    source: Union[PlotNode, SimplifyNode, RasterizeNode, ColorizeNode]
+    occluders: tuple[Union[PlotNode, SimplifyNode, RasterizeNode, ColorizeNode], ...]  # the layers merged over it
+
+    @property
+    def layer(self) -> str:
+        return self.source.layer
+
+
+class MinifyNode(NamedTuple):
+    source: Union[PlotNode, SimplifyNode, RasterizeNode, ColorizeNode, CullNode]
+    precision: float  # mm
+
+    @property
+    def layer(self) -> str:
+        return self.source.layer
+
+
+class DedupNode(NamedTuple):
+    """Draw the shapes repeated in a layer, like the glyphs of the stroke font, once as form xobjects."""
+    source: Union[PlotNode, SimplifyNode, RasterizeNode, ColorizeNode, CullNode, MinifyNode]
+    tolerance: float  # mm
+
+    @property
+    def layer(self) -> str:
+        return self.source.layer
+
+
+class PanelLayout(NamedTuple):
+    """Where the copies of the board of the run are on a panel, in mm and degrees like in KiCad."""
+    frame_board: str  # absolute path of the board with the drawing sheet and rails of the panel
+    instances: tuple[tuple[float, float, float], ...]  # x and y offset and counterclockwise rotation of every copy
+    center: tuple[float, float]  # the copies are rotated around this point of the board
+
+
+class PanelNode(NamedTuple):
+    """Draw a layer of the board once as a form xobject on the same layer of the panel frame, at every copy."""
+    source: Union[PlotNode, SimplifyNode, RasterizeNode, ColorizeNode, CullNode, MinifyNode, DedupNode]
+    frame: Union[PlotNode, SimplifyNode, ColorizeNode, MinifyNode, DedupNode]  # the same layer of the frame board
+    instances: tuple[tuple[float, float, float], ...]
+    center: tuple[float, float]
+    mirrored: bool
+
+    @property
+    def layer(self) -> str:
+        return self.source.layer
+
+
+LayerNode = Union[PlotNode, SimplifyNode, RasterizeNode, ColorizeNode, CullNode, MinifyNode, DedupNode, PanelNode]
+
+
+class MergeNode(NamedTuple):
+    template: str  # the page name in the pdf outline
+    inputs: tuple[LayerNode, ...]  # bottom layer first, the last is painted on top
+    frame: int  # index of the frame layer in `inputs`, -1 without frame
+    scaling_method: str
+    scaling_factor: str
+    layer_scale: float
+    use_popups: bool
+
+
+class CropNode(NamedTuple):
+    """Crop (scaling method 1) or crop and scale back to the page size (2). Done by the merge engine."""
+    source: MergeNode
+    whitespace: str
+    rescale: bool
+
+
+class ConcatNode(NamedTuple):
+    pages: tuple[Union[MergeNode, CropNode], ...]
+    use_popups: bool
+
+
+class SvgNode(NamedTuple):
+    page: Union[MergeNode, CropNode]
+
+
+Node = Union[PlotNode, SimplifyNode, RasterizeNode, ColorizeNode, CullNode, MinifyNode, DedupNode, PanelNode, MergeNode,
+             CropNode, ConcatNode, SvgNode]
+
+
+class TemplatePlan(NamedTuple):
+    name: str
+    plots: tuple[PlotNode, ...]  # one per layer like Template.settings, bottom layer first, the last is painted on top
+    layers: tuple[LayerNode, ...]  # the merge inputs
+    merge: MergeNode
+    page: Union[MergeNode, CropNode]
+    svg: SvgNode | None
+    frame_plots: tuple[PlotNode, ...] = ()  # the layers of the panel frame board, one per layer like plots
+
+    @property
+    def frame_layers(self) -> list:
+        """The last steps of the panel frame layers, in the order of frame_plots."""
+        return [node.frame for node in self.layers if isinstance(node, PanelNode)]
+
+
+class Plan(NamedTuple):
+    templates: tuple[TemplatePlan, ...]
+    concat: ConcatNode
+
+    def nodes(self) -> list[Node]:
+        """Every node once, dependencies before the nodes using them."""
+        ordered = {}
+
+        def visit(node: Node):
+            if node in ordered:
+                return
+            for child in _children(node):
+                visit(child)
+            ordered[node] = None
+
+        visit(self.concat)
+        for template in self.templates:
+            if template.svg is not None:
+                visit(template.svg)
+        return list(ordered)
+
+    def node_count(self) -> int:
+        """Number of nodes when every template would do its own work."""
+        return sum(len(t.plots) + len(t.frame_plots)
+                   + sum(len(layer_steps(n)) for n in t.layers + tuple(t.frame_layers)) + 1
+                   + isinstance(t.page, CropNode) + (t.svg is not None) for t in self.templates) + 1
+
+
+@functools.lru_cache(maxsize=4096)
+def node_key(node: Node) -> str:
+    """Short stable hash of a node, including everything it depends on."""
+    return hashlib.sha1(repr(node).encode()).hexdigest()[:12]
+
+
+def layer_steps(node: LayerNode) -> list:
+    """The simplify, rasterize, colorize, cull, minify, dedup and panel nodes of a merge input in the order they are
+    done, without the steps of the panel frame layer."""
+    steps = []
+    while not isinstance(node, PlotNode):
+        steps.insert(0, node)
+        node = node.source
+    return steps
+
+
+def _children(node: Node) -> tuple:
+    if isinstance(node, (SimplifyNode, RasterizeNode, ColorizeNode, MinifyNode, DedupNode)):
+        return (node.source,)
+    if isinstance(node, CullNode):
+        return (node.source,) + node.occluders
+    if isinstance(node, PanelNode):
+        return node.source, node.frame
+    if isinstance(node, MergeNode):
+        return node.inputs
+    if isinstance(node, CropNode):
+        return (node.source,)
+    if isinstance(node, ConcatNode):
+        return node.pages
+    if isinstance(node, SvgNode):
+        return (node.page,)
+    return ()
+
+
+def stage(node: Node) -> str:
+    """Name of the tracing stage doing the node."""
+    return {PlotNode: 'plot', SimplifyNode: 'simplify', RasterizeNode: 'rasterize', ColorizeNode: 'colorize',
+            CullNode: 'cull', MinifyNode: 'minify', DedupNode: 'dedup', PanelNode: 'panel',
+            MergeNode: 'merge', CropNode: 'crop',
+            ConcatNode: 'concat', SvgNode: 'svg'}[type(node)]
+
+
+def comment(template_name: str, index: int, count: int) -> str:
+    """Title block comment of the `index`th of `count` templates."""
+    return f"board2pdf: {template_name} -- {index + 1}/{count}"
+
+
+def _colorize_engine(colorize_lib: str, transparency: bool, popups: bool) -> str:
+    engine = backends.select('colorize', colorize_lib, transparency=transparency, popups=popups)
+    return engine.name if engine is not None else ''
+
+
+def compile_plan(templates: list, layer_scale: float = 1.0, create_svg: bool = False,
+                 minify_precision: float = 0.0, cull_hidden: bool = False, rasterize_over: int = 0,
+                 rasterize_dpi: int = 300, dedup_tolerance: float = 0.0, panel: PanelLayout | None = None,
+                 rasterize_paths: int = 0, colorize_lib: str = '') -> Plan:
+    """Compile plot.Template objects to a Plan. The layers are minified with a `minify_precision` (mm) above 0.
+    With `cull_hidden` the paths of opaque layers hidden by the opaque layers over them are dropped, the frame
+    layer and transparent layers are left alone. With `rasterize_over` above 0 layers with more content stream
+    bytes, and with `rasterize_paths` above 0 layers with more painted paths, are rendered to an image at
+    `rasterize_dpi`, except the frame layer. The rasterize settings of a layer in its template replace these. With
+    a `dedup_tolerance` (mm) above 0 shapes repeated within it are drawn once per layer, last so they are minified
+    and colored before. With a `panel` every layer is done for one copy of the board and then drawn at every copy, on
+    the same layer of the panel frame board done the same way. The drawing sheet is then plotted with the frame
+    board only. The layers are colored by the engine backends.select picks for `colorize_lib`."""
+    template_plans = []
+    for index, template in enumerate(templates):
+        page_comment = comment(template.name, index, len(templates))
+        plots = []
+        frame_plots = []
+        frame_layers = []
+        layers = []
+        frame = -1
+        for i, layer_info in enumerate(template.settings):
+            # The drawing sheet of a panel comes from the frame board, it would be repeated with every copy
+            with_frame = layer_info.with_frame and panel is None
+            plot_node = PlotNode(layer_info.name, layer_info.id, with_frame, layer_info.negative,
+                                 layer_info.footprint_value, layer_info.reference_designator, template.mirrored,
+                                 template.tented, layer_scale == 1.0 and layer_info.front_popups,
+                                 layer_scale == 1.0 and layer_info.back_popups,
+                                 page_comment if with_frame else '')
+            plots.append(plot_node)
+            if panel is not None:
+                frame_node = PlotNode(layer_info.name, layer_info.id, layer_info.with_frame, layer_info.negative,
+                                      layer_info.footprint_value, layer_info.reference_designator, template.mirrored,
+                                      template.tented, False, False,
+                                      page_comment if layer_info.with_frame else '', panel.frame_board)
+                frame_plots.append(frame_node)
+                if layer_info.simplify_tolerance > 0:
+                    frame_node = SimplifyNode(frame_node, layer_info.simplify_tolerance)
+                if layer_info.has_color or layer_info.has_transparency:
+                    frame_node = ColorizeNode(frame_node, layer_info.color_rgb, layer_info.transparency,
+                                              _colorize_engine(colorize_lib, layer_info.has_transparency, False))
+                if minify_precision > 0:
+                    frame_node = MinifyNode(frame_node, minify_precision)
+                if dedup_tolerance > 0:
+                    frame_node = DedupNode(frame_node, dedup_tolerance)
+                frame_layers.append(frame_node)
+            layer_node = plot_node
+            if layer_info.simplify_tolerance > 0:
+                layer_node = SimplifyNode(plot_node, layer_info.simplify_tolerance)
+            max_bytes = rasterize_over if layer_info.rasterize_over is None else layer_info.rasterize_over
+            max_paths = rasterize_paths if layer_info.rasterize_paths is None else layer_info.rasterize_paths
+            if (max_bytes > 0 or max_paths > 0) and not layer_info.with_frame:
+                layer_node = RasterizeNode(layer_node, layer_info.color_rgb, layer_info.transparency, max_bytes,
+                                           max_paths, rasterize_dpi)
+            if layer_info.has_color or layer_info.has_transparency:
+                popups = plot_node.front_popups or plot_node.back_popups
+                layer_node = ColorizeNode(layer_node, layer_info.color_rgb, layer_info.transparency,
+                                          _colorize_engine(colorize_lib, layer_info.has_transparency, popups))
+            layers.append(layer_node)
+            if layer_info.with_frame:
+                frame = i
+
+        # The paths covered by the upper layers as they are colored, culling them doesn't change what they cover
+        colored = tuple(layers)
+        opaque = [not layer_info.with_frame and not layer_info.has_transparency for layer_info in template.settings]
+        for i, layer_node in enumerate(colored):
+            # The merge engines paint the last input on top
+            occluders = tuple(colored[k] for k in range(i + 1, len(colored)) if opaque[k])
+            if cull_hidden and opaque[i] and occluders:
+                layer_node = CullNode(layer_node, occluders)
+            if minify_precision > 0:
+                layer_node = MinifyNode(layer_node, minify_precision)
+            if dedup_tolerance > 0:
+                layer_node = DedupNode(layer_node, dedup_tolerance)
+            if panel is not None:
+                layer_node = PanelNode(layer_node, frame_layers[i], panel.instances, panel.center, template.mirrored)
+            layers[i] = layer_node
+
+        use_popups = any(p.front_popups or p.back_popups for p in plots)
+        scale_or_crop = template.scale_or_crop
+        merge = MergeNode(template.name, tuple(layers), frame, scale_or_crop['scaling_method'],
+                          scale_or_crop['scaling_factor'] if scale_or_crop['scaling_method'] == '3' else '',
+                          layer_scale, use_popups)
+        page = merge
+        if scale_or_crop['scaling_method'] == '1':
+            page = CropNode(merge, scale_or_crop['crop_whitespace'], False)
+        elif scale_or_crop['scaling_method'] == '2':
+            page = CropNode(merge, scale_or_crop['scale_whitespace'], True)
+        template_plans.append(TemplatePlan(template.name, tuple(plots), tuple(layers), merge, page,
+                                           SvgNode(page) if create_svg else None, tuple(frame_plots)))
+
+    pages = tuple(t.page for t in template_plans)
+    return Plan(tuple(template_plans), ConcatNode(pages, any(t.merge.use_popups for t in template_plans)))
+
+
+def predicted_costs(plan: Plan, cost_model: costs.CostModel, board: str) -> dict[Node, float]:
+    """Predicted seconds of every node of `plan`, from the history of `board`. Crops are part of the merge."""
+    predicted = {}
+    for template in plan.templates:
+        for node in template.plots + template.frame_plots:
+            predicted.setdefault(node, cost_model.predict(board, 'plot', template.name, node.layer))
+        for node in template.layers + tuple(template.frame_layers):
+            for step in layer_steps(node):
+                default = None
+                if isinstance(step, ColorizeNode) and step.transparency:
+                    default = costs.DEFAULT_COSTS['colorize-transparency']
+                predicted.setdefault(step, cost_model.predict(board, stage(step), template.name, step.layer,
+                                                              default))
+        predicted.setdefault(template.merge, cost_model.predict(board, 'merge', template.name))
+        if template.svg is not None:
+            predicted.setdefault(template.svg, cost_model.predict(board, 'svg', template.name))
+    predicted[plan.concat] = cost_model.predict(board, 'concat')
+    return predicted
+
+
+def _describe(node: Node) -> str:
+    if isinstance(node, PlotNode):
+        return (f"plot {node.layer}" + (f' of {os.path.basename(node.board)}' if node.board else '')
+                + (' with frame' if node.with_frame else '') + (' negative' if node.negative else ''))
+    if isinstance(node, SimplifyNode):
+        return f"simplify {node.layer} to {node.tolerance:g} mm"
+    if isinstance(node, RasterizeNode):
+        limits = ([f"{node.max_bytes / (1 << 20):g} MB"] if node.max_bytes else []) + (
+            [f"{node.max_paths} paths"] if node.max_paths else [])
+        return f"rasterize {node.layer} at {node.dpi} dpi if over {' or '.join(limits)}"
+    if isinstance(node, MinifyNode):
+        return f"minify {node.layer} to {node.precision:g} mm"
+    if isinstance(node, DedupNode):
+        return f"dedup the shapes of {node.layer} within {node.tolerance:g} mm"
+    if isinstance(node, PanelNode):
+        return f"panel {len(node.instances)} copies of {node.layer} on the panel frame"
+    if isinstance(node, CullNode):
+        return f"cull {node.layer} hidden by {', '.join(occluder.layer for occluder in node.occluders)}"
+    if isinstance(node, ColorizeNode):
+        color = '#' + ''.join(f'{round(c * 255):02X}' for c in node.color)
+        return (f"colorize {node.source.layer} {color}"
+                + (f' {node.transparency}% transparent' if node.transparency else '')
+                + (f' with {node.engine}' if node.engine else ''))
+    if isinstance(node, MergeNode):
+        return f"merge {len(node.inputs)} layers of '{node.template}'" + (
+            f' scaled {node.scaling_factor}x' if node.scaling_method == '3' else '')
+    if isinstance(node, CropNode):
+        return f"crop '{node.source.template}' with {node.whitespace} whitespace" + (
+            ' and scale to page' if node.rescale else '')
+    if isinstance(node, ConcatNode):
+        return f"concat {len(node.pages)} pages" + (' with popups' if node.use_popups else '')
+    return f"svg of '{node.page.template if isinstance(node.page, MergeNode) else node.page.source.template}'"
+
+
+def format_plan(plan: Plan, predicted: dict[Node, float] = None) -> str:
+    """The DAG as an indented tree from the assembly pdf down, shared nodes are only expanded once."""
+    predicted = predicted or {}
+    lines = []
+    shown = set()
+
+    def show(node: Node, depth: int):
+        cost = f"  ~{costs.format_duration(predicted[node])}" if node in predicted else ''
+        if node in shown:
+            lines.append(f"{'  ' * depth}{_describe(node)} [{node_key(node)}] (shared, see above)")
+            return
+        shown.add(node)
+        lines.append(f"{'  ' * depth}{_describe(node)} [{node_key(node)}]{cost}")
+        for child in _children(node):
+            show(child, depth + 1)
+
+    show(plan.concat, 0)
+    for template in plan.templates:
+        if template.svg is not None:
+            show(template.svg, 0)
+
+    nodes = plan.nodes()
+    total = sum(predicted.get(node, 0.0) for node in nodes)
+    lines.append('')
+    lines.append(f"{len(nodes)} nodes ({plan.node_count()} without sharing), "
+                 f"predicted time {costs.format_duration(total)}")
+    return '\n'.join(lines)
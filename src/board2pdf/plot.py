@@ -1,74 +1,240 @@
+from __future__ import annotations
 import os
 import shutil
 import sys
-import pcbnew
-import wx
 import re
 import traceback
+import gc
 import tempfile
+import hashlib
+import json
 import logging
-from pathlib import Path
+import threading
+import contextvars
+import functools
+import importlib
+import math
+import zlib
+import concurrent.futures
+import subprocess
+import time
+from typing import NamedTuple
 
-# Try to import PyMuPDF.
-has_pymupdf = True
-import pymupdf  # This imports PyMuPDF
+try:
+    from . import _version, backends, costs, plan, tracing
+except ImportError:
+    import _version, backends, costs, plan, tracing
+
+# The pdf functions don't need KiCad, they are also used by the benchmarks.
+try:
+    import pcbnew
+except ImportError:
+    pcbnew = None
+
+_logger = logging.getLogger(__name__)
+
+
+class _LazyModule:
+    """Imports the module on first use, so e.g. `board2pdf --version` doesn't load the pdf libraries."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
 
-# after pip uninstall PyMuPDF the import still works, but not `open()`
-# check if it's possible to call pymupdf.open()
-if has_pymupdf:
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self._name!r})'
+
+
+pymupdf = _LazyModule('pymupdf')
+pypdf = _LazyModule('pypdf')
+geometry = _LazyModule(f'{__package__}.geometry' if __package__ else 'geometry')
+
+
+@functools.lru_cache(maxsize=None)
+def pymupdf_loaded() -> bool:
+    """Import PyMuPDF, returns False if it's not available."""
     try:
+        # after pip uninstall PyMuPDF the import still works, but not `open()`
+        # check if it's possible to call pymupdf.open()
         pymupdf.open()
-    except:
-        has_pymupdf = False
+    except Exception:
+        return False
+    return True
 
-# Try to import pdfCropMargins.
-has_pdfcropmargins = True
-try:
-    from pdfCropMargins import crop  # This imports pdfCropMargins
-except:
-    has_pdfcropmargins = False
 
-_logger = logging.getLogger(__name__)
+@functools.lru_cache(maxsize=None)
+def pdfcropmargins_loaded() -> bool:
+    """Import pdfCropMargins, returns False if it's not available."""
+    try:
+        importlib.import_module('pdfCropMargins')
+    except Exception:
+        return False
+    return True
 
 
-def exception_msg(info: str, tb=True):
-    msg = f"{info}\n\n" + (
-        traceback.format_exc() if tb else '')
+@functools.lru_cache(maxsize=None)
+def pikepdf_loaded() -> bool:
+    """Import pikepdf, returns False if it's not available."""
+    try:
+        importlib.import_module('pikepdf')
+    except Exception:
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def qpdf_path() -> str | None:
+    """The qpdf command line tool, None if it's not installed."""
+    return shutil.which('qpdf')
+
+
+@functools.lru_cache(maxsize=None)
+def pymupdf_linearizes() -> bool:
+    """MuPDF 1.26 dropped writing linearized pdfs."""
+    if not pymupdf_loaded():
+        return False
     try:
-        wx.MessageBox(msg, 'Error', wx.OK | wx.ICON_ERROR)
+        with pymupdf.open() as doc:
+            doc.new_page()
+            doc.tobytes(linear=True)
+    except Exception:
+        return False
+    return True
+
+
+def __getattr__(name: str):
+    # has_pymupdf and has_pdfcropmargins used to be set when this module was imported
+    if name == 'has_pymupdf':
+        return pymupdf_loaded()
+    if name == 'has_pdfcropmargins':
+        return pdfcropmargins_loaded()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _wx():
+    """The wx module if it's loaded, i.e. when running inside KiCad or with the dialog. Headless runs never
+    import wx."""
+    return sys.modules.get('wx')
+
+# msg_box of the plot_pdfs call running in the current thread. Error messages from the pdf functions
+# are routed through it, so that a plot running on a worker thread never opens a wx.MessageBox itself.
+_message_sink = contextvars.ContextVar('board2pdf_message_sink', default=None)
+# Memory budget in bytes of the plot running in the current thread, None without max_memory.
+_memory_budget = contextvars.ContextVar('board2pdf_memory_budget', default=None)
+# With a memory budget, content streams are recolored in chunks of about this size.
+STREAM_CHUNK_SIZE = 4 << 20
+
+
+class PlotCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """Thread safe flag used to stop a running plot_pdfs between layers and stages."""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise PlotCancelled()
+
+
+def msg_flags(icon: str = None) -> int:
+    """wx.MessageBox flags with the wx.ICON_* named `icon`, 0 without wx."""
+    wx = _wx()
+    if wx is None:
+        return 0
+    return (wx.OK | getattr(wx, icon)) if icon else wx.OK
+
+
+def show_error(msg: str):
+    sink = _message_sink.get()
+    if sink is not None:
+        sink(msg, 'Error', msg_flags('ICON_ERROR'))
+        return
+    wx = _wx()
+    if wx is None:
+        print(f'Error: {msg}', file=sys.stderr)
+        return
+    try:
+        wx.MessageBox(msg, 'Error', msg_flags('ICON_ERROR'))
     except wx._core.PyNoAppError:
         print(f'Error: {msg}', file=sys.stderr)
 
 
+def exception_msg(info: str, tb=True):
+    msg = f"{info}\n\n" + (
+        traceback.format_exc() if tb else '')
+    show_error(msg)
+
+
 def io_file_error_msg(function: str, input_file: str, folder: str, more: str = '', tb=True):
     msg = f"{function} failed\nOn input file {input_file} in {folder}\n\n{more}" + (
         traceback.format_exc() if tb else '')
-    try:
-        wx.MessageBox(msg, 'Error', wx.OK | wx.ICON_ERROR)
-    except wx._core.PyNoAppError:
-        print(f'Error: {msg}', file=sys.stderr)
+    show_error(msg)
+
+
+_black = re.compile(br'(\s)0 0 0 (RG|rg)')
+
+
+def recolor_stream(stream_bytes: bytes, color) -> bytes:
+    """Replace black (0 0 0 RG/rg) in a content stream by `color`.
+
+    With a memory budget a large stream is done in chunks ending at a line end, instead of collecting the
+    pieces of the whole stream in one re.sub.
+    """
+    new_color = ''.join([f'{c:.3g} ' for c in color])
+    replacement = bytes(fr'\g<1>{new_color}\g<2>', 'ascii')
+    if _memory_budget.get() is None or len(stream_bytes) <= STREAM_CHUNK_SIZE:
+        return _black.sub(replacement, stream_bytes)
+
+    recolored = bytearray()
+    view = memoryview(stream_bytes)
+    start = 0
+    while start < len(stream_bytes):
+        end = stream_bytes.find(b'\n', start + STREAM_CHUNK_SIZE)
+        end = len(stream_bytes) if end < 0 else end + 1
+        # The whitespace in front of a color can be the last byte of the previous chunk
+        lead = 1 if start else 0
+        recolored += _black.sub(replacement, bytes(view[start - lead:end]))[lead:]
+        start = end
+    return bytes(recolored)
 
 
 def colorize_pdf_pymupdf(folder, input_file, output_file, color, transparency):
     # If transparency is non zero, run colorize_pdf_pymupdf_with_transparency instead.
     if not transparency == 0:
+        if _memory_budget.get() is not None:
+            return colorize_pdf_pymupdf_with_extgstate(folder, input_file, output_file, color, transparency)
         return colorize_pdf_pymupdf_with_transparency(folder, input_file, output_file, color, transparency)
 
     try:
         with pymupdf.open(os.path.join(folder, input_file)) as doc:
-            xref_number = doc[0].get_contents()
-            stream_bytes = doc.xref_stream(xref_number[0])
-            new_color = ''.join([f'{c:.3g} ' for c in color])
-            _logger.debug(f'{new_color=}')
-            stream_bytes = re.sub(br'(\s)0 0 0 (RG|rg)', bytes(fr'\g<1>{new_color}\g<2>', 'ascii'), stream_bytes)
-
-            doc.update_stream(xref_number[0], stream_bytes)
+            _logger.debug(f'{color=}')
+            # A page can have several content streams, all of them are colored.
+            for xref_number in doc[0].get_contents():
+                doc.update_stream(xref_number, recolor_stream(doc.xref_stream(xref_number), color))
             doc.save(os.path.join(folder, output_file), clean=True)
 
     except RuntimeError as e:
         if "invalid key in dict" in str(e):
             io_file_error_msg(colorize_pdf_pymupdf.__name__, input_file, folder,
                               "This error can be due to PyMuPdf not being able to handle pdfs created by KiCad 7.0.1 due to a bug in KiCad 7.0.1. Upgrade KiCad or switch to pypdf instead.\n\n")
+        else:
+            io_file_error_msg(colorize_pdf_pymupdf.__name__, input_file, folder)
         return False
 
     except:
@@ -78,6 +244,44 @@ def colorize_pdf_pymupdf(folder, input_file, output_file, color, transparency):
     return True
 
 
+def _xref_set_path(doc, xref: int, path: str, value: str):
+    """xref_set_key for a path like Resources/ExtGState/Name, which may go through indirect objects."""
+    keys = path.split('/')
+    prefix = []
+    for key in keys[:-1]:
+        prefix.append(key)
+        kind, ref = doc.xref_get_key(xref, '/'.join(prefix))
+        if kind == 'xref':
+            xref, prefix = int(ref.split()[0]), []
+    doc.xref_set_key(xref, '/'.join(prefix + keys[-1:]), value)
+
+
+def colorize_pdf_pymupdf_with_extgstate(folder, input_file, output_file, color, transparency):
+    """Transparent coloring for a memory budget: black is recolored in the content streams, which are wrapped
+    in a graphics state with the opacity. get_drawings() would hold every path of the layer as python objects."""
+    opacity = 1 - float(transparency / 100)
+    try:
+        with pymupdf.open(os.path.join(folder, input_file)) as doc:
+            page = doc[0]
+            gstate_xref = doc.get_new_xref()
+            doc.update_object(gstate_xref, f"<</Type/ExtGState/CA {opacity:.3g}/ca {opacity:.3g}>>")
+            _xref_set_path(doc, page.xref, "Resources/ExtGState/B2PAlpha", f"{gstate_xref} 0 R")
+            contents = page.get_contents()
+            for i, xref_number in enumerate(contents):
+                stream_bytes = recolor_stream(doc.xref_stream(xref_number), color)
+                if i == 0:
+                    stream_bytes = b"q /B2PAlpha gs\n" + stream_bytes
+                if i == len(contents) - 1:
+                    stream_bytes += b"\nQ"
+                doc.update_stream(xref_number, stream_bytes)
+            doc.save(os.path.join(folder, output_file), clean=True)
+    except Exception:
+        io_file_error_msg(colorize_pdf_pymupdf_with_extgstate.__name__, input_file, folder)
+        return False
+
+    return True
+
+
 def colorize_pdf_pymupdf_with_transparency(folder, input_file, output_file, color, transparency):
     opacity = 1-float(transparency / 100)
 
@@ -172,14 +376,6 @@ def colorize_pdf_pymupdf_with_transparency(folder, input_file, output_file, colo
     # all paths processed - commit the shape to its page
     shape.commit()
 
-    print("New page")
-    page = outpdf[0]
-    paths = page.get_drawings()  # extract existing drawings
-
-    #for path in paths:
-    #    print("Object:")
-    #    pprint.pp(path)
-
     outpdf.save(os.path.join(folder, output_file), clean=True)
 
     return True
@@ -188,33 +384,27 @@ def colorize_pdf_pymupdf_with_transparency(folder, input_file, output_file, colo
 def colorize_pdf_pypdf(folder, input_file, output_file, color, transparency):
     try:
         with open(os.path.join(folder, input_file), "rb") as f:
-            class ErrorHandler(object):
-                def write(self, data):
-                    if "UserWarning" not in data:
-                        io_file_error_msg(colorize_pdf_pypdf.__name__, input_file, folder, data + "\n\n", tb=False)
-                        return False
-
-            if sys.stderr is None:
-                handler = ErrorHandler()
-                sys.stderr = handler
-
-            source = PdfReader(f)
-            output = PdfWriter()
+            source = pypdf.PdfReader(f)
+            output = pypdf.PdfWriter()
 
             page = source.pages[0]
             content_object = page["/Contents"].get_object()
-            content = generic.ContentStream(content_object, source)
-
-            for i, (operands, operator) in enumerate(content.operations):
-                if operator in (b"rg", b"RG"):
-                    if operands == [0, 0, 0]:
-                        content.operations[i] = (
-                            [generic.FloatObject(intensity) for intensity in color], operator)
-                    # else:
-                    #    print(operator, operands[0], operands[1], operands[2], "The type is : ", type(operands[0]),
-                    #          type(operands[1]), type(operands[2]))
-
-            page[generic.NameObject("/Contents")] = content
+            content = pypdf.generic.ContentStream(content_object, source)
+
+            if _memory_budget.get() is not None:
+                # With a memory budget the stream isn't parsed to a list of operations
+                content.set_data(recolor_stream(content.get_data(), color))
+            else:
+                for i, (operands, operator) in enumerate(content.operations):
+                    if operator in (b"rg", b"RG"):
+                        if operands == [0, 0, 0]:
+                            content.operations[i] = (
+                                [pypdf.generic.FloatObject(intensity) for intensity in color], operator)
+                        # else:
+                        #    print(operator, operands[0], operands[1], operands[2], "The type is : ", type(operands[0]),
+                        #          type(operands[1]), type(operands[2]))
+
+            page[pypdf.generic.NameObject("/Contents")] = content
             output.add_page(page)
 
             with open(os.path.join(folder, output_file), "wb") as output_stream:
@@ -226,8 +416,319 @@ def colorize_pdf_pypdf(folder, input_file, output_file, color, transparency):
 
     return True
 
+
+MM_TO_PT = 72 / 25.4
+
+
+def simplify_pdf(folder, input_file, output_file, tolerance) -> tuple[int, int] | None:
+    """Drop the vertices of the polylines of a layer that are less than `tolerance` mm off the simplified outline,
+    see geometry.simplify_stream. KiCad plots zones with vertices much closer than an assembly drawing needs.
+    Returns the number of vertices of the simplified polylines before and after, None if it failed."""
+    before = after = 0
+    try:
+        with pymupdf.open(os.path.join(folder, input_file)) as doc:
+            for page in doc:
+                for xref_number in page.get_contents():
+                    stream, vertices, kept = geometry.simplify_stream(doc.xref_stream(xref_number),
+                                                                      tolerance * MM_TO_PT)
+                    if kept < vertices:
+                        doc.update_stream(xref_number, stream)
+                    before += vertices
+                    after += kept
+            doc.save(os.path.join(folder, output_file))
+    except Exception:
+        io_file_error_msg(simplify_pdf.__name__, input_file, folder)
+        return None
+
+    return before, after
+
+
+def layer_complexity(folder, input_file) -> tuple[int, int | None] | None:
+    """Content stream bytes and painted paths of a layer pdf, the paths are None without numpy. Returns None if
+    the pdf can't be read."""
+    try:
+        with pymupdf.open(os.path.join(folder, input_file)) as doc:
+            stream = doc[0].read_contents()
+    except Exception:
+        io_file_error_msg(layer_complexity.__name__, input_file, folder)
+        return None
+
+    return len(stream), geometry.paint_count(stream) if geometry.has_numpy else None
+
+
+def rasterize_pdf(folder, input_file, output_file, color, transparency, dpi) -> bool:
+    """Replace the drawing of a layer by an image at `dpi`, colored like colorize_pdf_pymupdf colors it. The
+    image only covers the bounding box of the drawing, for crop_pdf_pymupdf. The annotations and the outline are
+    kept, so the popups still work."""
+    try:
+        with pymupdf.open(os.path.join(folder, input_file)) as doc:
+            page = doc[0]
+            rects = [rect for _, rect in page.get_bboxlog()]
+            contents = page.get_contents()
+            for xref_number in contents:
+                doc.update_stream(xref_number, recolor_stream(doc.xref_stream(xref_number), color))
+            clip = None
+            if rects:
+                clip = pymupdf.Rect(min(r[0] for r in rects), min(r[1] for r in rects),
+                                    max(r[2] for r in rects), max(r[3] for r in rects)) & page.rect
+                pixmap = page.get_pixmap(dpi=dpi, alpha=True, annots=False, clip=clip)
+                if transparency:
+                    # The samples are premultiplied by the alpha, so the transparency scales all of them
+                    scale = 1 - transparency / 100
+                    transparent = pymupdf.Pixmap(pixmap.colorspace, pixmap.irect, True)
+                    transparent.samples_mv[:] = pixmap.samples.translate(bytes(round(value * scale)
+                                                                               for value in range(256)))
+                    pixmap = transparent
+            for xref_number in contents:
+                doc.update_stream(xref_number, b'')
+            if clip is not None:
+                # The pixmap has whole pixels around the clip, it is fit to the clip so crops stay the same
+                page.insert_image(clip, pixmap=pixmap, keep_proportion=False)
+            doc.save(os.path.join(folder, output_file), garbage=1, deflate=True)
+    except Exception:
+        io_file_error_msg(rasterize_pdf.__name__, input_file, folder)
+        return False
+
+    return True
+
+
+# Resolution of the coverage of the upper layers, the paths of a layer are only culled if covered to the pixel
+CULL_DPI = 300
+
+
+def cull_pdf(folder, input_file, output_file, occluder_files: list) -> tuple[int, int] | None:
+    """Drop the paths of a layer hidden by the opaque layers `occluder_files` merged over it, see
+    geometry.cull_stream. The coverage is the alpha of the layers rendered together at CULL_DPI. Returns the number
+    of painted paths and the number of dropped paths, None if it failed."""
+    try:
+        with pymupdf.open(os.path.join(folder, input_file)) as doc, pymupdf.open() as cover:
+            page = doc[0]
+            cover_page = cover.new_page(width=page.rect.width, height=page.rect.height)
+            for occluder_file in occluder_files:
+                with pymupdf.open(os.path.join(folder, occluder_file)) as occluder:
+                    cover_page.show_pdf_page(cover_page.rect, occluder, 0)
+            zoom = pymupdf.Matrix(CULL_DPI / 72, CULL_DPI / 72)
+            pixmap = cover_page.get_pixmap(matrix=zoom, alpha=True)
+            covered = geometry.opaque_pixels(pixmap.samples, pixmap.width, pixmap.height, pixmap.n)
+            stream, paths, dropped = geometry.cull_stream(page.read_contents(), tuple(page.transformation_matrix * zoom),
+                                                          covered)
+            if dropped:
+                # The streams of the page are joined, the graphics state goes on from one to the next
+                contents = page.get_contents()
+                doc.update_stream(contents[0], stream)
+                for xref_number in contents[1:]:
+                    doc.update_stream(xref_number, b'')
+            doc.save(os.path.join(folder, output_file))
+    except Exception:
+        io_file_error_msg(cull_pdf.__name__, input_file, folder)
+        return None
+
+    return paths, dropped
+
+
+def minify_pdf(folder, input_file, output_file, precision) -> bool:
+    """Round the numbers of the content streams to `precision` mm, drop state operators without effect and merge
+    paints with the same state, see geometry.minify_stream. The streams are saved compressed."""
+    try:
+        with pymupdf.open(os.path.join(folder, input_file)) as doc:
+            for page in doc:
+                for xref_number in page.get_contents():
+                    doc.update_stream(xref_number,
+                                      geometry.minify_stream(doc.xref_stream(xref_number), precision * MM_TO_PT))
+            doc.save(os.path.join(folder, output_file), deflate=True)
+    except Exception:
+        io_file_error_msg(minify_pdf.__name__, input_file, folder)
+        return False
+
+    return True
+
+
+# mm the strokes of two glyphs may differ by to be drawn by the same form xobject with --dedup-text
+DEDUP_TOLERANCE = 0.001
+
+
+def dedup_pdf(folder, input_file, output_file, tolerance) -> int | None:
+    """Draw the shapes repeated on a page within `tolerance` mm, like the glyphs of text, once as form xobjects, see
+    geometry.dedup_strokes. The footprint popup menus are kept. Returns the number of shapes replaced, None if it
+    failed."""
+    try:
+        replaced = 0
+        with pymupdf.open(os.path.join(folder, input_file)) as doc:
+            for page in doc:
+                stream, forms, count = geometry.dedup_strokes(page.read_contents(), tolerance * MM_TO_PT,
+                                                              b'B2PGlyph')
+                if not count:
+                    continue
+                for number, (content, bbox) in enumerate(forms):
+                    xref_number = doc.get_new_xref()
+                    doc.update_object(xref_number, '<< /Type /XObject /Subtype /Form /BBox [%g %g %g %g] >>' % bbox)
+                    doc.update_stream(xref_number, content)
+                    _xref_set_path(doc, page.xref, f'Resources/XObject/B2PGlyph{number}', f'{xref_number} 0 R')
+                contents = page.get_contents()
+                doc.update_stream(contents[0], stream)
+                for xref_number in contents[1:]:
+                    doc.update_stream(xref_number, b'')
+                replaced += count
+            doc.save(os.path.join(folder, output_file), garbage=1, deflate=True)
+    except Exception:
+        io_file_error_msg(dedup_pdf.__name__, input_file, folder)
+        return None
+
+    return replaced
+
+
+def panel_layout_path(board, panel_layout: str) -> str:
+    """Relative panel layouts are relative to the board directory, like the output path."""
+    board_dir = os.path.dirname(os.path.abspath(board.GetFileName()))
+    return os.path.join(board_dir, os.path.expanduser(os.path.expandvars(panel_layout)))
+
+
+def load_panel_layout(path: str, board) -> plan.PanelLayout:
+    """Read a panel layout, a json file like
+    {"frame_board": "rails.kicad_pcb", "center": [100, 80], "instances": [{"x": 0, "y": 0, "rotation": 0}, ...]}
+    with the offset of every copy in mm and its counterclockwise rotation in degrees around `center`. The frame board
+    with the drawing sheet and rails is relative to the layout file, `center` defaults to the center of the board
+    edges. Raises OSError or ValueError."""
+    with open(path, 'r') as f:
+        layout = json.load(f)
+    try:
+        instances = tuple((float(instance.get('x', 0)), float(instance.get('y', 0)),
+                           float(instance.get('rotation', 0))) for instance in layout['instances'])
+        frame_board = os.path.abspath(os.path.join(os.path.dirname(path), os.path.expanduser(layout['frame_board'])))
+        if 'center' in layout:
+            center = (float(layout['center'][0]), float(layout['center'][1]))
+        else:
+            box = board.GetBoardEdgesBoundingBox()
+            center = (pcbnew.ToMM(box.GetCenter().x), pcbnew.ToMM(box.GetCenter().y))
+    except (KeyError, IndexError, TypeError, AttributeError) as e:
+        raise ValueError(f"invalid panel layout {path}: {e!r}") from e
+    if not instances:
+        raise ValueError(f"the panel layout {path} has no instances")
+    return plan.PanelLayout(frame_board, instances, center)
+
+
+def _page_matrix(page, mirrored: bool):
+    # KiCad plots 1:1 from the top left corner of the sheet, mirrored from the top right corner
+    width, height = page.rect.width, page.rect.height
+    if mirrored:
+        return pymupdf.Matrix(-MM_TO_PT, 0, 0, -MM_TO_PT, width, height)
+    return pymupdf.Matrix(MM_TO_PT, 0, 0, -MM_TO_PT, 0, height)
+
+
+def panel_pdf(folder, input_file, frame_file, output_file, instances, center, mirrored) -> bool:
+    """Draw the page of `input_file` at every copy of `instances`, see load_panel_layout, on the page of `frame_file`.
+    The page is added once as a form xobject drawn by every copy, the footprint popup menus of the frame are kept but
+    those of the copies aren't."""
+    try:
+        with pymupdf.open(os.path.join(folder, input_file)) as source:
+            with pymupdf.open(os.path.join(folder, frame_file)) as doc:
+                page = doc[0]
+                contents = page.get_contents()
+                # show_pdf_page adds the page as a form xobject, drawn by a wrapper form scaling it to the rect
+                form_xref = page.show_pdf_page(source[0].rect, source, 0)
+                added = [xref_number for xref_number in page.get_contents() if xref_number not in contents]
+                wrapper = re.search(rb'/(\S+)\s+Do', doc.xref_stream(added[-1])).group(1).decode()
+                _xref_set_path(doc, page.xref, f'Resources/XObject/{wrapper}', 'null')
+                _xref_set_path(doc, page.xref, 'Resources/XObject/B2PPanel', f'{form_xref} 0 R')
+
+                # Copies are placed in board mm, from the pdf coordinates of the layer to those of the panel
+                to_board = ~_page_matrix(source[0], mirrored)
+                to_page = _page_matrix(page, mirrored)
+                blocks = []
+                for x, y, rotation in instances:
+                    angle = math.radians(rotation)
+                    cos, sin = math.cos(angle), math.sin(angle)
+                    place = (pymupdf.Matrix(1, 0, 0, 1, -center[0], -center[1])
+                             * pymupdf.Matrix(cos, -sin, sin, cos, 0, 0)
+                             * pymupdf.Matrix(1, 0, 0, 1, center[0] + x, center[1] + y))
+                    matrix = to_board * place * to_page
+                    # pdf numbers have no exponent
+                    numbers = ' '.join(('%.4f' % v).rstrip('0').rstrip('.') for v in matrix)
+                    blocks.append(f'q {numbers} cm /B2PPanel Do Q')
+                doc.update_stream(added[-1], '\n'.join(blocks).encode())
+                for xref_number in added[:-1]:
+                    doc.update_stream(xref_number, b'')
+                doc.save(os.path.join(folder, output_file), garbage=1, deflate=True)
+    except Exception:
+        io_file_error_msg(panel_pdf.__name__, input_file, folder)
+        return False
+
+    return True
+
+
+def crop_pdf_pdfcropmargins(input_path: str, output_path: str, whitespace: str) -> bool:
+    try:
+        from pdfCropMargins import crop
+        output_doc_pathname, exit_code, stdout_str, stderr_str = crop(
+                             ["-p", "0", "-a", "-" + whitespace, "-t", "250", "-A", "-o", output_path, input_path],
+                             string_io=True, quiet=False)
+        _logger.debug(f"{output_doc_pathname=} {exit_code=} {stdout_str=} {stderr_str=}")
+    except Exception:
+        io_file_error_msg(crop_pdf_pdfcropmargins.__name__, os.path.basename(input_path), os.path.dirname(input_path))
+        return False
+
+    return True
+
+
+def crop_pdf_pymupdf(input_path: str, output_path: str, whitespace: str) -> bool:
+    # Crops to the bounding box of everything drawn on the page. Unlike pdfCropMargins the page isn't rendered,
+    # so white drawings count as content too.
+    try:
+        with pymupdf.open(input_path) as doc:
+            page = doc[0]
+            rects = [rect for _, rect in page.get_bboxlog()]
+            if rects:
+                bbox = pymupdf.Rect(min(r[0] for r in rects), min(r[1] for r in rects),
+                                    max(r[2] for r in rects), max(r[3] for r in rects))
+                margin = float(whitespace)
+                clip = (bbox + (-margin, -margin, margin, margin)) & page.rect
+                offset = page.cropbox_position
+                page.set_cropbox(clip + (offset.x, offset.y, offset.x, offset.y))
+            doc.save(output_path)
+    except Exception:
+        io_file_error_msg(crop_pdf_pymupdf.__name__, os.path.basename(input_path), os.path.dirname(input_path))
+        return False
+
+    return True
+
+
+_flush_prefix = 'board2pdf-flush-'
+
+
+def _within_memory_budget(doc, folder: str):
+    """With a memory budget, drop what pymupdf caches of the documents shown in `doc`. If half the budget is
+    still in use, `doc` is written to a file in `folder` and opened again, which also drops the objects kept for
+    the imported pages. Returns the document to continue with."""
+    budget = _memory_budget.get()
+    if budget is None:
+        return doc
+    pymupdf.TOOLS.store_shrink(100)
+    gc.collect()
+    rss = tracing.current_rss()
+    if rss is not None and rss < budget // 2:
+        return doc
+
+    fd, path = tempfile.mkstemp(prefix=_flush_prefix, suffix='.pdf', dir=folder)
+    os.close(fd)
+    doc.save(path)
+    previous = doc.name
+    doc.close()
+    _remove_flush_file(previous)
+    _logger.debug(f'{rss=} over half of {budget=}, continuing from {path}')
+    return pymupdf.open(path)
+
+
+def _remove_flush_file(path: str):
+    if path and os.path.basename(path).startswith(_flush_prefix):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
 def merge_pdf_pymupdf(input_folder: str, input_files: list, output_folder: str, output_file: str, frame_file: str,
-                    scale_or_crop: dict, layer_scale: float, template_use_popups: bool, template_name: str):
+                    scale_or_crop: dict, layer_scale: float, template_use_popups: bool, template_name: str,
+                    crop_pdf=None):
     # I haven't found a way to scale the pdf and preserve the popup-menus.
     # For now, I'm taking the easy way out and handle the merging differently depending
     # on if scaling is used or not. At least the popup-menus are preserved when not using scaling.
@@ -237,18 +738,21 @@ def merge_pdf_pymupdf(input_folder: str, input_files: list, output_folder: str,
         # If scaling_method = 3, use a different method
         scaling_factor = float(scale_or_crop['scaling_factor'])
         return merge_pdf_pymupdf_with_scaling(input_folder, input_files, output_folder, output_file, frame_file, template_name, scaling_factor)
-    return merge_pdf_pymupdf_without_scaling(input_folder, input_files, output_folder, output_file, frame_file, scale_or_crop, template_name)
+    return merge_pdf_pymupdf_without_scaling(input_folder, input_files, output_folder, output_file, frame_file, scale_or_crop, template_name, crop_pdf)
 
-def merge_pdf_pymupdf_without_scaling(input_folder: str, input_files: list, output_folder: str, output_file: str, frame_file: str, scale_or_crop: dict, template_name: str):
+def merge_pdf_pymupdf_without_scaling(input_folder: str, input_files: list, output_folder: str, output_file: str, frame_file: str, scale_or_crop: dict, template_name: str,
+                                      crop_pdf=None):
     if(scale_or_crop['scaling_method'] == '1' or scale_or_crop['scaling_method'] == '2'):
+        # The merged file is not the final file, keep it with the temp files.
+        merged_folder = input_folder
         merged_file = "merged_" + output_file
     else:
+        merged_folder = output_folder
         merged_file = output_file
 
     if(scale_or_crop['scaling_method'] == '2'):
         # The frame layer should not be scaled, so don't merge this with the others.
-        print(str(input_files))
-        print("frame file:", frame_file)
+        _logger.debug(f"{input_files=} {frame_file=}")
         input_files.remove(frame_file)
 
     try:
@@ -263,6 +767,7 @@ def merge_pdf_pymupdf_without_scaling(input_folder: str, input_files: list, outp
                         output[0].show_pdf_page(src[0].rect,  # select output rect
                                                 src,  # input document
                                                 overlay=False)
+                    output = _within_memory_budget(output, input_folder)
             except Exception:
                 io_file_error_msg(merge_pdf_pymupdf.__name__, filename, input_folder)
                 return False
@@ -324,29 +829,28 @@ def merge_pdf_pymupdf_without_scaling(input_folder: str, input_files: list, outp
             toc = [[1, template_name, 1]]
             output.set_toc(toc)
 
-        output.save(os.path.join(output_folder, merged_file)) # , garbage=2
+        output.save(os.path.join(merged_folder, merged_file)) # , garbage=2
         output.close()
+        _remove_flush_file(output.name)
 
     except Exception:
-        io_file_error_msg(merge_pdf_pymupdf.__name__, merged_file, output_folder)
+        io_file_error_msg(merge_pdf_pymupdf.__name__, merged_file, merged_folder)
         return False
 
     if(scale_or_crop['scaling_method'] == '1'):
         whitespace = scale_or_crop['crop_whitespace']
-        cropped_file = output_file
+        cropped_file_path = os.path.join(output_folder, output_file)
     elif(scale_or_crop['scaling_method'] == '2'):
         whitespace = scale_or_crop['scale_whitespace']
         cropped_file = "cropped_" + output_file
+        cropped_file_path = os.path.join(input_folder, cropped_file)
 
     if(scale_or_crop['scaling_method'] == '1' or scale_or_crop['scaling_method'] == '2'):
-        output_doc_pathname, exit_code, stdout_str, stderr_str = crop(
-                             ["-p", "0", "-a", "-" + whitespace, "-t", "250", "-A", "-o", os.path.join(input_folder, cropped_file), os.path.join(output_folder, merged_file)],
-                             string_io=True, quiet=False)
-
-        print("output_doc_pathname" + str(output_doc_pathname))
-        print("exit_code" + str(exit_code))
-        print("stdout_str" + str(stdout_str))
-        print("stderr_str" + str(stderr_str))
+        with tracing.stage('crop', template_name) as span:
+            span.add_input(os.path.join(merged_folder, merged_file))
+            span.add_output(cropped_file_path)
+            if not (crop_pdf or crop_pdf_pdfcropmargins)(os.path.join(merged_folder, merged_file), cropped_file_path, whitespace):
+                return False
 
     if(scale_or_crop['scaling_method'] == '2'):
         # Scale the cropped file.
@@ -361,6 +865,14 @@ def merge_pdf_pymupdf_without_scaling(input_folder: str, input_files: list, outp
 
 def merge_pdf_pymupdf_with_scaling(input_folder: str, input_files: list, output_folder: str, output_file: str, frame_file: str,
                     template_name: str, layer_scale: float):
+    with tracing.stage('scale', template_name) as span:
+        span.add_output(os.path.join(output_folder, output_file))
+        return _merge_pdf_pymupdf_with_scaling(input_folder, input_files, output_folder, output_file, frame_file,
+                                               template_name, layer_scale)
+
+
+def _merge_pdf_pymupdf_with_scaling(input_folder: str, input_files: list, output_folder: str, output_file: str, frame_file: str,
+                    template_name: str, layer_scale: float):
     try:
         output = pymupdf.open()
         page = None
@@ -380,6 +892,8 @@ def merge_pdf_pymupdf_with_scaling(input_folder: str, input_files: list, output_
                     page.show_pdf_page(pos,  # select output rect
                                        src,  # input document
                                        overlay=False)
+                output = _within_memory_budget(output, input_folder)
+                page = output[0]
             except Exception:
                 io_file_error_msg(merge_pdf_pymupdf.__name__, filename, input_folder)
                 return False
@@ -392,6 +906,8 @@ def merge_pdf_pymupdf_with_scaling(input_folder: str, input_files: list, output_
         output.set_toc(toc)
 
         output.save(os.path.join(output_folder, output_file))
+        output.close()
+        _remove_flush_file(output.name)
 
     except Exception:
         io_file_error_msg(merge_pdf_pymupdf.__name__, output_file, output_folder)
@@ -400,16 +916,18 @@ def merge_pdf_pymupdf_with_scaling(input_folder: str, input_files: list, output_
     return True
 
 def merge_pdf_pypdf(input_folder: str, input_files: list, output_folder: str, output_file: str, frame_file: str,
-                    scale_or_crop: dict, layer_scale: float, template_use_popups: bool, template_name: str):
+                    scale_or_crop: dict, layer_scale: float, template_use_popups: bool, template_name: str,
+                    crop_pdf=None):
+    # The crop and scale methods of the template are not supported, only layer_scale.
     try:
         page = None
         for filename in input_files:
             try:
                 filepath = os.path.join(input_folder, filename)
-                pdf_reader = PdfReader(filepath)
-                src_page: PageObject = pdf_reader.pages[0]
+                pdf_reader = pypdf.PdfReader(filepath)
+                src_page = pdf_reader.pages[0]
 
-                op = Transformation()
+                op = pypdf.Transformation()
                 if layer_scale > 1.0:
                     if filename == frame_file:
                         x_offset = src_page.mediabox.width * (layer_scale - 1.0) / 2
@@ -419,7 +937,7 @@ def merge_pdf_pypdf(input_folder: str, input_files: list, output_folder: str, ou
                         op = op.scale(layer_scale)
 
                 if page is None:
-                    page = PageObject.create_blank_page(width=src_page.mediabox.width * layer_scale,
+                    page = pypdf.PageObject.create_blank_page(width=src_page.mediabox.width * layer_scale,
                                                         height=src_page.mediabox.height * layer_scale)
                     page.cropbox.lower_left = ((page.mediabox.width - src_page.mediabox.width) / 2,
                                                (page.mediabox.height - src_page.mediabox.height) / 2)
@@ -436,7 +954,7 @@ def merge_pdf_pypdf(input_folder: str, input_files: list, output_folder: str, ou
                 io_file_error_msg(merge_pdf_pypdf.__name__, filename, input_folder, error_bitmap)
                 return False
 
-        output = PdfWriter()
+        output = pypdf.PdfWriter()
         output.add_page(page)
         output.add_outline_item(title=template_name, page_number=0)
         with open(os.path.join(output_folder, output_file), "wb") as output_stream:
@@ -449,9 +967,13 @@ def merge_pdf_pypdf(input_folder: str, input_files: list, output_folder: str, ou
     return True
 
 
+# Each incremental update appends to the assembly pdf, after this many the whole file is written again.
+MAX_INCREMENTAL_UPDATES = 8
+
+
 def create_pdf_from_pages(input_folder, input_files, output_folder, output_file, use_popups):
     try:
-        output = PdfWriter()
+        output = pypdf.PdfWriter()
         for filename in input_files:
             try:
                 output.append(os.path.join(input_folder, filename))
@@ -478,6 +1000,584 @@ def create_pdf_from_pages(input_folder, input_files, output_folder, output_file,
     return True
 
 
+def page_manifest_path(assembly_path: str) -> str:
+    """Hidden file next to the assembly pdf with the template and digest of every page."""
+    folder, name = os.path.split(assembly_path)
+    return os.path.join(folder, f".{name}.pages.json")
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# The file ID and dates differ every time a pdf is saved.
+# PyMuPDF writes the file ID strings in hex or as literal strings
+_pdf_id_string = rb'(?:<[0-9A-Fa-f]*>|\((?:\\.|[^\\)])*\))'
+_volatile_pdf_entries = re.compile(rb'/ID\s*\[\s*%s\s*%s\s*\]|/(?:CreationDate|ModDate)\s*\([^)]*\)'
+                                   % (_pdf_id_string, _pdf_id_string))
+
+
+def pdf_digest(path: str) -> str:
+    """Digest of a pdf file without its file ID and dates, equal for equal content."""
+    with open(path, 'rb') as f:
+        return hashlib.sha1(_volatile_pdf_entries.sub(b'', f.read())).hexdigest()
+
+
+def source_date() -> str:
+    """The pdf date of SOURCE_DATE_EPOCH, see reproducible-builds.org, '' if it isn't set."""
+    epoch = os.environ.get('SOURCE_DATE_EPOCH', '')
+    if not epoch.isdigit():
+        return ''
+    return time.strftime('D:%Y%m%d%H%M%SZ', time.gmtime(int(epoch)))
+
+
+_uuid_string = re.compile(rb'\([0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}\)')
+# Replaced by the digest of the saved file, the trailer is written last
+_placeholder_id = b'/ID[<%s><%s>]' % (b'0' * 32, b'0' * 32)
+
+
+def make_reproducible(input_path: str, output_path: str) -> bool:
+    """Write `input_path` so the same content always gives the same bytes: the creation and modification dates are
+    source_date() or removed without it, the objects are numbered in the order of the compacted xref table and the
+    file ID is the md5 of the file. `output_path` may be `input_path`."""
+    try:
+        with pymupdf.open(input_path) as doc:
+            date = source_date()
+            doc.set_metadata({**doc.metadata, 'creationDate': date, 'modDate': date})
+            # pypdf names the popup menu javascript by a random uuid, numbered in order they stay sorted
+            kind, names = doc.xref_get_key(doc.pdf_catalog(), 'Names/JavaScript/Names')
+            if kind == 'array':
+                numbers = iter(range(len(names)))
+                doc.xref_set_key(doc.pdf_catalog(), 'Names/JavaScript/Names',
+                                 _uuid_string.sub(lambda _: b'(B2PScript%04d)' % next(numbers), names.encode()).decode())
+            doc.xref_set_key(-1, 'ID', _placeholder_id[3:].decode())
+            data = doc.tobytes(garbage=3, deflate=True, no_new_id=True)
+        at = data.rindex(_placeholder_id)
+        digest = hashlib.md5(data).hexdigest().upper().encode()
+        with open(output_path, 'wb') as f:
+            f.write(data[:at] + b'/ID[<%s><%s>]' % (digest, digest) + data[at + len(_placeholder_id):])
+    except Exception:
+        io_file_error_msg(make_reproducible.__name__, os.path.basename(input_path), os.path.dirname(input_path))
+        return False
+
+    return True
+
+
+def write_page_manifest(input_folder: str, input_files: list, assembly_path: str, templates: list, use_popups: bool,
+                        updates: int = 0) -> bool:
+    """Record which template file made each page of `assembly_path`, for update_pdf_pages."""
+    manifest = {'version': 1, 'pdf': file_digest(assembly_path), 'use_popups': use_popups, 'updates': updates,
+                'pages': [{'template': template, 'digest': pdf_digest(os.path.join(input_folder, filename))}
+                          for template, filename in zip(templates, input_files)]}
+    try:
+        with open(page_manifest_path(assembly_path), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    except OSError:
+        _logger.warning(f'unable to write the page manifest of {assembly_path=}', exc_info=True)
+        return False
+    return True
+
+
+def update_pdf_pages(input_folder: str, input_files: list, assembly_path: str, templates: list,
+                     use_popups: bool) -> bool | None:
+    """Replace the pages of the changed templates in an existing assembly pdf, with an incremental update.
+
+    The page objects are kept and only get new contents, resources and annotations, so the outline and the popup
+    javascript stay as they are. Returns None if the pdf can't be patched safely: without a manifest matching the
+    pdf, with other templates or popup setting, or after MAX_INCREMENTAL_UPDATES. The whole file has to be
+    written then.
+    """
+    try:
+        with open(page_manifest_path(assembly_path), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != 1 or manifest['pdf'] != file_digest(assembly_path):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    if (manifest['use_popups'] != use_popups or [page['template'] for page in manifest['pages']] != templates
+            or manifest['updates'] >= MAX_INCREMENTAL_UPDATES):
+        return None
+
+    digests = [pdf_digest(os.path.join(input_folder, filename)) for filename in input_files]
+    changed = [i for i, (page, digest) in enumerate(zip(manifest['pages'], digests)) if page['digest'] != digest]
+    _logger.info(f'{changed=} of {len(templates)} pages')
+    if len(changed) == len(templates):
+        return None
+    if not changed:
+        return True
+
+    try:
+        output = pypdf.PdfWriter(assembly_path, incremental=True)
+        if len(output.pages) != len(templates):
+            return None
+        for i in changed:
+            page = output.pages[i]
+            new_page = pypdf.PdfReader(os.path.join(input_folder, input_files[i])).pages[0]
+            for key in list(page.keys()):
+                if key not in ('/Type', '/Parent'):
+                    del page[key]
+            # /P of the annotations points to the page they are copied from
+            for key, value in new_page.items():
+                if key not in ('/Type', '/Parent'):
+                    page[pypdf.generic.NameObject(key)] = value.clone(output, ignore_fields=('/P', '/Parent'))
+            for annotation in page.get('/Annots', []):
+                annotation.get_object()[pypdf.generic.NameObject('/P')] = page.indirect_reference
+            page.compress_content_streams()
+
+        # Written next to the pdf first, a pdf viewer may have it open
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(assembly_path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            output.write(f)
+        shutil.copymode(assembly_path, temp_path)
+        os.replace(temp_path, assembly_path)
+    except:
+        io_file_error_msg(update_pdf_pages.__name__, os.path.basename(assembly_path), os.path.dirname(assembly_path))
+        return False
+
+    write_page_manifest(input_folder, input_files, assembly_path, templates, use_popups, manifest['updates'] + 1)
+    return True
+
+
+# Images drawn this many times larger than the resolution asked for are downsampled, smaller ones only recompressed
+DOWNSAMPLE_OVER = 1.5
+JPEG_QUALITY = 85
+
+
+class ImageSavings(NamedTuple):
+    """Images of the assembly pdf and its size before and after optimize_images."""
+    images: int
+    duplicates: int  # images with the same content as another one
+    downsampled: int
+    bytes_before: int
+    bytes_after: int
+
+    def describe(self) -> str:
+        return (f"{self.images} images, {self.duplicates} duplicates, {self.downsampled} downsampled, "
+                f"{tracing.format_bytes(self.bytes_before)} -> {tracing.format_bytes(self.bytes_after)}")
+
+
+# The pdf the images are read from in the optimize_images workers
+_image_doc = None
+
+
+def _open_image_doc(path: str):
+    global _image_doc
+    _image_doc = pymupdf.open(path)
+
+
+def _recompress_image(task: tuple) -> tuple | None:
+    # Runs in the pool: the image `xref` and its soft mask `smask` (0 without) at width x height, as jpeg if the
+    # image was a jpeg. Returns the stream, filter, color space and soft mask stream, None for unsupported images.
+    xref, smask, width, height, jpeg = task
+    pixmap = pymupdf.Pixmap(_image_doc, xref)
+    if pixmap.alpha:
+        pixmap = pymupdf.Pixmap(pixmap, 0)
+    colorspace = {1: 'DeviceGray', 3: 'DeviceRGB', 4: 'DeviceCMYK'}.get(pixmap.n)
+    if colorspace is None:
+        return None
+    if (width, height) != (pixmap.width, pixmap.height):
+        pixmap = pymupdf.Pixmap(pixmap, width, height, None)
+    if jpeg and pixmap.n != 4:
+        data, image_filter = pixmap.tobytes('jpeg', jpg_quality=JPEG_QUALITY), 'DCTDecode'
+    else:
+        data, image_filter = zlib.compress(pixmap.samples, 9), 'FlateDecode'
+    mask = None
+    if smask:
+        mask_pixmap = pymupdf.Pixmap(_image_doc, smask)
+        if (width, height) != (mask_pixmap.width, mask_pixmap.height):
+            mask_pixmap = pymupdf.Pixmap(mask_pixmap, width, height, None)
+        mask = zlib.compress(mask_pixmap.samples, 9)
+    return data, image_filter, colorspace, mask
+
+
+_reference = re.compile(r'(\d+) \d+ R')
+
+
+def _object_digest(doc, xref: int, depth: int = 0) -> str:
+    # Content of an object and the objects it refers to, the same for the copies the pdf libraries make of it
+    text = doc.xref_object(xref, compressed=True)
+    if depth < 4:
+        text = _reference.sub(lambda match: _object_digest(doc, int(match.group(1)), depth + 1), text)
+    digest = hashlib.sha1(text.encode())
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref))
+    return digest.hexdigest()
+
+
+def _set_image(doc, xref: int, data: bytes, image_filter: str, colorspace: str, width: int, height: int):
+    doc.update_stream(xref, data, compress=0)
+    for key, value in (('Filter', f'/{image_filter}'), ('ColorSpace', f'/{colorspace}'), ('BitsPerComponent', '8'),
+                       ('Width', str(width)), ('Height', str(height)), ('DecodeParms', 'null'), ('Matte', 'null')):
+        doc.xref_set_key(xref, key, value)
+
+
+def optimize_images(path: str, dpi: int, jobs: int = 1) -> ImageSavings | None:
+    """Rewrite the images of the pdf `path` in place: images with the same content are stored once, images drawn at
+    more than `dpi` are downsampled to it and all of them are recompressed, in `jobs` processes (0 for one per
+    cpu). Image masks, images with a decode array and inline images are left alone. Returns None if it failed."""
+    try:
+        bytes_before = os.path.getsize(path)
+        with pymupdf.open(path) as doc:
+            # The most pixels every image needs, over every place it's drawn at
+            needed = {}
+            for page in doc:
+                for info in page.get_image_info(xrefs=True):
+                    xref = info['xref']
+                    if not xref:
+                        continue
+                    a, b, c, d = info['transform'][:4]
+                    width, height = needed.get(xref, (0.0, 0.0))
+                    needed[xref] = (max(width, math.hypot(a, b) * dpi / 72), max(height, math.hypot(c, d) * dpi / 72))
+
+            groups = {}
+            for xref in needed:
+                if (doc.xref_get_key(xref, 'ImageMask')[1] == 'true' or doc.xref_get_key(xref, 'Decode')[0] != 'null'
+                        or doc.xref_get_key(xref, 'Mask')[0] != 'null'):
+                    continue
+                kind, value = doc.xref_get_key(xref, 'SMask')
+                smask = int(value.split()[0]) if kind == 'xref' else 0
+                groups.setdefault(_object_digest(doc, xref), []).append((xref, smask))
+
+            # One task for all copies of an image
+            tasks = []
+            task_members = []
+            for members in groups.values():
+                xref, smask = members[0]
+                width, height = int(doc.xref_get_key(xref, 'Width')[1]), int(doc.xref_get_key(xref, 'Height')[1])
+                scale = max(max(needed[member][0] / width, needed[member][1] / height) for member, _ in members)
+                jpeg = doc.xref_get_key(xref, 'Filter')[1] == '/DCTDecode'
+                if scale * DOWNSAMPLE_OVER < 1:
+                    tasks.append((xref, smask, max(1, round(width * scale)), max(1, round(height * scale)), jpeg))
+                elif not jpeg:
+                    tasks.append((xref, smask, width, height, jpeg))
+                else:
+                    continue
+                task_members.append(members)
+
+            jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+            if jobs > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_open_image_doc,
+                                                            initargs=(path,)) as pool:
+                    results = list(pool.map(_recompress_image, tasks))
+            else:
+                _open_image_doc(path)
+                try:
+                    results = [_recompress_image(task) for task in tasks]
+                finally:
+                    _image_doc.close()
+
+            downsampled = 0
+            for task, members, recompressed in zip(tasks, task_members, results):
+                xref, smask, width, height, _ = task
+                if recompressed is None:
+                    continue
+                data, image_filter, colorspace, mask = recompressed
+                old_size = len(doc.xref_stream_raw(xref)) + (len(doc.xref_stream_raw(smask)) if smask else 0)
+                if len(data) + len(mask or b'') >= old_size:
+                    continue
+                downsampled += width != int(doc.xref_get_key(xref, 'Width')[1])
+                # The copies get the same objects, saving merges them
+                for member, member_smask in members:
+                    _set_image(doc, member, data, image_filter, colorspace, width, height)
+                    if member_smask:
+                        _set_image(doc, member_smask, mask, 'FlateDecode', 'DeviceGray', width, height)
+
+            # Written next to the pdf first, a pdf viewer may have it open
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            os.close(fd)
+            doc.save(temp_path, garbage=4, deflate=True)
+        os.replace(temp_path, path)
+    except Exception:
+        io_file_error_msg(optimize_images.__name__, os.path.basename(path), os.path.dirname(path))
+        return None
+
+    return ImageSavings(sum(len(members) for members in groups.values()),
+                        sum(len(members) - 1 for members in groups.values()), downsampled, bytes_before,
+                        os.path.getsize(path))
+
+
+TILE_FORMATS = ('png', 'jpeg', 'webp')
+# Memory of a tile worker besides the display list of the page, and the display list per byte of the pdf
+TILE_WORKER_MEMORY = 64 << 20
+DISPLAY_LIST_PER_PDF_BYTE = 8
+
+
+@functools.lru_cache(maxsize=None)
+def pillow_loaded() -> bool:
+    """Import Pillow, returns False if it's not available."""
+    try:
+        importlib.import_module('PIL.Image')
+    except Exception:
+        return False
+    return True
+
+
+class TilePyramid(NamedTuple):
+    """Deep zoom tiles of a template page written by export_tiles."""
+    template: str
+    dzi_file: str
+    tiles: int
+    rendered: int  # the tiles of changed parts of the page, the others are kept from the last export
+
+    def describe(self) -> str:
+        return f"{self.template}: {self.rendered} of {self.tiles} tiles rendered, {self.dzi_file}"
+
+
+# The display list of the page the tiles are rendered from in the export_tiles workers
+_tile_page = None
+
+
+def _open_tile_page(path: str):
+    global _tile_page
+    with pymupdf.open(path) as doc:
+        _tile_page = doc[0].get_displaylist()
+
+
+def _render_tile(task: tuple):
+    # Runs in the pool: writes the tile with `clip` of the page at `zoom` to `path`
+    path, zoom, clip, tile_format = task
+    pixmap = _tile_page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), clip=pymupdf.Rect(clip), alpha=False)
+    if tile_format == 'webp':
+        pixmap.pil_save(path, format='WEBP', quality=90)
+    else:
+        pixmap.save(path, output=tile_format)
+
+
+def _tile_items(page) -> list[tuple[tuple, bytes]]:
+    # The bbox of everything drawn on the page and what is drawn there, anything changing on a tile changes these
+    items = []
+    for path in page.get_cdrawings():
+        path.pop('seqno', None)
+        items.append((path['rect'], repr(sorted(path.items())).encode()))
+    for span in page.get_texttrace():
+        span.pop('seqno', None)
+        items.append((span['bbox'], repr(sorted(span.items())).encode()))
+    for image in page.get_image_info(hashes=True):
+        items.append((image['bbox'], repr((image['digest'], image['transform'])).encode()))
+    return items
+
+
+def export_tiles(pdf_path: str, dzi_path: str, tile_format: str, tile_size: int, dpi: int, jobs: int = 1,
+                 salt: str = '') -> tuple[int, int] | None:
+    """Write the first page of `pdf_path` as a deep zoom image: `dzi_path` and the tiles of every level in the
+    _files folder next to it, the finest level at `dpi`. Tiles are only rendered again if what is drawn on them
+    changed since the last export to `dzi_path` with the same settings and `salt`, which are kept in tiles.json.
+    The tiles are rendered in `jobs` processes (0 for one per cpu), fewer with a memory budget. Returns the number
+    of tiles and of rendered tiles, None if it failed."""
+    try:
+        files_dir = os.path.splitext(dzi_path)[0] + '_files'
+        manifest_path = os.path.join(files_dir, 'tiles.json')
+        extension = 'jpg' if tile_format == 'jpeg' else tile_format
+        with pymupdf.open(pdf_path) as doc:
+            page = doc[0]
+            rect = page.rect
+            width, height = math.ceil(rect.width * dpi / 72), math.ceil(rect.height * dpi / 72)
+            levels = max(width, height).bit_length() if max(width, height) > 1 else 0
+            if max(width, height) == 1 << (levels - 1):
+                levels -= 1  # a power of two fits exactly
+            settings = {'version': 1, 'salt': salt, 'format': tile_format, 'tile_size': tile_size, 'dpi': dpi,
+                        'width': width, 'height': height}
+
+            # Digests of the finest level tiles from the items drawn on them, a pixel around each item for
+            # antialiasing, the coarser levels from the four tiles under them
+            def grid(level: int) -> tuple[int, int]:
+                scale = 1 << (levels - level)
+                return math.ceil(math.ceil(width / scale) / tile_size), math.ceil(math.ceil(height / scale) / tile_size)
+
+            columns, rows = grid(levels)
+            digests = [[hashlib.sha1() for _ in range(rows)] for _ in range(columns)]
+            zoom = dpi / 72
+            for (x0, y0, x1, y1), item in _tile_items(page):
+                first_column = max(0, int(((x0 - rect.x0) * zoom - 1) // tile_size))
+                last_column = min(columns - 1, int(((x1 - rect.x0) * zoom + 1) // tile_size))
+                first_row = max(0, int(((y0 - rect.y0) * zoom - 1) // tile_size))
+                last_row = min(rows - 1, int(((y1 - rect.y0) * zoom + 1) // tile_size))
+                for column in range(first_column, last_column + 1):
+                    for row in range(first_row, last_row + 1):
+                        digests[column][row].update(item)
+            tiles = {}
+            level_digests = [[digest.hexdigest() for digest in column] for column in digests]
+            for level in range(levels, -1, -1):
+                if level < levels:
+                    columns, rows = grid(level)
+                    finer = level_digests
+                    level_digests = [[hashlib.sha1(''.join(
+                        finer[c][r] for c in (2 * column, 2 * column + 1) for r in (2 * row, 2 * row + 1)
+                        if c < len(finer) and r < len(finer[0])).encode()).hexdigest() for row in range(rows)]
+                        for column in range(columns)]
+                for column, column_digests in enumerate(level_digests):
+                    for row, digest in enumerate(column_digests):
+                        tiles[f'{level}/{column}_{row}'] = (digest, level, column, row)
+
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        if any(manifest.get(key) != value for key, value in settings.items()):
+            shutil.rmtree(files_dir, ignore_errors=True)
+            manifest = {'tiles': {}}
+
+        tasks = []
+        for name, (digest, level, column, row) in tiles.items():
+            path = os.path.join(files_dir, f'{name}.{extension}')
+            if manifest['tiles'].get(name) == digest and os.path.exists(path):
+                continue
+            level_zoom = zoom / (1 << (levels - level))
+            x, y = column * tile_size / level_zoom, row * tile_size / level_zoom
+            clip = (rect.x0 + x, rect.y0 + y, rect.x0 + min(x + tile_size / level_zoom, rect.width),
+                    rect.y0 + min(y + tile_size / level_zoom, rect.height))
+            tasks.append((path, level_zoom, clip, tile_format))
+        for level in range(levels + 1):
+            os.makedirs(os.path.join(files_dir, str(level)), exist_ok=True)
+
+        jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+        budget = _memory_budget.get()
+        if budget is not None:
+            worker_memory = TILE_WORKER_MEMORY + DISPLAY_LIST_PER_PDF_BYTE * os.path.getsize(pdf_path)
+            jobs = max(1, min(jobs, (budget - (tracing.current_rss() or 0)) // worker_memory))
+        if jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_open_tile_page,
+                                                        initargs=(pdf_path,)) as pool:
+                list(pool.map(_render_tile, tasks, chunksize=16))
+        elif tasks:
+            _open_tile_page(pdf_path)
+            for task in tasks:
+                _render_tile(task)
+
+        with open(dzi_path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{extension}" Overlap="0" '
+                    f'TileSize="{tile_size}">\n  <Size Width="{width}" Height="{height}"/>\n</Image>\n')
+        with open(manifest_path, 'w') as f:
+            json.dump({**settings, 'tiles': {name: tile[0] for name, tile in tiles.items()}}, f)
+    except Exception:
+        io_file_error_msg(export_tiles.__name__, os.path.basename(pdf_path), os.path.dirname(pdf_path))
+        return None
+
+    return len(tiles), len(tasks)
+
+
+def linearize_pdf_pikepdf(input_path: str, output_path: str) -> bool:
+    try:
+        pikepdf = importlib.import_module('pikepdf')
+        with pikepdf.open(input_path) as pdf:
+            # The ID is derived from the content, like the one of make_reproducible
+            pdf.save(output_path, linearize=True, deterministic_id=True)
+    except Exception:
+        io_file_error_msg(linearize_pdf_pikepdf.__name__, os.path.basename(input_path), os.path.dirname(input_path))
+        return False
+
+    return True
+
+
+def linearize_pdf_qpdf(input_path: str, output_path: str) -> bool:
+    try:
+        completed = subprocess.run([qpdf_path(), '--linearize', '--deterministic-id', input_path, output_path],
+                                   capture_output=True, text=True)
+        _logger.debug(f"{completed.returncode=} {completed.stdout=} {completed.stderr=}")
+        # 3 is success with warnings
+        if completed.returncode not in (0, 3):
+            raise RuntimeError(completed.stderr)
+    except Exception:
+        io_file_error_msg(linearize_pdf_qpdf.__name__, os.path.basename(input_path), os.path.dirname(input_path))
+        return False
+
+    return True
+
+
+def linearize_pdf_pymupdf(input_path: str, output_path: str) -> bool:
+    try:
+        with pymupdf.open(input_path) as doc:
+            doc.save(output_path, linear=True, garbage=1, no_new_id=True)
+    except Exception:
+        io_file_error_msg(linearize_pdf_pymupdf.__name__, os.path.basename(input_path), os.path.dirname(input_path))
+        return False
+
+    return True
+
+
+_linearization = re.compile(rb'<<[^>]*/Linearized\b[^>]*>>')
+
+
+def _references(value, skip=('/Parent', '/P')):
+    # The indirect objects in a pypdf object, without resolving them
+    if isinstance(value, pypdf.generic.IndirectObject):
+        yield value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if key not in skip:
+                yield from _references(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _references(item)
+
+
+def linearized_first_page(path: str) -> int | None:
+    """Bytes at the start of a linearized pdf enough to show its first page, like a browser does while the rest of
+    the file is downloaded. None if `path` isn't linearized, was changed after it was (an incremental update) or
+    the first page needs objects further back."""
+    try:
+        with open(path, 'rb') as f:
+            match = _linearization.search(f.read(1024))
+        if match is None:
+            return None
+        parameters = {key.decode(): int(value) for key, value in re.findall(rb'/([LEO])\s+(\d+)', match.group())}
+        if len(parameters) != 3 or parameters['L'] != os.path.getsize(path):
+            return None
+
+        reader = pypdf.PdfReader(path)
+        offsets = {}
+        for generation in reader.xref.values():
+            offsets.update(generation)
+        first_page = parameters['O']
+        todo = [first_page]
+        seen = set()
+        while todo:
+            number = todo.pop()
+            if number in seen:
+                continue
+            seen.add(number)
+            # Objects in an object stream are where the stream is
+            offset = offsets.get(reader.xref_objStm[number][0] if number in reader.xref_objStm else number)
+            if offset is None or offset >= parameters['E']:
+                return None
+            for reference in _references(reader.get_object(number)):
+                # Links to the other pages don't have to be loaded
+                target = reference.get_object()
+                if reference.idnum == first_page or not (isinstance(target, dict)
+                                                          and target.get('/Type') in ('/Page', '/Pages')):
+                    todo.append(reference.idnum)
+    except Exception:
+        _logger.warning(f'unable to read the linearization of {path=}', exc_info=True)
+        return None
+
+    return parameters['E']
+
+
+# The first engine of an operation is used when no library is chosen, see backends.select.
+# Transparent layers are redrawn by PyMuPDF without their annotations, so only opaque layers keep their popups.
+backends.register(backends.Engine('pymupdf', 'colorize', colorize_pdf_pymupdf, transparency=True, popups=True,
+                                  available=pymupdf_loaded))
+backends.register(backends.Engine('pypdf', 'colorize', colorize_pdf_pypdf, popups=True))
+backends.register(backends.Engine('pymupdf', 'merge', merge_pdf_pymupdf, popups=True, scaling=True,
+                                  available=pymupdf_loaded))
+backends.register(backends.Engine('pypdf', 'merge', merge_pdf_pypdf, popups=True))
+backends.register(backends.Engine('pdfcropmargins', 'crop', crop_pdf_pdfcropmargins, available=pdfcropmargins_loaded))
+backends.register(backends.Engine('pymupdf', 'crop', crop_pdf_pymupdf, available=pymupdf_loaded))
+backends.register(backends.Engine('pypdf', 'concat', create_pdf_from_pages, popups=True))
+backends.register(backends.Engine('pikepdf', 'linearize', linearize_pdf_pikepdf, popups=True,
+                                  available=pikepdf_loaded))
+backends.register(backends.Engine('qpdf', 'linearize', linearize_pdf_qpdf, popups=True,
+                                  available=lambda: qpdf_path() is not None))
+backends.register(backends.Engine('pymupdf', 'linearize', linearize_pdf_pymupdf, popups=True,
+                                  available=pymupdf_linearizes))
+
+
 class LayerInfo:
     std_color = "#000000"
     std_transparency = 0
@@ -511,6 +1611,26 @@ class LayerInfo:
         except KeyError:
             self.reference_designator = True
 
+        try:
+            # Simplification tolerance in mm as string, 0 to keep every vertex
+            self.simplify_tolerance = max(float(template["layers_simplify"][layer_name]), 0.0)
+        except (KeyError, ValueError):
+            self.simplify_tolerance = 0.0
+
+        try:
+            # Content stream bytes as string above which the layer is rasterized, 0 to not check them. None to use
+            # the rasterize_over of the run.
+            self.rasterize_over: int | None = max(int(template["layers_rasterize_over"][layer_name]), 0)
+        except (KeyError, ValueError):
+            self.rasterize_over = None
+
+        try:
+            # Painted paths as string above which the layer is rasterized, 0 to not check them. None to use the
+            # rasterize_paths of the run.
+            self.rasterize_paths: int | None = max(int(template["layers_rasterize_paths"][layer_name]), 0)
+        except (KeyError, ValueError):
+            self.rasterize_paths = None
+
         # Check the popup settings.
         self.front_popups = True
         self.back_popups = True
@@ -532,7 +1652,7 @@ class LayerInfo:
         """Checks if the layer transparency is not the standard value (=0%)."""
         return self.transparency_value != self.std_transparency
 
-    @property
+    @functools.cached_property
     def color_rgb(self) -> tuple[float, float, float]:
         """Return (red, green, blue) in float between 0-1."""
         value = self.color_hex.lstrip('#')
@@ -591,105 +1711,543 @@ class Template:
         return f'{self.__class__.__name__}:{{ {var_str} }}'
 
 
+def board_templates(board, templates: dict, enabled_templates: list) -> list[Template]:
+    """The enabled templates of the config, with the layer ids of `board`."""
+    # Build a dict to translate layer names to layerID
+    layer_names = {}
+    for i in range(pcbnew.PCBNEW_LAYER_ID_START, pcbnew.PCBNEW_LAYER_ID_START + pcbnew.PCB_LAYER_ID_COUNT):
+        layer_names[board.GetStandardLayerName(i)] = i
+
+    templates_list: list[Template] = []
+    for t in enabled_templates:
+        # {  "Test-template": {"mirrored": true, "enabled_layers": "B.Fab,B.Mask,Edge.Cuts,F.Adhesive", "frame": "In4.Cu",
+        #          "layers": {"B.Fab": "#000012", "B.Mask": "#000045"}}  }
+        if t in templates:
+            temp = Template(t, templates[t], layer_names)
+            _logger.debug(temp)
+            templates_list.append(temp)
+    return templates_list
+
+
+def plan_board(board, templates: dict, enabled_templates: list, create_svg: bool, layer_scale: float = 1.0,
+               **kwargs) -> plan.Plan:
+    """Compile the work plot_board would do for `board`, nothing is plotted. Extra config vars are ignored.
+    Raises OSError or ValueError if the panel layout can't be read."""
+    panel = None
+    if kwargs.get('panel_layout'):
+        panel = load_panel_layout(panel_layout_path(board, kwargs['panel_layout']), board)
+    return plan.compile_plan(board_templates(board, templates, enabled_templates), layer_scale, create_svg,
+                             kwargs.get('minify_precision', 0.0), kwargs.get('cull_hidden', False),
+                             kwargs.get('rasterize_over', 0), kwargs.get('rasterize_dpi', 300),
+                             DEDUP_TOLERANCE if kwargs.get('dedup_text', False) else 0.0, panel,
+                             kwargs.get('rasterize_paths', 0), kwargs.get('colorize_lib', ''))
+
+
+class PlotCache:
+    """Layer plots and colored layers in the temp dir, shared by the templates of a run and by ini variants."""
+
+    def __init__(self):
+        self.files: dict[str, str] = {}  # plan.node_key -> file name in the temp dir
+
+    def __repr__(self):
+        var_str = ', '.join(f"{key}: {value}" for key, value in vars(self).items())
+        return f'{self.__class__.__name__}:{{ {var_str} }}'
+
+
+class Checkpoint:
+    """The finished plot, colorize and merge steps of a run, saved in the temp dir so --resume can skip them.
+
+    A step is recorded by its plan.node_key with the digests of its output file and input files. It is only
+    reused if the files are unchanged. Plots depend on the board file, the whole checkpoint is dropped when
+    the board file or `settings` (the pdf libraries) changed.
+    """
+    file_name = 'checkpoint.json'
+
+    def __init__(self, temp_dir: str, board_digest: str, settings: dict):
+        self.path: str = os.path.join(temp_dir, self.file_name)
+        self.board_digest: str = board_digest
+        self.settings: dict = settings
+        self.steps: dict[str, dict] = {}  # plan.node_key -> {'file': path, 'digest': ..., 'inputs': {path: digest}}
+
+    @classmethod
+    def load(cls, temp_dir: str, board_digest: str, settings: dict) -> 'Checkpoint':
+        checkpoint = cls(temp_dir, board_digest, settings)
+        try:
+            with open(checkpoint.path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return checkpoint
+        except (OSError, ValueError):
+            _logger.warning(f'unable to read the checkpoint {checkpoint.path=}', exc_info=True)
+            return checkpoint
+        if saved.get('version') == 1 and saved.get('board') == board_digest and saved.get('settings') == settings:
+            checkpoint.steps = saved.get('steps', {})
+        else:
+            _logger.info('the board or the settings changed, the checkpoint is not used')
+        return checkpoint
+
+    def done(self, key: str) -> str | None:
+        """Output file of a finished step, None if it isn't finished or its files changed since."""
+        step = self.steps.get(key)
+        if step is None:
+            return None
+        try:
+            if file_digest(step['file']) != step['digest'] or any(
+                    file_digest(path) != digest for path, digest in step['inputs'].items()):
+                return None
+        except OSError:
+            return None
+        return step['file']
+
+    def add(self, key: str, output_file: str, input_files: list = ()):
+        """Record a finished step and save the checkpoint."""
+        self.steps[key] = {'file': output_file, 'digest': file_digest(output_file),
+                           'inputs': {path: file_digest(path) for path in input_files}}
+        try:
+            # Written atomically, the run may be killed any time
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': 1, 'board': self.board_digest, 'settings': self.settings, 'steps': self.steps},
+                          f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError:
+            _logger.warning(f'unable to save the checkpoint {self.path=}', exc_info=True)
+
+    def __repr__(self):
+        var_str = ', '.join(f"{key}: {value}" for key, value in vars(self).items())
+        return f'{self.__class__.__name__}:{{ {var_str} }}'
+
+
+# Status words of the layer steps, like "Coloring F.Cu" and "Reusing colored F.Cu"
+_layer_step_words = {'simplify': ('Simplifying', 'simplified'), 'colorize': ('Coloring', 'colored'),
+                     'rasterize': ('Rasterizing', 'rasterized'), 'cull': ('Culling', 'culled'), 'minify': ('Minifying', 'minified'),
+                     'dedup': ('Deduplicating', 'deduplicated'), 'panel': ('Panelizing', 'panelized')}
+
+
+class Simplification(NamedTuple):
+    """Vertices and file size of a layer before and after simplify_pdf."""
+    template: str
+    layer: str
+    vertices_before: int
+    vertices_after: int
+    bytes_before: int
+    bytes_after: int
+
+    def describe(self) -> str:
+        return (f"{self.template} {self.layer}: {self.vertices_before} -> {self.vertices_after} vertices, "
+                f"{tracing.format_bytes(self.bytes_before)} -> {tracing.format_bytes(self.bytes_after)}")
+
+
+class LayerComplexity(NamedTuple):
+    """Content stream size of a layer checked for rasterizing, and whether it was rasterized."""
+    template: str
+    layer: str
+    stream_bytes: int
+    paths: int | None  # None without numpy
+    rasterized: bool
+    dpi: int
+
+    def describe(self) -> str:
+        paths = f", {self.paths} paths" if self.paths is not None else ''
+        return (f"{self.template} {self.layer}: {tracing.format_bytes(self.stream_bytes)} content{paths}"
+                + (f", rasterized at {self.dpi} dpi" if self.rasterized else ''))
+
+
+class PlotResult:
+    """Outcome of plot_board. Nothing is shown to the user, that is up to the caller."""
+
+    def __init__(self):
+        self.success: bool = False
+        self.status: str = ''  # last progress status
+        self.assembly_file: str = ''  # absolute path of the assembly pdf
+        self.assembly_unchanged: bool = False  # a reproducible run found the same assembly pdf and left it alone
+        self.single_page_files: list[str] = []  # absolute paths of the kept single page pdfs
+        self.svg_files: list[str] = []  # absolute paths of the created svgs
+        self.timings: dict[str, float] = {}  # seconds per stage
+        self.tracer: tracing.Tracer = tracing.Tracer()  # all timed stages of the run
+        self.warnings: list[str] = []
+        self.errors: list[str] = []
+        self.cancelled: bool = False
+        self.max_memory: int | None = None  # memory budget in bytes
+        self.peak_rss: int | None = None  # peak resident set size of the process during the run in bytes
+        self.simplified: list[Simplification] = []  # the layers simplified in this run
+        self.layer_complexity: list[LayerComplexity] = []  # the layers checked for rasterizing in this run
+        self.image_savings: ImageSavings | None = None  # None if the images weren't optimized
+        self.tile_pyramids: list[TilePyramid] = []  # the deep zoom images of the template pages
+
+    @property
+    def outputs(self) -> list[str]:
+        return (([self.assembly_file] if self.assembly_file else []) + self.single_page_files + self.svg_files
+                + [pyramid.dzi_file for pyramid in self.tile_pyramids])
+
+    def summary(self) -> str:
+        """The message shown when everything is done."""
+        msg = ("Assembly pdf unchanged: " if self.assembly_unchanged else "Assembly pdf created: ") + self.assembly_file
+        if self.single_page_files:
+            msg += "\n\nSingle page pdf files created:"
+            for filename in self.single_page_files:
+                msg += "\n" + filename
+
+        if self.svg_files:
+            msg += "\n\nSVG files created:"
+            for filename in self.svg_files:
+                msg += "\n" + filename
+
+        if self.simplified:
+            msg += "\n\nSimplified layers:"
+            for simplified in self.simplified:
+                msg += "\n" + simplified.describe()
+
+        rasterized = [layer for layer in self.layer_complexity if layer.rasterized]
+        if rasterized:
+            msg += "\n\nRasterized layers:"
+            for layer in rasterized:
+                msg += "\n" + layer.describe()
+
+        if self.tile_pyramids:
+            msg += "\n\nDeep zoom tiles created:"
+            for pyramid in self.tile_pyramids:
+                msg += "\n" + pyramid.describe()
+
+        if self.image_savings:
+            msg += "\n\nImages: " + self.image_savings.describe()
+
+        if self.max_memory:
+            msg += (f"\n\nPeak memory use: {tracing.format_bytes(self.peak_rss)} "
+                    f"(budget {tracing.format_bytes(self.max_memory)})")
+        return msg
+
+    def __repr__(self):
+        var_str = ', '.join(f"{key}: {value}" for key, value in vars(self).items())
+        return f'{self.__class__.__name__}:{{ {var_str} }}'
+
+
+def report_result(result: PlotResult, msg_box):
+    """Show the errors, warnings and the final message of `result` through `msg_box(text, caption, flags)`."""
+    for error in result.errors:
+        msg_box(error, 'Error', msg_flags('ICON_ERROR'))
+    for warning in result.warnings:
+        msg_box(warning, 'Warning', msg_flags('ICON_WARNING'))
+    if result.success:
+        msg_box(result.summary(), 'All done!', msg_flags())
+
+
 def plot_pdfs(board, output_path, templates, enabled_templates, del_temp_files, create_svg, del_single_page_files,
                  dlg=None, **kwargs) -> bool:
-    asy_file_extension = kwargs.pop('assembly_file_extension', '__Assembly')
-    layer_scale = kwargs.pop('layer_scale', 1.0)
-    colorize_lib: str = kwargs.pop('colorize_lib', '')
-    merge_lib: str = kwargs.pop('merge_lib', '')
+    """Plot the enabled templates of `board` and create the assembly pdf.
 
+    Progress and messages go to `dlg` when it's a wx.Panel, with the plot running in a job.PlotJob, else to
+    stdout. Callers that want the result instead of message boxes use plot_board.
+    """
     if dlg is None:
-        use_pymupdf = has_pymupdf or create_svg
-        pymupdf_pdf = has_pymupdf and colorize_lib != 'pypdf'
-        pymupdf_merge = has_pymupdf and merge_lib != 'pypdf'
-
         def set_progress_status(progress: int, status: str):
             print(f'{int(progress):3d}%: {status}')
 
         def msg_box(text, caption, flags):
             print(f"{caption}: {text}")
 
-    elif isinstance(dlg, wx.Panel):
-        pymupdf_pdf = dlg.m_radio_pymupdf.GetValue()
-        pymupdf_merge = dlg.m_radio_merge_pymupdf.GetValue()
-        use_pymupdf = pymupdf_pdf or pymupdf_merge or create_svg
-
-        def set_progress_status(progress: int, status: str):
-            dlg.m_staticText_status.SetLabel(f'Status: {status}')
-            dlg.m_progress.SetValue(int(progress))
-            dlg.Refresh()
-            dlg.Update()
-
-        def msg_box(text, caption, flags):
-            wx.MessageBox(text, caption, flags)
+    elif _wx() is not None and isinstance(dlg, _wx().Panel):
+        # The plot runs on a worker thread so the wx main loop isn't blocked, see job.plot_from_dialog
+        try:
+            from . import job
+        except ImportError:
+            import job
+        return job.plot_from_dialog(dlg, board, dict(
+            output_path=output_path, templates=templates, enabled_templates=enabled_templates,
+            del_temp_files=del_temp_files, create_svg=create_svg, del_single_page_files=del_single_page_files,
+            **kwargs))
     else:
         print(f"Error: Unknown dialog type {type(dlg)}", file=sys.stderr)
         return False
 
-    if use_pymupdf and not has_pymupdf:
-        msg_box(
-            "PyMuPdf wasn't loaded.\n\nIt must be installed for it to be used for coloring, for merging and for creating SVGs.\n\nMore information under Install dependencies in the Wiki at board2pdf.dennevi.com",
-            'Error', wx.OK | wx.ICON_ERROR)
-        set_progress_status(100, "Failed to load PyMuPDF.")
+    result = plot_board(board, output_path, templates, enabled_templates, del_temp_files, create_svg,
+                        del_single_page_files, progress_callback=set_progress_status, **kwargs)
+    report_result(result, msg_box)
+    return result.success
+
+
+def plot_board(board, output_path, templates, enabled_templates, del_temp_files, create_svg, del_single_page_files,
+               progress_callback=None, cancel_token: CancelToken = None, **kwargs) -> PlotResult:
+    """Reentrant core of plot_pdfs.
+
+    All paths are resolved from the board file name, the working directory is never changed, and the title
+    block of the board is restored afterward. Errors are collected in the returned PlotResult instead of being
+    shown, so several boards can be plotted from one process. Progress is reported through
+    `progress_callback(progress, status)` and `cancel_token` is checked between layers and stages.
+    With `profile_dir` every stage is profiled with cProfile and tracemalloc, see tracing.Profiler.
+    With `reset_peak_rss` the stages measure their own memory peaks, which resets the peak of the whole process,
+    see tracing.Tracer.
+    With `max_memory` (bytes) the pdf functions trade speed for memory, see _within_memory_budget.
+    Progress is weighted by the stage costs of earlier runs from `cost_model` (default: costs.CostModel.load()),
+    which is updated with the timings of a successful run.
+    """
+    result = PlotResult()
+    if kwargs.pop('reset_peak_rss', False):
+        result.tracer = tracing.Tracer(reset_peak=True)
+    profile_dir = kwargs.pop('profile_dir', None)
+    if profile_dir:
+        result.tracer.profiler = tracing.Profiler(profile_dir)
+    cost_model: costs.CostModel = kwargs.pop('cost_model', None) or costs.CostModel.load()
+    result.max_memory = kwargs.pop('max_memory', None)
+
+    def set_progress_status(progress: int, status: str):
+        result.status = status
+        if progress_callback is not None:
+            progress_callback(progress, status)
+
+    token = _message_sink.set(lambda text, caption, flags: result.errors.append(text))
+    budget_token = _memory_budget.set(result.max_memory)
+    try:
+        with result.tracer.activate():
+            result.success = _plot_board(board, output_path, templates, enabled_templates, del_temp_files,
+                                         create_svg, del_single_page_files, result, set_progress_status, cancel_token,
+                                         cost_model=cost_model, **kwargs)
+    finally:
+        _memory_budget.reset(budget_token)
+        _message_sink.reset(token)
+        if result.tracer.profiler is not None:
+            result.tracer.profiler.close()
+    result.peak_rss = result.tracer.peak_rss()
+    if result.max_memory and result.peak_rss and result.peak_rss > result.max_memory:
+        result.warnings.append(f"The peak memory use of {tracing.format_bytes(result.peak_rss)} was over the budget "
+                               f"of {tracing.format_bytes(result.max_memory)}.")
+    result.timings = {name: total['wall'] for name, total in result.tracer.totals('name').items()}
+    if result.success:
+        cost_model.update(os.path.abspath(board.GetFileName()), result.tracer.spans, result.peak_rss)
+        cost_model.save()
+    return result
+
+
+def plot_variants(board, variants: list[dict], progress_callback=None, cancel_token: CancelToken = None) -> list[PlotResult]:
+    """Plot several configurations (ini variants) of one board, each layer/option combination is plotted once.
+
+    `variants` holds the config vars of each variant, as returned by Persistence.load. All variants plot to
+    one temp dir which is removed afterward if every variant has del_temp_files set, after a failure too unless it
+    can be resumed. Returns a PlotResult per variant, a failed variant doesn't stop the others.
+    """
+    # Nothing in an OS temp dir can be resumed, it is removed however the variants end
+    os_temp_dir = all(v.get('del_temp_files', True) and not v.get('resume') for v in variants)
+    if os_temp_dir:
+        temp_dir = tempfile.mkdtemp()
+    else:
+        board_dir = os.path.dirname(os.path.abspath(board.GetFileName()))
+        output_path = next(v.get('output_path', 'plot') for v in variants
+                           if not v.get('del_temp_files', True) or v.get('resume'))
+        temp_dir = os.path.join(board_dir, os.path.expanduser(os.path.expandvars(output_path)), "temp")
+
+    plot_cache = PlotCache()
+    cost_model = costs.CostModel.load()
+    results = []
+    try:
+        for i, config_vars in enumerate(variants):
+            def variant_progress(progress: int, status: str, i=i):
+                if progress_callback is not None:
+                    progress_callback((i * 100 + progress) / len(variants), f"[{i + 1}/{len(variants)}] {status}")
+
+            results.append(plot_board(board, progress_callback=variant_progress, cancel_token=cancel_token,
+                                      temp_dir=temp_dir, plot_cache=plot_cache, cost_model=cost_model, **config_vars))
+            if results[-1].cancelled:
+                break
+    finally:
+        # The checkpoint of a resumable run is kept until every variant succeeded
+        if os_temp_dir or (all(v.get('del_temp_files', True) for v in variants)
+                           and len(results) == len(variants) and all(result.success for result in results)):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+
+def _plot_board(board, output_path, templates, enabled_templates, del_temp_files, create_svg, del_single_page_files,
+                result: PlotResult, set_progress_status, cancel_token: CancelToken, **kwargs) -> bool:
+    asy_file_extension = kwargs.pop('assembly_file_extension', '__Assembly')
+    layer_scale = kwargs.pop('layer_scale', 1.0)
+    # mm the numbers of the layer pdfs are rounded to, 0 to not minify them
+    minify_precision: float = kwargs.pop('minify_precision', 0.0)
+    # Drop the paths of layers hidden by the opaque layers over them
+    cull_hidden: bool = kwargs.pop('cull_hidden', False)
+    # Layers with more content stream bytes or more painted paths are rendered to an image at rasterize_dpi, 0 to
+    # not check that measure. The layers_rasterize_over and layers_rasterize_paths of a template replace them.
+    rasterize_over: int = kwargs.pop('rasterize_over', 0)
+    rasterize_paths: int = kwargs.pop('rasterize_paths', 0)
+    rasterize_dpi: int = kwargs.pop('rasterize_dpi', 300)
+    # Draw the glyphs of text repeated in a layer once as form xobjects
+    dedup_text: bool = kwargs.pop('dedup_text', False)
+    # Json file with the copies of the board on a panel, see load_panel_layout, '' to plot the board alone
+    panel_layout: str = kwargs.pop('panel_layout', '')
+    # Images of the assembly pdf drawn at a higher resolution are downsampled to image_dpi, 0 to leave them alone.
+    # They are optimized in image_jobs processes, 0 for one per cpu.
+    image_dpi: int = kwargs.pop('image_dpi', 0)
+    image_jobs: int = kwargs.pop('image_jobs', 1)
+    # '' for the first engine that can do the job, 'auto' for the fastest one, or the name of an engine.
+    colorize_lib: str = kwargs.pop('colorize_lib', '')
+    merge_lib: str = kwargs.pop('merge_lib', '')
+    crop_lib: str = kwargs.pop('crop_lib', '')
+    # Only replace the pages of changed templates in the assembly pdf of the last run
+    incremental: bool = kwargs.pop('incremental', False)
+    # Write the assembly pdf linearized, a browser shows the first page before the whole file is downloaded
+    linearize: bool = kwargs.pop('linearize', False)
+    # The same boards and settings give the same assembly pdf, which is left alone if it didn't change
+    reproducible: bool = kwargs.pop('reproducible', False)
+    # Deep zoom tiles of every template page in one of TILE_FORMATS, '' for none. The finest level is at tile_dpi,
+    # they are rendered in tile_jobs processes, 0 for one per cpu.
+    tile_format: str = kwargs.pop('tile_format', '')
+    tile_size: int = kwargs.pop('tile_size', 256)
+    tile_dpi: int = kwargs.pop('tile_dpi', 600)
+    tile_jobs: int = kwargs.pop('tile_jobs', 1)
+    if tile_format == 'webp' and not pillow_loaded():
+        result.warnings.append("WebP tiles need Pillow, the tiles are written as PNG.")
+        tile_format = 'png'
+    if linearize and incremental:
+        # An incremental update is appended after the linearized file, which is then read like any other pdf
+        result.warnings.append("An incremental update would undo the linearization, the whole assembly pdf is "
+                               "written.")
+        incremental = False
+    if reproducible and incremental:
+        # The updates appended depend on the earlier runs
+        result.warnings.append("Incremental updates aren't reproducible, the whole assembly pdf is written.")
+        incremental = False
+    # Skip the steps recorded as finished in the checkpoint of output_dir/temp
+    resume: bool = kwargs.pop('resume', False)
+    # plot_variants passes a temp dir and a cache shared by all variants, the temp dir is then removed by it.
+    temp_dir: str | None = kwargs.pop('temp_dir', None)
+    plot_cache: PlotCache = kwargs.pop('plot_cache', None) or PlotCache()
+    cost_model: costs.CostModel = kwargs.pop('cost_model', None) or costs.CostModel()
+    own_temp_dir = temp_dir is None
+
+    def fail(status: str, msg: str = '') -> bool:
+        if msg:
+            result.errors.append(msg)
+        set_progress_status(100, status)
         return False
 
-    colorize_pdf = colorize_pdf_pymupdf if pymupdf_pdf else colorize_pdf_pypdf
-    merge_pdf = merge_pdf_pymupdf if pymupdf_merge else merge_pdf_pypdf
-
-    os.chdir(os.path.dirname(board.GetFileName()))
-    output_dir = os.path.abspath(os.path.expanduser(os.path.expandvars(output_path)))
-    if del_temp_files:
+    use_pymupdf = 'pymupdf' in (colorize_lib, merge_lib, crop_lib) or create_svg or panel_layout or reproducible
+    if use_pymupdf and not pymupdf_loaded():
+        return fail("Failed to load PyMuPDF.",
+                    "PyMuPdf wasn't loaded.\n\nIt must be installed for it to be used for coloring, for merging, for panels, for reproducible pdfs and for creating SVGs.\n\nMore information under Install dependencies in the Wiki at board2pdf.dennevi.com")
+    panel = None
+    if panel_layout:
+        panel_layout = panel_layout_path(board, panel_layout)
+        try:
+            panel = load_panel_layout(panel_layout, board)
+        except (OSError, ValueError):
+            return fail("Failed to read the panel layout.", f"Unable to read {panel_layout}\n\n" + traceback.format_exc())
+        if not os.path.exists(panel.frame_board):
+            return fail("Failed to read the panel layout.", f"The panel frame board {panel.frame_board} doesn't exist.")
+    for operation, name in (('colorize', colorize_lib), ('merge', merge_lib), ('crop', crop_lib)):
+        if name and name != backends.AUTO and backends.select(operation, name) is None:
+            return fail(f"Failed to load {name}.", f"The {operation} library {name} isn't available.")
+    if backends.AUTO in (colorize_lib, merge_lib, crop_lib):
+        set_progress_status(0, "Calibrating the pdf libraries...")
+        backends.calibration()
+
+    # Simplifying, culling, minifying and deduplicating need numpy and PyMuPDF, without them the layers are merged
+    # as they are
+    can_rewrite = None
+
+    # Relative paths are relative to the board directory
+    board_dir = os.path.dirname(os.path.abspath(board.GetFileName()))
+    output_dir = os.path.join(board_dir, os.path.expanduser(os.path.expandvars(output_path)))
+    if own_temp_dir and del_temp_files and not resume:
         # in case the files are deleted: use the OS temp directory
         temp_dir = tempfile.mkdtemp()
-    else:
-        temp_dir = os.path.abspath(os.path.join(output_dir, "temp"))
-
-    progress = 5
-    set_progress_status(progress, "Started plotting...")
-
-    plot_controller = pcbnew.PLOT_CONTROLLER(board)
-    plot_options = plot_controller.GetPlotOptions()
+    elif own_temp_dir:
+        temp_dir = os.path.join(output_dir, "temp")
 
     base_filename = os.path.basename(os.path.splitext(board.GetFileName())[0])
     final_assembly_file = base_filename + asy_file_extension + ".pdf"
-    final_assembly_file_with_path = os.path.abspath(os.path.join(output_dir, final_assembly_file))
-
     if "assembly_file_output" in kwargs:
-        final_assembly_file = kwargs.pop('assembly_file_output')
-        final_assembly_file_with_path = str(Path(final_assembly_file_with_path).absolute())
-
+        final_assembly_file = os.path.expanduser(os.path.expandvars(kwargs.pop('assembly_file_output')))
+    final_assembly_file_with_path = os.path.abspath(os.path.join(output_dir, final_assembly_file))
 
     # Create the directory if it doesn't exist already
     os.makedirs(output_dir, exist_ok=True)
 
     # Check if we're able to write to the output file.
     try:
-        # os.access(os.path.join(output_dir, final_assembly_file), os.W_OK)
-        open(os.path.join(output_dir, final_assembly_file), "w")
-    except:
-        msg_box("The output file is not writeable. Perhaps it's open in another application?\n\n"
-                + final_assembly_file_with_path, 'Error', wx.OK | wx.ICON_ERROR)
-        set_progress_status(100, "Failed to write to output file.")
-        return False
+        with open(final_assembly_file_with_path, "a"):
+            pass
+    except OSError:
+        return fail("Failed to write to output file.",
+                    "The output file is not writeable. Perhaps it's open in another application?\n\n"
+                    + final_assembly_file_with_path)
+
+    # Runs keeping their temp files record the finished steps, so a failed run can be resumed
+    checkpoint = None
+    if resume or not del_temp_files:
+        os.makedirs(temp_dir, exist_ok=True)
+        settings = {'version': _version.__version__, 'colorize': colorize_lib, 'merge': merge_lib, 'crop': crop_lib}
+        if panel is not None:
+            # The layout is part of the plan, the frame board isn't
+            settings['panel'] = file_digest(panel.frame_board)
+        checkpoint_type = Checkpoint.load if resume else Checkpoint
+        checkpoint = checkpoint_type(temp_dir, file_digest(os.path.abspath(board.GetFileName())), settings)
+
+    set_progress_status(5, "Started plotting...")
 
+    plot_controller = pcbnew.PLOT_CONTROLLER(board)
+    plot_options = plot_controller.GetPlotOptions()
     plot_options.SetOutputDirectory(temp_dir)
-
-    # Build a dict to translate layer names to layerID
-    layer_names = {}
-    for i in range(pcbnew.PCBNEW_LAYER_ID_START, pcbnew.PCBNEW_LAYER_ID_START + pcbnew.PCB_LAYER_ID_COUNT):
-        layer_names[board.GetStandardLayerName(i)] = i
-
-    steps: int = 2  # number of process steps
-    templates_list: list[Template] = []
-    for t in enabled_templates:
-        # {  "Test-template": {"mirrored": true, "enabled_layers": "B.Fab,B.Mask,Edge.Cuts,F.Adhesive", "frame": "In4.Cu",
-        #          "layers": {"B.Fab": "#000012", "B.Mask": "#000045"}}  }
-        if t in templates:
-            temp = Template(t, templates[t], layer_names)
-            _logger.debug(temp)
-            steps += 1 + temp.steps
-            templates_list.append(temp)
-    progress_step: float = 95 / steps
+    controllers = [plot_controller]
+    frame_board = None
+    if panel is not None:
+        try:
+            frame_board = pcbnew.LoadBoard(panel.frame_board)
+        except Exception:
+            return fail("Failed to load the panel frame board.", traceback.format_exc())
+        frame_controller = pcbnew.PLOT_CONTROLLER(frame_board)
+        frame_controller.GetPlotOptions().SetOutputDirectory(temp_dir)
+        controllers.append(frame_controller)
+
+    def cancelled() -> bool:
+        """Check the cancel token, on cancel the open plot is closed and the temp files are removed unless they
+        can be resumed."""
+        if cancel_token is None or not cancel_token.cancelled:
+            return False
+        for controller in controllers:
+            controller.ClosePlot()
+        if checkpoint is None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        result.cancelled = True
+        set_progress_status(100, "Cancelled.")
+        return True
+
+    templates_list = board_templates(board, templates, enabled_templates)
+    board_plan = plan.compile_plan(templates_list, layer_scale, create_svg, minify_precision, cull_hidden,
+                                   rasterize_over, rasterize_dpi, DEDUP_TOLERANCE if dedup_text else 0.0, panel,
+                                   rasterize_paths, colorize_lib)
+
+    # Progress is weighted by the cost of each step in earlier runs of this board, shared nodes cost nothing
+    # the second time.
+    board_key = os.path.abspath(board.GetFileName())
+    predicted = plan.predicted_costs(board_plan, cost_model, board_key)
+    estimate = costs.ProgressEstimate()
+    planned = set()
+
+    def add_step(node: plan.Node, stage: str, template: str = '', layer: str = ''):
+        estimate.add(0.0 if node in planned else predicted.get(node, 0.0), stage, template, layer)
+        planned.add(node)
+
+    for template_plan in board_plan.templates:
+        for node in template_plan.plots + template_plan.frame_plots:
+            add_step(node, 'plot', template_plan.name, node.layer)
+        for node in template_plan.layers + tuple(template_plan.frame_layers):
+            for step in plan.layer_steps(node):
+                add_step(step, plan.stage(step), template_plan.name, step.layer)
+        add_step(template_plan.merge, 'merge', template_plan.name)
+    add_step(board_plan.concat, 'concat')
+    if image_dpi > 0:
+        estimate.add(cost_model.predict(board_key, 'images'), 'images')
+    if reproducible:
+        estimate.add(cost_model.predict(board_key, 'reproducible'), 'reproducible')
+    if linearize:
+        estimate.add(cost_model.predict(board_key, 'linearize'), 'linearize')
+    for template_plan in board_plan.templates:
+        if template_plan.svg is not None:
+            add_step(template_plan.svg, 'svg', template_plan.name)
+        if tile_format:
+            estimate.add(cost_model.predict(board_key, 'tiles', template_plan.name), 'tiles', template_plan.name)
+
+    def step_status(status: str, stage: str, template: str = '', layer: str = ''):
+        set_progress_status(estimate.step(stage, template, layer), estimate.with_eta(status))
 
     """
     [
@@ -703,188 +2261,420 @@ def plot_pdfs(board, output_path, templates, enabled_templates, del_temp_files,
     """
     try:
         # Set General Options:
-        plot_options.SetPlotInvisibleText(False)
-        # plot_options.SetPlotPadsOnSilkLayer(False);
-        plot_options.SetUseAuxOrigin(False)
-        plot_options.SetScale(1.0)
-        plot_options.SetAutoScale(False)
-        # plot_options.SetPlotMode(PLOT_MODE)
-        # plot_options.SetLineWidth(2000)
-        if pcbnew.Version()[0:3] == "6.0":
-            # This method is only available on V6, not V6.99/V7
-            plot_options.SetExcludeEdgeLayer(True)
-    except:
-        msg_box(traceback.format_exc(), 'Error', wx.OK | wx.ICON_ERROR)
-        set_progress_status(100, "Failed to set plot_options")
-        return False
+        for options in (controller.GetPlotOptions() for controller in controllers):
+            options.SetPlotInvisibleText(False)
+            # options.SetPlotPadsOnSilkLayer(False);
+            options.SetUseAuxOrigin(False)
+            options.SetScale(1.0)
+            options.SetAutoScale(False)
+            # options.SetPlotMode(PLOT_MODE)
+            # options.SetLineWidth(2000)
+            if pcbnew.Version()[0:3] == "6.0":
+                # This method is only available on V6, not V6.99/V7
+                options.SetExcludeEdgeLayer(True)
+    except Exception:
+        return fail("Failed to set plot_options", traceback.format_exc())
 
     use_popups = False
     template_filelist = []
 
-    title_block = board.GetTitleBlock()
-    # Iterate over the templates
-    for page_count, template in enumerate(templates_list):
-        title_block.SetComment(0, f"board2pdf: {template.name} -- {page_count + 1}/{len(templates_list)}")
-        board.SetTitleBlock(title_block)
-        # msg_box("Now starting with template: " + template_name)
-        # Plot layers to pdf files
-        for layer_info in template.settings:
-            progress += progress_step
-            set_progress_status(progress, f"Plotting {layer_info.name} for template {template.name}")
-
-            if pcbnew.Version()[0:3] == "6.0":
-                if pcbnew.IsCopperLayer(layer_info.id):  # Should probably do this on mask layers as well
-                    plot_options.SetDrillMarksType(
-                        2)  # NO_DRILL_SHAPE = 0, SMALL_DRILL_SHAPE = 1, FULL_DRILL_SHAPE  = 2
-                else:
-                    plot_options.SetDrillMarksType(
-                        0)  # NO_DRILL_SHAPE = 0, SMALL_DRILL_SHAPE = 1, FULL_DRILL_SHAPE  = 2
-            else:  # API changed in V6.99/V7
-                try:
-                    if pcbnew.IsCopperLayer(layer_info.id):  # Should probably do this on mask layers as well
-                        plot_options.SetDrillMarksType(pcbnew.DRILL_MARKS_FULL_DRILL_SHAPE)
-                    else:
-                        plot_options.SetDrillMarksType(pcbnew.DRILL_MARKS_NO_DRILL_SHAPE)
-                except:
-                    msg_box(
-                        "Unable to set Drill Marks type.\n\nIf you're using a V6.99 build from before Dec 07 2022 then update to a newer build.\n\n" + traceback.format_exc(),
-                        'Error', wx.OK | wx.ICON_ERROR)
-                    set_progress_status(100, "Failed to set Drill Marks type")
-
+    # The page comment is changed for every template, restore it when done. The drawing sheet of a panel is plotted
+    # with the frame board.
+    boards = [board] + ([frame_board] if frame_board is not None else [])
+    original_comments = [b.GetTitleBlock().GetComment(0) for b in boards]
+    try:
+        # Iterate over the templates
+        for page_count, (template, template_plan) in enumerate(zip(templates_list, board_plan.templates)):
+            assembly_file = f"{base_filename}_{template.name}.pdf"
+            merge_key = plan.node_key(template_plan.page)
+            if checkpoint is not None and checkpoint.done(merge_key) == os.path.join(output_dir, assembly_file):
+                step_status(f"Reusing merged template {template.name}", 'merge', template.name)
+                template_filelist.append(assembly_file)
+                use_popups = use_popups or template_plan.merge.use_popups
+                continue
+
+            for b in boards:
+                title_block = b.GetTitleBlock()
+                title_block.SetComment(0, plan.comment(template.name, page_count, len(templates_list)))
+                b.SetTitleBlock(title_block)
+            # Plot layers to pdf files, layers plotted with the same settings before are reused
+            plotted_files = {}
+            plot_spans = []
+            plotted_keys = []
+            plot_jobs = ([(layer_info, plot_node, plot_controller)
+                          for layer_info, plot_node in zip(template.settings, template_plan.plots)]
+                         + [(layer_info, plot_node, controllers[-1])
+                            for layer_info, plot_node in zip(template.settings, template_plan.frame_plots)])
+            for layer_info, plot_node, controller in plot_jobs:
+                of_frame = ' of the panel frame' if plot_node.board else ''
+                if cancelled():
                     return False
-
-            try:
-                plot_options.SetPlotFrameRef(layer_info.with_frame)
-                plot_options.SetNegative(layer_info.negative)
-                plot_options.SetPlotValue(layer_info.footprint_value)
-                plot_options.SetPlotReference(layer_info.reference_designator)
-                plot_options.SetMirror(template.mirrored)
-                plot_options.SetPlotViaOnMaskLayer(template.tented)
-                if int(pcbnew.Version()[0:1]) >= 8:
-                    if layer_scale == 1.0:
-                        plot_options.m_PDFFrontFPPropertyPopups = layer_info.front_popups
-                        plot_options.m_PDFBackFPPropertyPopups = layer_info.back_popups
-                    else:
-                        plot_options.m_PDFFrontFPPropertyPopups = False
-                        plot_options.m_PDFBackFPPropertyPopups = False
-
-                plot_controller.SetLayer(layer_info.id)
-                if pcbnew.Version()[0:3] == "6.0":
-                    plot_controller.OpenPlotfile(layer_info.name, pcbnew.PLOT_FORMAT_PDF, template.name)
+                key = plan.node_key(plot_node)
+                done = checkpoint.done(key) if checkpoint is not None and key not in plot_cache.files else None
+                if done:
+                    plot_cache.files[key] = os.path.basename(done)
+                if key in plot_cache.files and os.path.exists(os.path.join(temp_dir, plot_cache.files[key])):
+                    step_status(f"Reusing plot of {layer_info.name}{of_frame} for template {template.name}",
+                                'plot', template.name, layer_info.name)
+                    plotted_files[plot_node] = plot_cache.files[key]
+                    continue
+                step_status(f"Plotting {layer_info.name}{of_frame} for template {template.name}",
+                            'plot', template.name, layer_info.name)
+                plot_options = controller.GetPlotOptions()
+
+                with tracing.stage('plot', template.name, layer_info.name) as span:
+                    if pcbnew.Version()[0:3] == "6.0":
+                        if pcbnew.IsCopperLayer(layer_info.id):  # Should probably do this on mask layers as well
+                            plot_options.SetDrillMarksType(
+                                2)  # NO_DRILL_SHAPE = 0, SMALL_DRILL_SHAPE = 1, FULL_DRILL_SHAPE  = 2
+                        else:
+                            plot_options.SetDrillMarksType(
+                                0)  # NO_DRILL_SHAPE = 0, SMALL_DRILL_SHAPE = 1, FULL_DRILL_SHAPE  = 2
+                    else:  # API changed in V6.99/V7
+                        try:
+                            if pcbnew.IsCopperLayer(layer_info.id):  # Should probably do this on mask layers as well
+                                plot_options.SetDrillMarksType(pcbnew.DRILL_MARKS_FULL_DRILL_SHAPE)
+                            else:
+                                plot_options.SetDrillMarksType(pcbnew.DRILL_MARKS_NO_DRILL_SHAPE)
+                        except Exception:
+                            return fail("Failed to set Drill Marks type",
+                                        "Unable to set Drill Marks type.\n\nIf you're using a V6.99 build from before Dec 07 2022 then update to a newer build.\n\n" + traceback.format_exc())
+
+                    try:
+                        plot_options.SetPlotFrameRef(plot_node.with_frame)
+                        plot_options.SetNegative(layer_info.negative)
+                        plot_options.SetPlotValue(layer_info.footprint_value)
+                        plot_options.SetPlotReference(layer_info.reference_designator)
+                        plot_options.SetMirror(template.mirrored)
+                        plot_options.SetPlotViaOnMaskLayer(template.tented)
+                        if int(pcbnew.Version()[0:1]) >= 8:
+                            # popups are off when scaling
+                            plot_options.m_PDFFrontFPPropertyPopups = plot_node.front_popups
+                            plot_options.m_PDFBackFPPropertyPopups = plot_node.back_popups
+
+                        controller.SetLayer(layer_info.id)
+                        # The key in the file name keeps plots of the same layer with different settings apart
+                        suffix = f"{layer_info.name}-{key}"
+                        if pcbnew.Version()[0:3] == "6.0":
+                            controller.OpenPlotfile(suffix, pcbnew.PLOT_FORMAT_PDF, template.name)
+                        else:
+                            controller.OpenPlotfile(suffix, pcbnew.PLOT_FORMAT_PDF, "", template.name)
+                        controller.PlotLayer()
+                        plot_cache.files[key] = os.path.basename(controller.GetPlotFileName())
+                        plotted_files[plot_node] = plot_cache.files[key]
+                        span.add_output(controller.GetPlotFileName())
+                        plot_spans.append(span)
+                        plotted_keys.append(key)
+                    except Exception:
+                        return fail("Failed to set plot_options or plot_controller", traceback.format_exc())
+
+            for controller in controllers:
+                controller.ClosePlot()
+            # The plot files are complete when they are closed
+            for span in plot_spans:
+                span.measure()
+            if checkpoint is not None:
+                for key in plotted_keys:
+                    checkpoint.add(key, os.path.join(temp_dir, plot_cache.files[key]))
+
+            template_use_popups = template_plan.merge.use_popups
+            # Simplify, colorize, cull, minify, dedup and panel the layers, steps done before for the same layer are
+            # reused. A cull step needs the layers merged over it colored, so the cull steps and the steps after them
+            # are last. The layers of the panel frame board follow those of the board and are never culled.
+            plots = template_plan.plots + template_plan.frame_plots
+            layer_files = [plotted_files[plot_node] for plot_node in plots]
+            # The file of every layer step, the cull and panel steps look up the files of other layers here
+            step_files = dict(zip(plots, layer_files))
+            steps = [plan.layer_steps(layer_node)
+                     for layer_node in template_plan.layers + tuple(template_plan.frame_layers)]
+            # The layers replaced by an image, which already has its color
+            rasterized = set()
+            # The panel steps read the frame layers, which come after the layers of the board, so they wait too
+            culls = [next((k for k, step in enumerate(s) if isinstance(step, (plan.CullNode, plan.PanelNode))), len(s))
+                     for s in steps]
+            ordered = ([(i, step) for i, s in enumerate(steps) for step in s[:culls[i]]]
+                       + [(i, step) for i, s in enumerate(steps) for step in s[culls[i]:]])
+            for i, step in ordered:
+                layer_info = template.settings[i % len(template.settings)]
+                input_file = layer_files[i]
+                stage = plan.stage(step)
+                step_files[step] = input_file
+                if stage in ('simplify', 'cull', 'minify', 'dedup'):
+                    if can_rewrite is None:
+                        can_rewrite = geometry.has_numpy and pymupdf_loaded()
+                        if not can_rewrite:
+                            result.warnings.append("Simplifying, culling, minifying and deduplicating layers needs "
+                                                   "numpy and PyMuPDF, the layers are used as they are.")
+                    if not can_rewrite:
+                        continue
+                if i in rasterized and isinstance(step, (plan.ColorizeNode, plan.CullNode, plan.DedupNode)):
+                    continue
+                if stage == 'rasterize' and not pymupdf_loaded():
+                    warning = "Rasterizing layers needs PyMuPDF, all layers are kept as vector drawings."
+                    if warning not in result.warnings:
+                        result.warnings.append(warning)
+                    continue
+                if isinstance(step, plan.RasterizeNode):
+                    # Checked every run, the layer is only rasterized if it got too heavy
+                    with tracing.stage('complexity', template.name, layer_info.name) as span:
+                        complexity = layer_complexity(temp_dir, input_file)
+                        if complexity is None:
+                            return fail(f"Failed when measuring {layer_info.name} for template {template.name}")
+                        stream_bytes, paths = complexity
+                        if step.max_paths and paths is None:
+                            warning = "Counting the paths of layers needs numpy, only their size is checked for " \
+                                      "rasterizing."
+                            if warning not in result.warnings:
+                                result.warnings.append(warning)
+                        heavy = ((step.max_bytes and stream_bytes > step.max_bytes)
+                                 or (step.max_paths and paths is not None and paths > step.max_paths))
+                        checked = LayerComplexity(template.name, layer_info.name, stream_bytes, paths, bool(heavy),
+                                                  step.dpi)
+                        span.info.update(stream_bytes=checked.stream_bytes, paths=checked.paths,
+                                         rasterized=checked.rasterized)
+                    _logger.info(f"complexity of {checked.describe()}")
+                    result.layer_complexity.append(checked)
+                    if not checked.rasterized:
+                        continue
+                    rasterized.add(i)
+                if cancelled():
+                    return False
+                doing, done = _layer_step_words[stage]
+                of_frame = ' of the panel frame' if i >= len(template.settings) else ''
+                key = plan.node_key(step)
+                output_file = f"{os.path.splitext(input_file)[0]}-{key}-{done}.pdf"
+                if key not in plot_cache.files and checkpoint is not None and checkpoint.done(key):
+                    plot_cache.files[key] = output_file
+                if key in plot_cache.files and os.path.exists(os.path.join(temp_dir, output_file)):
+                    step_status(f"Reusing {done} {layer_info.name}{of_frame} for template {template.name}",
+                                stage, template.name, layer_info.name)
                 else:
-                    plot_controller.OpenPlotfile(layer_info.name, pcbnew.PLOT_FORMAT_PDF, "", template.name)
-                plot_controller.PlotLayer()
-            except:
-                msg_box(traceback.format_exc(), 'Error', wx.OK | wx.ICON_ERROR)
-                set_progress_status(100, "Failed to set plot_options or plot_controller")
+                    step_status(f"{doing} {layer_info.name}{of_frame} for template {template.name}",
+                                stage, template.name, layer_info.name)
+                    with tracing.stage(stage, template.name, layer_info.name) as span:
+                        span.add_input(os.path.join(temp_dir, input_file))
+                        span.add_output(os.path.join(temp_dir, output_file))
+                        # The other layers the step reads
+                        other_files = []
+                        if isinstance(step, plan.SimplifyNode):
+                            vertices = simplify_pdf(temp_dir, input_file, output_file, step.tolerance)
+                            ok = vertices is not None
+                        elif isinstance(step, plan.RasterizeNode):
+                            ok = rasterize_pdf(temp_dir, input_file, output_file, step.color, step.transparency,
+                                               step.dpi)
+                        elif isinstance(step, plan.ColorizeNode):
+                            colorize_pdf = backends.select('colorize', step.engine).function
+                            ok = colorize_pdf(temp_dir, input_file, output_file, step.color, step.transparency)
+                        elif isinstance(step, plan.CullNode):
+                            other_files = [step_files[occluder] for occluder in step.occluders]
+                            paths = cull_pdf(temp_dir, input_file, output_file, other_files)
+                            ok = paths is not None
+                            if ok:
+                                _logger.info(f"culled {paths[1]} of {paths[0]} paths of {layer_info.name} "
+                                             f"for template {template.name}")
+                        elif isinstance(step, plan.MinifyNode):
+                            ok = minify_pdf(temp_dir, input_file, output_file, step.precision)
+                        elif isinstance(step, plan.PanelNode):
+                            other_files = [step_files[step.frame]]
+                            ok = panel_pdf(temp_dir, input_file, other_files[0], output_file, step.instances,
+                                           step.center, step.mirrored)
+                        else:
+                            replaced = dedup_pdf(temp_dir, input_file, output_file, step.tolerance)
+                            ok = replaced is not None
+                            if ok:
+                                _logger.info(f"deduplicated {replaced} shapes of {layer_info.name} "
+                                             f"for template {template.name}")
+                        if not ok:
+                            return fail(f"Failed when {doing.lower()} {layer_info.name} for template {template.name}")
+                    if isinstance(step, plan.SimplifyNode):
+                        simplified = Simplification(template.name, layer_info.name + of_frame, *vertices,
+                                                    os.path.getsize(os.path.join(temp_dir, input_file)),
+                                                    os.path.getsize(os.path.join(temp_dir, output_file)))
+                        _logger.info(f"simplified {simplified.describe()}")
+                        result.simplified.append(simplified)
+                    plot_cache.files[key] = output_file
+                    if checkpoint is not None:
+                        checkpoint.add(key, os.path.join(temp_dir, output_file),
+                                       [os.path.join(temp_dir, f) for f in [input_file] + other_files])
+                layer_files[i] = output_file
+                step_files[step] = output_file
+            filelist = layer_files[:len(template.settings)]
+
+            # the frame layer is scaled by 1.0, all others by `layer_scale`
+            frame_file = filelist[template_plan.merge.frame] if template_plan.merge.frame >= 0 else 'None'
+
+            # Merge pdf files
+            if cancelled():
                 return False
-
-        plot_controller.ClosePlot()
-
-        template_use_popups = False
-        frame_file = 'None'
-        filelist = []
-        # Change color of pdf files
-        for layer_info in template.settings:
-            ln = layer_info.name.replace('.', '_')
-            input_file = f"{base_filename}-{ln}.pdf"
-            output_file = f"{base_filename}-{ln}-colored.pdf"
-            if layer_info.has_color or layer_info.has_transparency:
-                progress += progress_step
-                set_progress_status(progress, f"Coloring {layer_info.name} for template {template.name}")
-
-                if not colorize_pdf(temp_dir, input_file, output_file, layer_info.color_rgb, layer_info.transparency):
-                    set_progress_status(100, f"Failed when coloring {layer_info.name} for template {template.name}")
-                    return False
-
-                filelist.append(output_file)
-            else:
-                filelist.append(input_file)
-
-            if layer_info.with_frame:
-                # the frame layer is scaled by 1.0, all others by `layer_scale`
-                frame_file = filelist[-1]
-
-            # Set template_use_popups to True if any layer has popups and no scaling
-            if layer_scale == 1.0:
-                template_use_popups = template_use_popups or layer_info.front_popups or layer_info.back_popups
-
-        # Merge pdf files
-        progress += progress_step
-        set_progress_status(progress, f"Merging all layers of template {template.name}")
-
-        assembly_file = f"{base_filename}_{template.name}.pdf"
-
-        print("frame file before calling merge:", frame_file)
-        print("template.scale_or_crop: " + str(template.scale_or_crop))
-        if not merge_pdf(temp_dir, filelist, output_dir, assembly_file, frame_file, template.scale_or_crop, layer_scale, template_use_popups, template.name):
-            set_progress_status(100, "Failed when merging all layers of template " + template.name)
-            return False
-
-        template_filelist.append(assembly_file)
-        # Set use_popups to True if any template has popups
-        use_popups = use_popups or template_use_popups
+            step_status(f"Merging all layers of template {template.name}", 'merge', template.name)
+
+            _logger.debug(f"{frame_file=} {template.scale_or_crop=}")
+            scaling = template.scale_or_crop['scaling_method'] != '0'
+            merge_pdf = backends.select('merge', merge_lib, popups=template_use_popups, scaling=scaling).function
+            crop_engine = backends.select('crop', crop_lib)
+            if template.scale_or_crop['scaling_method'] in ('1', '2') and crop_engine is None:
+                return fail("Failed to load pdfCropMargins.",
+                            "Cropping needs pdfCropMargins or PyMuPDF.\n\nMore information under Install dependencies in the Wiki at board2pdf.dennevi.com")
+            with tracing.stage('merge', template.name) as span:
+                for filename in filelist:
+                    span.add_input(os.path.join(temp_dir, filename))
+                span.add_output(os.path.join(output_dir, assembly_file))
+                if not merge_pdf(temp_dir, filelist, output_dir, assembly_file, frame_file, template.scale_or_crop, layer_scale, template_use_popups, template.name,
+                                 crop_engine.function if crop_engine else None):
+                    return fail("Failed when merging all layers of template " + template.name)
+            if checkpoint is not None:
+                checkpoint.add(merge_key, os.path.join(output_dir, assembly_file),
+                               [os.path.join(temp_dir, filename) for filename in filelist])
+
+            template_filelist.append(assembly_file)
+            # Set use_popups to True if any template has popups
+            use_popups = use_popups or template_use_popups
+    finally:
+        for b, original_comment in zip(boards, original_comments):
+            title_block = b.GetTitleBlock()
+            title_block.SetComment(0, original_comment)
+            b.SetTitleBlock(title_block)
 
     # Add all generated pdfs to one file
-    progress += progress_step
-    set_progress_status(progress, "Adding all templates to a single file")
-
-
-    if not create_pdf_from_pages(output_dir, template_filelist, output_dir, final_assembly_file, use_popups):
-        set_progress_status(100, "Failed when adding all templates to a single file")
+    if cancelled():
         return False
+    step_status("Adding all templates to a single file", 'concat')
 
-    # Create SVG(s) if settings says so
-    if create_svg:
+    # A reproducible assembly pdf is written next to the last one first, to compare them when it's done
+    assembly_path = final_assembly_file_with_path + '.tmp' if reproducible else final_assembly_file_with_path
+    with tracing.stage('concat') as span:
         for template_file in template_filelist:
-            template_pdf = pymupdf.open(os.path.join(output_dir, template_file))
-            try:
-                svg_image = template_pdf[0].get_svg_image()
-                svg_filename = os.path.splitext(template_file)[0] + ".svg"
-                with open(os.path.join(output_dir, svg_filename), "w") as file:
-                    file.write(svg_image)
-            except:
-                msg_box("Failed to create SVG in {output_dir}\n\n" + traceback.format_exc(), 'Error',
-                        wx.OK | wx.ICON_ERROR)
-                set_progress_status(100, "Failed to create SVG(s)")
+            span.add_input(os.path.join(output_dir, template_file))
+        span.add_output(assembly_path)
+        template_names = [template.name for template in templates_list]
+        updated = None
+        if incremental and os.path.exists(final_assembly_file_with_path):
+            updated = update_pdf_pages(output_dir, template_filelist, final_assembly_file_with_path, template_names,
+                                       use_popups)
+            if updated is False:
+                return fail("Failed when updating the pages of changed templates")
+        if updated is None:
+            concat_pdf = backends.select('concat', popups=use_popups).function
+            if not concat_pdf(output_dir, template_filelist, os.path.dirname(assembly_path),
+                              os.path.basename(assembly_path), use_popups):
+                return fail("Failed when adding all templates to a single file")
+
+    # Only a newly written assembly pdf, the pages of an incremental update keep their images
+    if updated is None and image_dpi > 0:
+        if cancelled():
+            return False
+        step_status("Optimizing the images of the assembly pdf", 'images')
+        with tracing.stage('images') as span:
+            span.add_input(assembly_path)
+            span.add_output(assembly_path)
+            result.image_savings = optimize_images(assembly_path, image_dpi, image_jobs)
+            if result.image_savings is None:
+                return fail("Failed when optimizing the images of the assembly pdf")
+            span.info.update(result.image_savings._asdict())
+        _logger.info(f"images {result.image_savings.describe()}")
+    # Before linearizing, which keeps the dates and derives the ID from the content too
+    if reproducible:
+        if cancelled():
+            return False
+        step_status("Making the assembly pdf reproducible", 'reproducible')
+        with tracing.stage('reproducible') as span:
+            span.add_input(assembly_path)
+            span.add_output(assembly_path)
+            if not make_reproducible(assembly_path, assembly_path):
+                return fail("Failed when making the assembly pdf reproducible")
+    if linearize:
+        linearize_engine = backends.select('linearize')
+        if linearize_engine is None:
+            result.warnings.append("Linearizing needs pikepdf, qpdf or PyMuPDF before 1.26, the assembly pdf is "
+                                   "written as it is.")
+        else:
+            if cancelled():
                 return False
-            template_pdf.close()
+            step_status("Linearizing the assembly pdf", 'linearize')
+            with tracing.stage('linearize') as span:
+                span.add_input(assembly_path)
+                span.add_output(assembly_path)
+                # Written next to the pdf first, a pdf viewer may have it open
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(assembly_path), suffix='.tmp')
+                os.close(fd)
+                if not linearize_engine.function(assembly_path, temp_path):
+                    os.remove(temp_path)
+                    return fail("Failed when linearizing the assembly pdf")
+                os.replace(temp_path, assembly_path)
+                first_page = linearized_first_page(assembly_path)
+                span.info.update(engine=linearize_engine.name, first_page_bytes=first_page)
+            if first_page is None:
+                result.warnings.append(f"The assembly pdf written by {linearize_engine.name} isn't linearized, "
+                                       f"it's only shown when it's completely downloaded.")
+            _logger.info(f"linearized with {linearize_engine.name}, {first_page=} bytes")
+    if reproducible:
+        # Left alone when nothing changed, so it isn't written, uploaded or invalidated in caches again
+        if (os.path.exists(final_assembly_file_with_path)
+                and file_digest(final_assembly_file_with_path) == file_digest(assembly_path)):
+            os.remove(assembly_path)
+            result.assembly_unchanged = True
+            _logger.info(f"the assembly pdf {final_assembly_file_with_path} didn't change")
+        else:
+            os.replace(assembly_path, final_assembly_file_with_path)
+    # Written after the images are optimized, the manifest has the digest of the final pdf
+    if updated is None and incremental:
+        write_page_manifest(output_dir, template_filelist, final_assembly_file_with_path, template_names, use_popups)
+    result.assembly_file = final_assembly_file_with_path
 
-    # Delete temp files if setting says so
-    if del_temp_files:
-        try:
-            shutil.rmtree(temp_dir)
-        except:
-            msg_box(f"del_temp_files failed\n\nOn dir {temp_dir}\n\n" + traceback.format_exc(), 'Error',
-                    wx.OK | wx.ICON_ERROR)
-            set_progress_status(100, "Failed to delete temp files")
-            return False
+    # Create SVG(s) if settings says so
+    if create_svg:
+        for template, template_file in zip(templates_list, template_filelist):
+            if cancelled():
+                return False
+            step_status(f"Creating SVG of template {template.name}", 'svg', template.name)
+            svg_filename = os.path.join(output_dir, os.path.splitext(template_file)[0] + ".svg")
+            with tracing.stage('svg', template.name) as span:
+                span.add_input(os.path.join(output_dir, template_file))
+                span.add_output(svg_filename)
+                try:
+                    with pymupdf.open(os.path.join(output_dir, template_file)) as template_pdf:
+                        svg_image = template_pdf[0].get_svg_image()
+                    with open(svg_filename, "w") as file:
+                        file.write(svg_image)
+                except Exception:
+                    return fail("Failed to create SVG(s)", f"Failed to create SVG in {output_dir}\n\n" + traceback.format_exc())
+            result.svg_files.append(svg_filename)
+
+    # Create deep zoom tiles if settings says so, only the tiles of changed parts of the pages are rendered
+    if tile_format:
+        for template, template_plan, template_file in zip(templates_list, board_plan.templates, template_filelist):
+            if cancelled():
+                return False
+            step_status(f"Creating tiles of template {template.name}", 'tiles', template.name)
+            dzi_filename = os.path.join(output_dir, os.path.splitext(template_file)[0] + ".dzi")
+            with tracing.stage('tiles', template.name) as span:
+                span.add_input(os.path.join(output_dir, template_file))
+                span.add_output(dzi_filename)
+                tiles = export_tiles(os.path.join(output_dir, template_file), dzi_filename, tile_format, tile_size,
+                                     tile_dpi, tile_jobs, plan.node_key(template_plan.page))
+                if tiles is None:
+                    return fail(f"Failed to create the tiles of template {template.name}")
+                span.info.update(tiles=tiles[0], rendered=tiles[1])
+            result.tile_pyramids.append(TilePyramid(template.name, dzi_filename, *tiles))
+
+    with tracing.stage('cleanup'):
+        # Delete temp files if setting says so
+        if del_temp_files and own_temp_dir:
+            try:
+                shutil.rmtree(temp_dir)
+            except OSError:
+                return fail("Failed to delete temp files", f"del_temp_files failed\n\nOn dir {temp_dir}\n\n" + traceback.format_exc())
 
-    # Delete single page files if setting says so
-    if del_single_page_files:
+        # Delete single page files if setting says so
         for template_file in template_filelist:
-            delete_file = os.path.join(output_dir, os.path.splitext(template_file)[0] + ".pdf")
+            single_page_file = os.path.join(output_dir, os.path.splitext(template_file)[0] + ".pdf")
+            if not del_single_page_files:
+                result.single_page_files.append(single_page_file)
+                continue
             try:
-                os.remove(delete_file)
-            except:
-                msg_box(f"del_single_page_files failed\n\nOn file {delete_file}\n\n" + traceback.format_exc(), 'Error',
-                        wx.OK | wx.ICON_ERROR)
-                set_progress_status(100, "Failed to delete single files")
-                return False
+                os.remove(single_page_file)
+            except OSError:
+                return fail("Failed to delete single files", f"del_single_page_files failed\n\nOn file {single_page_file}\n\n" + traceback.format_exc())
 
     set_progress_status(100, "All done!")
-
-    endmsg = "Assembly pdf created: " + os.path.abspath(os.path.join(output_dir, final_assembly_file))
-    if not del_single_page_files:
-        endmsg += "\n\nSingle page pdf files created:"
-        for template_file in template_filelist:
-            endmsg += "\n" + os.path.abspath(os.path.join(output_dir, os.path.splitext(template_file)[0] + ".pdf"))
-
-    if create_svg:
-        endmsg += "\n\nSVG files created:"
-        for template_file in template_filelist:
-            endmsg += "\n" + os.path.abspath(os.path.join(output_dir, os.path.splitext(template_file)[0] + ".svg"))
-
-    msg_box(endmsg, 'All done!', wx.OK)
     return True
-
@@ -0,0 +1,346 @@
+from __future__ import annotations
+import contextlib
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+_logger = logging.getLogger(__name__)
+
+# Tracer of the plot running in the current thread, see stage().
+_current_tracer = contextvars.ContextVar('board2pdf_tracer', default=None)
+
+
+def reset_peak_rss() -> bool:
+    """Start a new peak for peak_rss() at the current resident set size, False if that isn't possible. Only possible
+    on Linux.
+
+    The peak belongs to the whole process, so this also resets it for everything else in the process watching it,
+    KiCad and other plots running at the same time included. Only Tracers with reset_peak call it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> int | None:
+    """Peak resident set size of this process in bytes since the last reset_peak_rss(), None if unknown. Only known
+    on Linux."""
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def current_rss() -> int | None:
+    """Resident set size of this process in bytes, None if unknown. Only known on Linux."""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def format_bytes(size: int | None) -> str:
+    if size is None:
+        return 'unknown'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class Span:
+    """One timed stage, for a template and/or a layer."""
+
+    def __init__(self, name: str, template: str = '', layer: str = ''):
+        self.name: str = name
+        self.template: str = template
+        self.layer: str = layer
+        self.start: float = 0.0  # seconds since the start of the trace
+        self.wall: float = 0.0  # seconds
+        self.cpu: float = 0.0  # cpu seconds of the thread running the stage
+        self.inputs: list[str] = []
+        self.outputs: list[str] = []
+        self.bytes_in: int = 0
+        self.bytes_out: int = 0
+        self.peak_rss: int | None = None  # bytes, the peak of the process during the stage, see Tracer.stage
+        self.thread: int = threading.get_ident()
+        self.info: dict = {}  # stage specific numbers, like vertex counts
+
+    def add_input(self, path: str):
+        self.inputs.append(path)
+
+    def add_output(self, path: str):
+        self.outputs.append(path)
+
+    def measure(self):
+        """Update the byte counts from the input and output files."""
+        self.bytes_in = sum(_file_size(p) for p in self.inputs)
+        self.bytes_out = sum(_file_size(p) for p in self.outputs)
+
+    def as_dict(self) -> dict:
+        return {'name': self.name, 'template': self.template, 'layer': self.layer, 'start': self.start,
+                'wall': self.wall, 'cpu': self.cpu, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'peak_rss': self.peak_rss, **({'info': self.info} if self.info else {})}
+
+    def __repr__(self):
+        var_str = ', '.join(f"{key}: {value}" for key, value in vars(self).items())
+        return f'{self.__class__.__name__}:{{ {var_str} }}'
+
+
+class _NullSpan(Span):
+    def add_input(self, path: str):
+        pass
+
+    def add_output(self, path: str):
+        pass
+
+    def measure(self):
+        pass
+
+
+def write_collapsed_stacks(stats: pstats.Stats, path: str, max_depth: int = 64):
+    """Write `stats` as collapsed stacks ("a;b;c <microseconds>" per line), the input of flamegraph.pl and speedscope.
+
+    cProfile only records caller/callee pairs, so the stacks are rebuilt by walking down from the functions
+    without callers and splitting the time of a function over its callers in proportion to the calls.
+    """
+    def label(func) -> str:
+        filename, line, name = func
+        return f"{name} ({os.path.basename(filename)}:{line})" if line else name
+
+    children: dict = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            children.setdefault(caller, []).append((func, caller_stats[3]))
+
+    lines: dict[str, int] = {}
+
+    def walk(func, weight: float, stack: list):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        fraction = min(1.0, weight / ct) if ct else 0.0
+        stack = stack + [label(func)]
+        self_time = int(tt * fraction * 1e6)
+        if self_time:
+            key = ';'.join(stack)
+            lines[key] = lines.get(key, 0) + self_time
+        if len(stack) >= max_depth:
+            return
+        for child, edge_time in children.get(func, []):
+            if label(child) not in stack:  # recursion is folded into the first call
+                walk(child, edge_time * fraction, stack)
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            walk(func, ct, [])
+
+    with open(path, 'w') as f:
+        for stack, microseconds in sorted(lines.items()):
+            f.write(f"{stack} {microseconds}\n")
+
+
+class Profiler:
+    """Runs every outermost stage under cProfile and tracemalloc.
+
+    For each stage a .pstats file and a .collapsed file (see write_collapsed_stacks) are written to `directory`.
+    close() writes allocations.txt with the top allocation sites of the stage with the highest memory peak.
+    """
+
+    def __init__(self, directory: str, top: int = 25):
+        self.directory: str = directory
+        self.top: int = top
+        self.count: int = 0
+        self.peak: int = 0  # highest traced memory peak of a stage, bytes
+        self.peak_stage: str = ''
+        self._peak_snapshot: tracemalloc.Snapshot | None = None
+        self._active = threading.local()
+        self._started_tracemalloc = False
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def profile(self, span: Span):
+        if getattr(self._active, 'stage', None) is not None:
+            # Nested stages are part of the profile of the outer stage, only one profiler can run at a time.
+            yield
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+            self._started_tracemalloc = True
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        self.count += 1
+        label = '-'.join(x for x in (f"{self.count:03d}", span.name, span.template, span.layer) if x)
+        filename = os.path.join(self.directory, re.sub(r'[^\w.+-]+', '_', label))
+        profile = cProfile.Profile()
+        self._active.stage = label
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._active.stage = None
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+            span.info['traced_peak'] = peak
+            if peak > self.peak:
+                self.peak, self.peak_stage = peak, label
+                self._peak_snapshot = tracemalloc.take_snapshot()
+            profile.dump_stats(filename + '.pstats')
+            write_collapsed_stacks(pstats.Stats(profile), filename + '.collapsed')
+
+    def close(self):
+        if self._peak_snapshot is not None:
+            snapshot = self._peak_snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, __file__)])
+            with open(os.path.join(self.directory, 'allocations.txt'), 'w') as f:
+                f.write(f"Top {self.top} allocation sites of {self.peak_stage}, "
+                        f"traced peak {self.peak / 2**20:.1f} MiB\n\n")
+                for stat in snapshot.statistics('lineno')[:self.top]:
+                    f.write(f"{stat.size / 2**10:10.1f} KiB {stat.count:8d} blocks  {stat.traceback[0]}\n")
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self._peak_snapshot = None
+
+
+class Tracer:
+    """Collects the Spans of one run and writes them as a JSON report or a Chrome trace (Perfetto).
+
+    With `reset_peak` the peak resident set size of the process is reset at the start of the run and of every
+    stage (see reset_peak_rss), so the spans get their own peaks. Without it they get the resident set sizes at
+    their start and end.
+    """
+
+    def __init__(self, profiler: Profiler = None, reset_peak: bool = False):
+        self.spans: list[Span] = []
+        self.profiler: Profiler | None = profiler
+        self.reset_peak: bool = reset_peak
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._open: list[Span] = []  # the stages running in any thread
+        # The peak is measured from the start of the run, not of the process
+        self._resettable = reset_peak and reset_peak_rss()
+
+    def _sample_rss(self):
+        # The high water mark is for the whole process, so it counts for every running stage. Where it can't be
+        # reset, the resident set size at the start and the end of the stages is all there is.
+        rss = peak_rss() if self._resettable else current_rss()
+        if rss is not None:
+            for span in self._open:
+                span.peak_rss = max(span.peak_rss or 0, rss)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, template: str = '', layer: str = ''):
+        """Time a stage. With reset_peak its peak_rss is the peak resident set size of the process while it ran, on
+        Linux, which includes the stages running at the same time in other threads. Otherwise it is the larger of the
+        resident set sizes at its start and end, or None."""
+        span = Span(name, template, layer)
+        span.start = time.perf_counter() - self._start
+        cpu_start = time.thread_time()
+        with self._lock:
+            self._sample_rss()
+            if self.reset_peak:
+                self._resettable = reset_peak_rss()
+            self._open.append(span)
+            self._sample_rss()
+        try:
+            if self.profiler is None:
+                yield span
+            else:
+                with self.profiler.profile(span):
+                    yield span
+        finally:
+            span.wall = time.perf_counter() - self._start - span.start
+            span.cpu = time.thread_time() - cpu_start
+            span.measure()
+            with self._lock:
+                self._sample_rss()
+                self._open.remove(span)
+                self.spans.append(span)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make this the tracer used by stage() in the current thread."""
+        token = _current_tracer.set(self)
+        try:
+            yield self
+        finally:
+            _current_tracer.reset(token)
+
+    def totals(self, attribute: str = 'name') -> dict[str, dict]:
+        """Sum of wall, cpu and bytes grouped by `attribute` ('name', 'template' or 'layer')."""
+        totals = {}
+        for span in self.spans:
+            group = getattr(span, attribute)
+            if not group:
+                continue
+            total = totals.setdefault(group, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes_in': 0, 'bytes_out': 0})
+            total['count'] += 1
+            total['wall'] += span.wall
+            total['cpu'] += span.cpu
+            total['bytes_in'] += span.bytes_in
+            total['bytes_out'] += span.bytes_out
+        return totals
+
+    def peak_rss(self) -> int | None:
+        """Peak resident set size in bytes of the stages of this run, None if unknown."""
+        rss = [span.peak_rss for span in self.spans if span.peak_rss is not None]
+        return max(rss) if rss else None
+
+    def report(self, **meta) -> dict:
+        return {**meta,
+                'wall': time.perf_counter() - self._start,
+                'peak_rss': self.peak_rss(),
+                'by_stage': self.totals('name'),
+                'by_template': self.totals('template'),
+                'by_layer': self.totals('layer'),
+                'stages': [span.as_dict() for span in self.spans]}
+
+    def write_report(self, path: str, **meta):
+        with open(path, 'w') as f:
+            json.dump(self.report(**meta), f, indent=2)
+
+    def chrome_trace(self) -> dict:
+        """The spans in the Trace Event Format, can be opened in ui.perfetto.dev or chrome://tracing."""
+        events = []
+        for span in self.spans:
+            label = ' '.join(x for x in (span.name, span.template, span.layer) if x)
+            events.append({'name': label, 'cat': span.name, 'ph': 'X', 'pid': os.getpid(), 'tid': span.thread,
+                           'ts': int(span.start * 1e6), 'dur': int(span.wall * 1e6),
+                           'args': {k: v for k, v in span.as_dict().items() if k not in ('name', 'start', 'wall')}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def stage(name: str, template: str = '', layer: str = ''):
+    """Time a stage with the active tracer, does nothing without one."""
+    tracer = _current_tracer.get()
+    if tracer is None:
+        return contextlib.nullcontext(_NullSpan(name, template, layer))
+    return tracer.stage(name, template, layer)
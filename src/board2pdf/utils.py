@@ -3,6 +3,7 @@ import traceback
 import sys
 import wx
 import os
+import uuid
 
 def exception_msg(info: str, tb=True):
     msg = f"{info}\n\n" + (
@@ -167,6 +168,10 @@ def create_kicad_color_template(template_settings, template_file_path: str, laye
     
     return True
 
+def _job_id(*names: str) -> str:
+    # The same template always gets the same ids, so the jobset file only changes with the template
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "board2pdf:" + "/".join(names)))
+
 def create_kicad_jobset(template: dict, layers_dict: dict, template_dir: str, board2pdf_path: str):
     # Template:{ name: Black And White TOP, mirrored: False, tented: False, scale_or_crop: {'scaling_method': '0', 'crop_whitespace': '10', 'scale_whitespace': '30', 'scaling_factor': '3.0'}, settings: [
     #  LayerInfo:{ name: F.Cu, color_hex: #F0F0F0, with_frame: False, transparency_value: 0, negative: False, footprint_value: True, reference_designator: True, front_popups: False, back_popups: False },
@@ -216,7 +221,7 @@ def create_kicad_jobset(template: dict, layers_dict: dict, template_dir: str, bo
 
         job_dict = {}
         job_dict["description"] = "Plot " + layer_info.name
-        job_dict["id"] = os.urandom(4).hex()+"-"+os.urandom(2).hex()+"-"+os.urandom(2).hex()+"-"+os.urandom(2).hex()+"-"+os.urandom(6).hex()
+        job_dict["id"] = _job_id(template.name, layer_info.name)
         job_dict["settings"] = settings_dict
         job_dict["type"] = "pcb_export_pdf"
 
@@ -224,7 +229,7 @@ def create_kicad_jobset(template: dict, layers_dict: dict, template_dir: str, bo
 
     outputs_dict = {}
     outputs_dict["description"] = "Generate " + template.name
-    outputs_dict["id"] = os.urandom(4).hex()+"-"+os.urandom(2).hex()+"-"+os.urandom(2).hex()+"-"+os.urandom(2).hex()+"-"+os.urandom(6).hex()
+    outputs_dict["id"] = _job_id(template.name)
     outputs_dict["only"] = []
     outputs_dict["settings"] = { "output_path": "." }
     outputs_dict["type"] = "folder"